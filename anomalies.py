@@ -0,0 +1,150 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from file_lock import atomic_write
+from rankings import RANKING_KINDS
+
+# Per-node metrics with a baseline: bad modem share and median readings
+READING_METRICS = ['usp_median', 'dsp_median', 'dss_median']
+METRICS = ['percentage'] + READING_METRICS
+
+# Deviations that count as anomalies: 1 = rises only, -1 = drops only, 0 = both
+METRIC_DIRECTIONS = {
+    'percentage': 1,
+    'usp_median': 0,
+    'dsp_median': 0,
+    'dss_median': -1
+}
+
+# Smallest standard deviation assumed per metric (percentage points, dB), so
+# a node that has been steady for a while is not flagged for noise
+METRIC_MIN_STD = {
+    'percentage': 2.0,
+    'usp_median': 1.0,
+    'dsp_median': 1.0,
+    'dss_median': 1.0
+}
+
+# Weight of the newest run in the moving averages
+EWMA_ALPHA = 0.2
+
+# Deviation from the baseline, in standard deviations, that is flagged
+Z_THRESHOLD = 3.0
+
+# Runs a node needs in its baseline, and modems in the run, to be flagged
+MIN_RUNS = 5
+MIN_TOTAL = 10
+
+# Anomalies kept in the results, largest deviations first
+ANOMALY_LIMIT = 50
+
+
+def baselines_path(data_folder, city):
+    return os.path.join(data_folder, f'{city}_baselines.npz')
+
+
+def load_baselines(data_folder, city):
+    """The city's saved baselines as {name: array}, or {} if there are none"""
+    try:
+        with np.load(baselines_path(data_folder, city), allow_pickle=False) as saved:
+            return {name: saved[name] for name in saved.files}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_baselines(data_folder, city, baselines):
+    """Persist a city's baselines, replacing the previous file atomically"""
+    path = baselines_path(data_folder, city)
+    atomic_write(path, lambda f: np.savez(f, **baselines), lock=True)
+
+
+def _node_metrics(rows):
+    """Metric values per node row of the aggregates (NaN where a median is missing)"""
+    total = np.asarray([row['total_count'] for row in rows], dtype=float)
+    bad = np.asarray([row['bad_count'] for row in rows], dtype=float)
+    values = {'percentage': np.divide(bad * 100, total, out=np.zeros(len(rows)), where=total > 0)}
+    for metric in READING_METRICS:
+        values[metric] = np.asarray([row.get(metric, np.nan) for row in rows], dtype=float)
+    return total, values
+
+
+def detect_anomalies(baselines, aggregates):
+    """
+    Compare a run's per-node metrics (see ModemAccumulator.aggregates) with
+    the baselines, then fold the run into them. Baselines are exponentially
+    weighted moving averages and variances per node and metric, so each run
+    costs time in proportion to the nodes, without reading the history.
+    Nodes missing from the run keep their baseline. Returns the updated
+    baselines and the anomalies, largest deviations first.
+    """
+    updated = {}
+    anomalies = []
+    for kind, (key_col, name_col) in RANKING_KINDS.items():
+        rows = aggregates.get(kind, [])
+        nodes = np.asarray([str(row[key_col]) for row in rows], dtype=str)
+        total, values = _node_metrics(rows)
+
+        # Known nodes are updated in place, new ones are appended
+        old_nodes = baselines.get(f'{kind}_node', np.asarray([], dtype=str))
+        at = pd.Index(old_nodes).get_indexer(nodes) if len(old_nodes) else np.full(len(nodes), -1)
+        known = at >= 0
+        added = int((~known).sum())
+        at[~known] = len(old_nodes) + np.arange(added)
+        updated[f'{kind}_node'] = np.concatenate([old_nodes, nodes[~known]]).astype(str)
+        runs = np.concatenate([baselines.get(f'{kind}_runs', np.zeros(0, dtype=np.int64)),
+                               np.zeros(added, dtype=np.int64)])
+        eligible = (runs[at] >= MIN_RUNS) & (total >= MIN_TOTAL)
+
+        for metric in METRICS:
+            mean = np.concatenate([baselines.get(f'{kind}_{metric}_mean', np.zeros(0)), np.zeros(added)])
+            var = np.concatenate([baselines.get(f'{kind}_{metric}_var', np.zeros(0)), np.zeros(added)])
+            value = values[metric]
+            present = ~np.isnan(value)
+
+            # Deviation from the baseline before this run
+            std = np.maximum(np.sqrt(var[at]), METRIC_MIN_STD[metric])
+            z = (value - mean[at]) / std
+            direction = METRIC_DIRECTIONS[metric]
+            deviating = np.abs(z) >= Z_THRESHOLD if direction == 0 else direction * z >= Z_THRESHOLD
+            for i in np.flatnonzero(eligible & present & deviating):
+                anomalies.append({
+                    'kind': kind,
+                    'node': str(rows[i][key_col]),
+                    'name': str(rows[i][name_col]),
+                    'metric': metric,
+                    'value': round(float(value[i]), 2),
+                    'baseline': round(float(mean[at[i]]), 2),
+                    'std': round(float(std[i]), 2),
+                    'z': round(float(z[i]), 2),
+                    'total_count': int(total[i])
+                })
+
+            # Fold the run in; a node's first run starts its baseline
+            first = present & ~known
+            later = present & known
+            mean[at[first]] = value[first]
+            diff = value[later] - mean[at[later]]
+            increment = EWMA_ALPHA * diff
+            mean[at[later]] += increment
+            var[at[later]] = (1 - EWMA_ALPHA) * (var[at[later]] + diff * increment)
+            updated[f'{kind}_{metric}_mean'] = mean
+            updated[f'{kind}_{metric}_var'] = var
+
+        runs[at] += 1
+        updated[f'{kind}_runs'] = runs
+
+    anomalies.sort(key=lambda item: -abs(item['z']))
+    return updated, anomalies
+
+
+def update_anomalies(data_folder, city, aggregates):
+    """
+    Anomalies of a city's run against its saved baselines (see
+    detect_anomalies), updating the baselines. Call with the city's lock
+    held, once per saved run.
+    """
+    baselines, anomalies = detect_anomalies(load_baselines(data_folder, city), aggregates)
+    save_baselines(data_folder, city, baselines)
+    return anomalies[:ANOMALY_LIMIT]
@@ -1,17 +1,55 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from werkzeug.utils import secure_filename
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 import os
-import json
-from datetime import datetime
-from modem_analysis import analyze_modem_data
+import threading
+import time
+from city_results import (CITIES, analyze_city, city_from_filename, ingest_city_delta, load_city_snapshot,
+                          load_overview_snapshot, mark_ranking_changes, rescore_city)
+from snapshots import preferred_encoding
+from exports import (BAD_MODEMS_SECTION, EXPORT_FORMATS, EXPORT_SECTIONS, REPORT_SECTION, TOP_LIST_SECTIONS,
+                     available_formats, iter_csv, iter_file, offender_sheet, summary_rows, top_list_sheet,
+                     write_workbook)
+from offenders import INDEX_COLUMNS, load_offenders
+from rankings import RANKING_KINDS, SORT_KEYS as RANKING_SORT_KEYS, load_rankings
+from topology import DEGRADED_PERCENTAGE, SORT_KEYS as TOPOLOGY_SORT_KEYS, load_topology
+from result_cache import FrameCache, ResultCache
+from upload_spool import UploadSpool
+from thresholds import PROFILES, profile_for_city
+from jobs import JobStore, new_job_id, is_valid_job_id
+from history_store import HistoryStore, since_timestamp
+from metrics import MetricsStore, Timings, render
 
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 50)) * 1024 * 1024  # 50MB max file size by default
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['UPLOAD_MAX_AGE'] = int(os.environ.get('UPLOAD_RETENTION_HOURS', 24)) * 60 * 60  # Spooled uploads kept this long
+app.config['UPLOAD_MAX_BYTES'] = 2 * 1024 * 1024 * 1024
 app.config['DATA_FOLDER'] = 'data'
-
-# List of cities to analyze
-CITIES = ['novi_sad', 'sombor', 'vrsac', 'zrenjanin', 'vrbas', 'kikinda']
+app.config['CSV_ENGINE'] = os.environ.get('CSV_ENGINE', 'auto')  # 'auto', 'c' or 'pyarrow'; only 'c' memory-maps uploads
+app.config['STREAMING_THRESHOLD'] = 20 * 1024 * 1024  # Uploads above this size are analyzed in chunks
+app.config['STREAMING_CHUNK_ROWS'] = 200_000
+app.config['CACHE_FOLDER'] = os.path.join(app.config['DATA_FOLDER'], 'cache')
+app.config['CACHE_MAX_ENTRIES'] = 50
+app.config['CACHE_MAX_BYTES'] = 50 * 1024 * 1024
+app.config['FRAME_CACHE_FOLDER'] = os.path.join(app.config['CACHE_FOLDER'], 'frames')
+app.config['FRAME_CACHE_MAX_ENTRIES'] = 12
+app.config['FRAME_CACHE_MAX_BYTES'] = 500 * 1024 * 1024
+app.config['OFFENDER_CACHE_FOLDER'] = os.path.join(app.config['CACHE_FOLDER'], 'offenders')
+app.config['OFFENDER_CACHE_MAX_ENTRIES'] = 12
+app.config['OFFENDER_CACHE_MAX_BYTES'] = 200 * 1024 * 1024
+app.config['JOBS_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'jobs')
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))  # Analysis processes per gunicorn worker
+app.config['HISTORY_DB'] = os.path.join(app.config['DATA_FOLDER'], 'history.sqlite')
+app.config['HISTORY_DEFAULT_DAYS'] = 90
+app.config['HISTORY_MAX_DAYS'] = 10 * 365  # Larger ?days= values are capped (older dates overflow)
+app.config['METRICS_FOLDER'] = os.path.join(app.config['DATA_FOLDER'], 'metrics')
+app.config['DRILLDOWN_DEFAULT_LIMIT'] = 100
+app.config['DRILLDOWN_MAX_LIMIT'] = 1000
+app.config['RANKING_DEFAULT_LIMIT'] = 10
+app.config['RANKING_MAX_LIMIT'] = 1000
 
 # Ensure folders exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -19,121 +57,223 @@ os.makedirs(app.config['DATA_FOLDER'], exist_ok=True)
 
 ALLOWED_EXTENSIONS = {'csv'}
 
+# Uploaded files, saved under their content hash until the retention policy removes them
+upload_spool = UploadSpool(app.config['UPLOAD_FOLDER'],
+                           max_age=app.config['UPLOAD_MAX_AGE'],
+                           max_bytes=app.config['UPLOAD_MAX_BYTES'])
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Results of previous uploads, keyed by file content and threshold profile
+result_cache = ResultCache(app.config['CACHE_FOLDER'],
+                           max_entries=app.config['CACHE_MAX_ENTRIES'],
+                           max_bytes=app.config['CACHE_MAX_BYTES'])
 
+# Parsed uploads, keyed by file content, for re-scoring with other profiles
+frame_cache = FrameCache(app.config['FRAME_CACHE_FOLDER'],
+                         max_entries=app.config['FRAME_CACHE_MAX_ENTRIES'],
+                         max_bytes=app.config['FRAME_CACHE_MAX_BYTES'])
 
-def get_previous_identifiers(city):
-    """Get identifiers from previous analysis to detect new entries"""
-    results = load_city_results(city)
-    if not results:
-        return {'amp_names': set(), 'on_nodes': set(), 'dss_nodes': set()}
-    
-    identifiers = {
-        'amp_names': set(),
-        'on_nodes': set(),
-        'dss_nodes': set()
-    }
-    
-    # Extract AMP names from previous results
-    if 'top_10_amp' in results:
-        for item in results['top_10_amp']:
-            identifiers['amp_names'].add(item.get('amp_name', ''))
-    
-    # Extract ON nodes from previous results
-    if 'top_10_on' in results:
-        for item in results['top_10_on']:
-            identifiers['on_nodes'].add(item.get('on_node', ''))
-    
-    # Extract DSS nodes from previous results
-    if 'top_20_dss' in results:
-        for item in results['top_20_dss']:
-            identifiers['dss_nodes'].add(item.get('on_node', ''))
-    
-    return identifiers
+# Offender tables of previous uploads, keyed like result_cache
+offender_cache = FrameCache(app.config['OFFENDER_CACHE_FOLDER'],
+                            max_entries=app.config['OFFENDER_CACHE_MAX_ENTRIES'],
+                            max_bytes=app.config['OFFENDER_CACHE_MAX_BYTES'])
 
+# Per-run aggregates of every analysis, for trends
+history_store = HistoryStore(app.config['HISTORY_DB'])
 
-def calculate_summary_percentages(results):
-    """Calculate summary percentages only"""
-    total_modems = results['summary']['total_modems']
-    
-    if total_modems == 0:
-        return results
-    
-    # Summary percentages
-    results['summary']['usp_dsp_percentage'] = round(
-        (results['summary']['usp_dsp_count'] / total_modems) * 100, 2
-    )
-    results['summary']['usp_dsp_dss_percentage'] = round(
-        (results['summary']['usp_dsp_dss_count'] / total_modems) * 100, 2
-    )
-    results['summary']['healthy_count'] = total_modems - results['summary']['usp_dsp_dss_count']
-    results['summary']['healthy_percentage'] = round(
-        (results['summary']['healthy_count'] / total_modems) * 100, 2
-    )
-    
-    return results
+# Counters and histograms of every process, served by /metrics
+metrics_store = MetricsStore(app.config['METRICS_FOLDER'])
 
+# Status of queued uploads, readable from every worker
+job_store = JobStore(app.config['JOBS_FOLDER'])
 
-def mark_new_entries(results, previous_identifiers):
-    """Mark entries that are new compared to previous analysis"""
-    
-    # Mark new AMP entries
-    if 'top_10_amp' in results:
-        for item in results['top_10_amp']:
-            amp_name = item.get('amp_name', '')
-            item['is_new'] = amp_name not in previous_identifiers['amp_names']
-    
-    # Mark new ON node entries
-    if 'top_10_on' in results:
-        for item in results['top_10_on']:
-            on_node = item.get('on_node', '')
-            item['is_new'] = on_node not in previous_identifiers['on_nodes']
-    
-    # Mark new DSS node entries
-    if 'top_20_dss' in results:
-        for item in results['top_20_dss']:
-            on_node = item.get('on_node', '')
-            item['is_new'] = on_node not in previous_identifiers['dss_nodes']
-    
-    # Count new entries for summary
-    new_counts = {
-        'new_amp_count': sum(1 for item in results.get('top_10_amp', []) if item.get('is_new', False)),
-        'new_on_count': sum(1 for item in results.get('top_10_on', []) if item.get('is_new', False)),
-        'new_dss_count': sum(1 for item in results.get('top_20_dss', []) if item.get('is_new', False))
-    }
+# Analysis process pool, created on first use so each gunicorn worker gets its own
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=app.config['JOB_WORKERS'])
+        return _executor
+
+
+def discard_executor(executor):
+    """
+    Drop a broken pool (an analysis process died, e.g. killed for memory),
+    so the next upload starts a new one instead of failing
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def submit_job(fn, *args):
+    """Submit to the analysis pool, replacing it once if it is broken"""
+    executor = get_executor()
+    try:
+        return executor, executor.submit(fn, *args)
+    except BrokenProcessPool:
+        discard_executor(executor)
+        executor = get_executor()
+        return executor, executor.submit(fn, *args)
+
+
+def job_finished(job_id, executor, future):
+    """
+    Done callback of a queued job. process_upload_job records its own
+    errors, so an exception here means the job never finished, e.g. its
+    process died: mark it failed instead of leaving it in its last stage.
+    """
+    if future.cancelled():
+        job_store.update(job_id, status='failed', error='Analysis was cancelled')
+        return
+    error = future.exception()
+    if error is None:
+        return
+    if isinstance(error, BrokenProcessPool):
+        discard_executor(executor)
+        message = 'The analysis process stopped unexpectedly (possibly out of memory), please try again'
+    else:
+        message = f'Error processing file: {str(error)}'
+    job_store.update(job_id, status='failed', error=message)
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def queue_upload(city, file, profile=None, timings=None, include_timings=False, delta=False, executor=None):
+    """
+    Spool an uploaded file to disk and queue it for analysis, returning the job ID.
+    timings (a metrics.Timings) gets the time spent on each upload step and
+    is handed to the job, which adds the analysis stages. With delta the
+    file is a delta export (see city_results.ingest_city_delta). executor
+    runs the job instead of the worker's pool (see upload_batch).
+    """
+    timings = timings or Timings()
+    job_id = new_job_id()
+    # The content hash is computed while the file is written
+    with timings.span('upload_save'):
+        digest, csv_path = upload_spool.save(file.stream)
     
-    results['new_entries_summary'] = new_counts
+    # Large exports are streamed in chunks to keep worker memory bounded
+    chunksize = None
+    if os.path.getsize(csv_path) > app.config['STREAMING_THRESHOLD']:
+        chunksize = app.config['STREAMING_CHUNK_ROWS']
     
-    return results
+    job_store.create(job_id, city)
+    try:
+        # The job adds the time until it starts as 'queue_wait'
+        job = (process_upload_job, job_id, city, csv_path, digest, chunksize, profile,
+               timings, include_timings, time.time(), delta)
+        if executor is None:
+            executor, future = submit_job(*job)
+        else:
+            future = executor.submit(*job)
+        future.add_done_callback(partial(job_finished, job_id, executor))
+    except Exception:
+        job_store.update(job_id, status='failed', error='Could not queue analysis')
+        raise
+    return job_id
 
 
-def save_city_results(city, results):
-    """Save analysis results for a city to JSON file"""
-    filepath = os.path.join(app.config['DATA_FOLDER'], f'{city}_latest.json')
-    results['timestamp'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    results['city'] = city
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
+def process_upload_job(job_id, city, csv_path, digest, chunksize, profile=None,
+                       timings=None, include_timings=False, queued_at=None, delta=False):
+    """
+    Analyze a saved upload in a pool process and store the results for the
+    city; with delta, apply a delta export to the city's modem state
+    instead. Stage durations go to /metrics, and to the job's results as
+    'timings' (milliseconds) when include_timings is set.
+    """
+    def progress(stage, rows):
+        job_store.update(job_id, status=stage, rows=rows)
+    
+    timings = timings or Timings()
+    if queued_at is not None:
+        timings.add('queue_wait', max(0, time.time() - queued_at))
+    upload_spool.touch(csv_path)
+    start = time.perf_counter()
+    status = 'failed'
+    try:
+        if delta:
+            progress('aggregating', 0)
+            results = ingest_city_delta(app.config['DATA_FOLDER'], city, csv_path,
+                                        engine=app.config['CSV_ENGINE'], history=history_store,
+                                        timings=timings)
+        else:
+            results = analyze_city(app.config['DATA_FOLDER'], city, csv_path,
+                                   engine=app.config['CSV_ENGINE'], chunksize=chunksize,
+                                   progress=progress, profile=profile, digest=digest,
+                                   cache=result_cache, frame_cache=frame_cache,
+                                   offender_cache=offender_cache, history=history_store,
+                                   timings=timings)
+        
+        if results['success']:
+            status = 'done'
+            analyzed = results['delta']['rows'] if delta else results['summary']['total_modems']
+            metrics_store.inc('modem_modems_analyzed_total', {'city': city}, analyzed)
+            if include_timings:
+                results['timings'] = timings.as_dict()
+            job_store.update(job_id, status='done', results=results)
+        else:
+            job_store.update(job_id, status='failed', error=results['error'])
+            
+    except Exception as e:
+        import traceback
+        job_store.update(job_id, status='failed',
+                         error=f'Error processing file: {str(e)}',
+                         traceback=traceback.format_exc())
+    finally:
+        metrics_store.observe('modem_analysis_duration_seconds', time.perf_counter() - start, {'city': city})
+        metrics_store.inc('modem_jobs_total', {'city': city, 'status': status})
+        metrics_store.record_timings(timings)
+        metrics_store.flush()
 
 
-def load_city_results(city):
-    """Load latest analysis results for a city from JSON file"""
-    filepath = os.path.join(app.config['DATA_FOLDER'], f'{city}_latest.json')
-    if os.path.exists(filepath):
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return None
+def snapshot_response(snapshot):
+    """
+    Serve a cached JSON snapshot with ETag/Last-Modified validators,
+    answering conditional requests with 304 and compressing the body
+    with brotli or gzip when the client accepts it.
+    """
+    encoding = preferred_encoding(request.accept_encodings)
+    body = snapshot.encoded(encoding) if encoding else snapshot.body
+    
+    response = Response(body, mimetype='application/json')
+    response.set_etag(f'{snapshot.etag}-{encoding}' if encoding else snapshot.etag)
+    response.last_modified = snapshot.mtime
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response.make_conditional(request)
 
 
 @app.route('/')
 def index():
-    return render_template('index.html', cities=CITIES)
+    # The Excel report link is shown only when openpyxl is installed
+    return render_template('index.html', cities=CITIES, export_formats=available_formats())
+
+
+def _timings_requested():
+    return request.values.get('timings', '').lower() in ('1', 'true', 'yes')
 
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    """
+    Queue an export for analysis. With timings=1 (form field or query) the
+    job's results include per-stage durations in milliseconds. With
+    delta=1 the file lists only changed modems and updates the city's
+    latest results (the city's saved profile is kept).
+    """
+    timings = Timings()
+    validate_start = time.perf_counter()
+    
     if 'file' not in request.files:
         return jsonify({'success': False, 'error': 'No file provided'}), 400
     
@@ -153,33 +293,73 @@ def upload_file():
     if not allowed_file(file.filename):
         return jsonify({'success': False, 'error': 'Invalid file type. Please upload a CSV file.'}), 400
     
+    profile = request.form.get('profile') or profile_for_city(city)
+    if profile not in PROFILES:
+        return jsonify({'success': False, 'error': f'Unknown threshold profile: {profile}'}), 400
+    
+    delta = request.form.get('delta', '').lower() in ('1', 'true', 'yes')
+    
+    timings.add('upload_validate', time.perf_counter() - validate_start)
+    
+    # Save the upload so it can be analyzed outside of this request
     try:
-        # Get previous identifiers BEFORE analyzing new data
-        previous_identifiers = get_previous_identifiers(city)
-        
-        # Analyze the file directly from memory
-        results = analyze_modem_data(file)
-        
-        if results['success']:
-            # Calculate summary percentages
-            results = calculate_summary_percentages(results)
-            
-            # Mark new entries by comparing with previous data
-            results = mark_new_entries(results, previous_identifiers)
-            
-            # Save results for this city
-            save_city_results(city, results)
-            return jsonify(results), 200
-        else:
-            return jsonify(results), 500
-            
+        job_id = queue_upload(city, file, profile, timings=timings, include_timings=_timings_requested(),
+                              delta=delta)
     except Exception as e:
-        import traceback
-        return jsonify({
-            'success': False, 
-            'error': f'Error processing file: {str(e)}',
-            'traceback': traceback.format_exc()
-        }), 500
+        return jsonify({'success': False, 'error': f'Could not queue analysis: {str(e)}'}), 500
+    
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'queued'}), 202
+
+
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    """
+    Upload exports for several cities at once. Each file is sent under
+    the city name (e.g. novi_sad=<file>) or under 'files' with the city
+    in the file name. Every city is analyzed in parallel as its own job,
+    in a pool of the batch's own with a process per city (up to the CPU
+    count), so the batch takes about as long as its largest city.
+    """
+    uploads = {}
+    for field, file in request.files.items(multi=True):
+        city = field.lower() if field.lower() in CITIES else city_from_filename(file.filename)
+        if city is None:
+            return jsonify({'success': False, 'error': f'Cannot determine city for file: {file.filename}'}), 400
+        if city in uploads:
+            return jsonify({'success': False, 'error': f'More than one file for city: {city}'}), 400
+        if file.filename == '' or not allowed_file(file.filename):
+            return jsonify({'success': False, 'error': f'Invalid file for {city}. Please upload CSV files.'}), 400
+        uploads[city] = file
+    
+    if not uploads:
+        return jsonify({'success': False, 'error': 'No file provided'}), 400
+    
+    jobs = {}
+    executor = ProcessPoolExecutor(max_workers=min(len(uploads), os.cpu_count() or 1))
+    try:
+        for city, file in uploads.items():
+            jobs[city] = queue_upload(city, file, include_timings=_timings_requested(), executor=executor)
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Could not queue analysis: {str(e)}', 'jobs': jobs}), 500
+    finally:
+        # The processes exit once the queued jobs are done
+        executor.shutdown(wait=False)
+    
+    return jsonify({'success': True, 'jobs': jobs}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Get the status of an upload job, with results once it is done"""
+    if not is_valid_job_id(job_id):
+        return jsonify({'success': False, 'error': 'Invalid job ID'}), 400
+    
+    job = job_store.get(job_id)
+    
+    if job:
+        return jsonify({'success': True, **job}), 200
+    else:
+        return jsonify({'success': False, 'error': 'Unknown job'}), 404
 
 
 @app.route('/get_latest/<city>', methods=['GET'])
@@ -190,13 +370,296 @@ def get_latest(city):
     if city not in CITIES:
         return jsonify({'success': False, 'error': f'Invalid city: {city}'}), 400
     
-    results = load_city_results(city)
+    snapshot = load_city_snapshot(app.config['DATA_FOLDER'], city)
     
-    if results:
-        return jsonify(results), 200
+    if snapshot:
+        return snapshot_response(snapshot)
     else:
         return jsonify({'success': False, 'error': 'No data available for this city'}), 404
 
 
+@app.route('/export/<city>/<section>', methods=['GET'])
+def export(city, section):
+    """
+    Download one section of the city's latest results (?format=csv or xlsx):
+    'amp', 'on' or 'dss' for a top list, 'bad_modems' for every flagged
+    modem, or 'report' for a workbook with all of them. The file is
+    generated while it is sent, so large offender lists use little memory.
+    """
+    city = city.lower()
+    fmt = request.args.get('format', 'csv').lower()
+    
+    if city not in CITIES:
+        return jsonify({'success': False, 'error': f'Invalid city: {city}'}), 400
+    
+    if section not in EXPORT_SECTIONS:
+        return jsonify({'success': False, 'error': f'Invalid export section: {section}'}), 400
+    
+    if fmt not in available_formats():
+        return jsonify({'success': False, 'error': f'Unsupported export format: {fmt}'}), 400
+    
+    if section == REPORT_SECTION and fmt != 'xlsx':
+        return jsonify({'success': False, 'error': 'The report is only available as xlsx'}), 400
+    
+    snapshot = load_city_snapshot(app.config['DATA_FOLDER'], city)
+    if not snapshot:
+        return jsonify({'success': False, 'error': 'No data available for this city'}), 404
+    results = snapshot.data
+    
+    sheets = [top_list_sheet(results, name) for name in TOP_LIST_SECTIONS if section in (name, REPORT_SECTION)]
+    if section in (BAD_MODEMS_SECTION, REPORT_SECTION):
+        offenders = load_offenders(app.config['DATA_FOLDER'], city)
+        if offenders is None:
+            return jsonify({'success': False, 'error': 'No bad modem list available for this city'}), 404
+        sheets.append(offender_sheet(offenders))
+    
+    if fmt == 'csv':
+        _, headers, row_chunks = sheets[0]
+        body = stream_with_context(iter_csv(headers, row_chunks))
+    else:
+        footer = summary_rows(results) if section in ('amp', REPORT_SECTION) else None
+        body = iter_file(write_workbook(sheets, footer=footer))
+    
+    stamp = results.get('timestamp', '').replace(' ', '_').replace(':', '-')
+    filename = f'{city}_{section}_{stamp}.{fmt}' if stamp else f'{city}_{section}.{fmt}'
+    response = Response(body, mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def _int_arg(name, default, minimum, maximum=None):
+    try:
+        value = max(minimum, int(request.args.get(name, default)))
+    except ValueError:
+        return default
+    return min(value, maximum) if maximum is not None else value
+
+
+@app.route('/drilldown/<city>/<kind>/<path:node>', methods=['GET'])
+def drilldown(city, kind, node):
+    """
+    Bad modems of one AMP (kind 'amp' by AMP name, 'amp_code' by AMP code)
+    or ON node (kind 'on') in the city's latest results, in export order.
+    Paginated with ?offset= and ?limit= (default 100, at most 1000).
+    """
+    city = city.lower()
+    
+    if city not in CITIES:
+        return jsonify({'success': False, 'error': f'Invalid city: {city}'}), 400
+    
+    if kind not in INDEX_COLUMNS:
+        return jsonify({'success': False, 'error': f'Invalid node type: {kind}'}), 400
+    
+    offenders = load_offenders(app.config['DATA_FOLDER'], city)
+    if offenders is None:
+        return jsonify({'success': False, 'error': 'No bad modem list available for this city'}), 404
+    
+    offset = _int_arg('offset', 0, 0)
+    limit = _int_arg('limit', app.config['DRILLDOWN_DEFAULT_LIMIT'], 1, app.config['DRILLDOWN_MAX_LIMIT'])
+    rows = offenders.node_rows(kind, node)
+    page = offenders.frame(rows[offset:offset + limit])
+    
+    return jsonify({
+        'success': True,
+        'city': city,
+        'kind': kind,
+        'node': node,
+        'total': len(rows),
+        'offset': offset,
+        'limit': limit,
+        'modems': page.to_dict('records')
+    }), 200
+
+
+@app.route('/rankings/<city>/<kind>', methods=['GET'])
+def rankings(city, kind):
+    """
+    A page of the city's AMP (kind 'amp') or ON node (kind 'on') ranking
+    in the latest results. ?sort= is bad_count (the top list order),
+    percentage or dss; ?n= (default 10, at most 1000) and ?offset= select
+    the page and ?min_total= skips nodes with fewer modems. Entries are
+    compared with the previous run like the top lists.
+    """
+    city = city.lower()
+    
+    if city not in CITIES:
+        return jsonify({'success': False, 'error': f'Invalid city: {city}'}), 400
+    
+    if kind not in RANKING_KINDS:
+        return jsonify({'success': False, 'error': f'Invalid node type: {kind}'}), 400
+    
+    sort = request.args.get('sort', 'bad_count')
+    if sort not in RANKING_SORT_KEYS:
+        return jsonify({'success': False, 'error': f'Invalid sort key: {sort}'}), 400
+    
+    ranked = load_rankings(app.config['DATA_FOLDER'], city)
+    if ranked is None:
+        return jsonify({'success': False, 'error': 'No rankings available for this city'}), 404
+    
+    offset = _int_arg('offset', 0, 0)
+    n = _int_arg('n', app.config['RANKING_DEFAULT_LIMIT'], 1, app.config['RANKING_MAX_LIMIT'])
+    total, items = ranked.page(kind, sort, offset, n, min_total=_int_arg('min_total', 1, 1))
+    if ranked.run_id is not None:
+        mark_ranking_changes(items, history_store, city, ranked.run_id, kind, sort)
+    
+    return jsonify({
+        'success': True,
+        'city': city,
+        'kind': kind,
+        'sort': sort,
+        'total': total,
+        'offset': offset,
+        'n': n,
+        'items': items
+    }), 200
+
+
+@app.route('/topology/<city>', methods=['GET'])
+def topology(city):
+    """
+    Worst subtrees of the city's plant (hub, ON node, AMP cascade) in the
+    latest results. ?level= (0 = hub, 1 = ON node, 2+ = AMP cascade) and
+    ?kind= (hub, on, amp) filter the nodes, ?sort= is one of bad_count,
+    dss_count, percentage or dss_percentage, ?min_total= skips small
+    subtrees and ?n= is the number of nodes (default 10, at most 1000).
+    """
+    city = city.lower()
+    
+    if city not in CITIES:
+        return jsonify({'success': False, 'error': f'Invalid city: {city}'}), 400
+    
+    sort = request.args.get('sort', 'bad_count')
+    if sort not in TOPOLOGY_SORT_KEYS:
+        return jsonify({'success': False, 'error': f'Invalid sort key: {sort}'}), 400
+    
+    tree = load_topology(app.config['DATA_FOLDER'], city)
+    if tree is None:
+        return jsonify({'success': False, 'error': 'No topology available for this city'}), 404
+    
+    nodes = tree.worst(level=request.args.get('level', type=int), kind=request.args.get('kind') or None,
+                       sort=sort, n=_int_arg('n', app.config['RANKING_DEFAULT_LIMIT'], 1,
+                                             app.config['RANKING_MAX_LIMIT']),
+                       min_total=_int_arg('min_total', 1, 1))
+    
+    return jsonify({
+        'success': True,
+        'city': city,
+        'sort': sort,
+        'nodes': tree.rows(nodes)
+    }), 200
+
+
+@app.route('/topology/<city>/degraded', methods=['GET'])
+def degraded_upstream(city):
+    """
+    Amplifiers whose downstream amplifiers are all degraded, i.e. have a
+    bad modem share of at least ?min_percentage= (default 20), pointing at
+    a fault upstream of them. ?min_children= (default 1) is the number of
+    downstream amplifiers needed.
+    """
+    city = city.lower()
+    
+    if city not in CITIES:
+        return jsonify({'success': False, 'error': f'Invalid city: {city}'}), 400
+    
+    tree = load_topology(app.config['DATA_FOLDER'], city)
+    if tree is None:
+        return jsonify({'success': False, 'error': 'No topology available for this city'}), 404
+    
+    min_percentage = request.args.get('min_percentage', DEGRADED_PERCENTAGE, type=float)
+    nodes = tree.degraded_upstream(min_percentage=min_percentage, min_children=_int_arg('min_children', 1, 1))
+    
+    return jsonify({
+        'success': True,
+        'city': city,
+        'min_percentage': min_percentage,
+        'nodes': tree.rows(nodes)
+    }), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, added up over every worker and analysis process"""
+    return Response(render(*metrics_store.collect()), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/profiles', methods=['GET'])
+def profiles():
+    """Available threshold profiles and the profile used for each city"""
+    return jsonify({
+        'success': True,
+        'profiles': PROFILES,
+        'cities': {city: profile_for_city(city) for city in CITIES}
+    }), 200
+
+
+@app.route('/what_if/<city>/<profile>', methods=['GET'])
+def what_if(city, profile):
+    """Re-score the city's latest upload with another threshold profile, without saving"""
+    city = city.lower()
+    
+    if city not in CITIES:
+        return jsonify({'success': False, 'error': f'Invalid city: {city}'}), 400
+    
+    if profile not in PROFILES:
+        return jsonify({'success': False, 'error': f'Unknown threshold profile: {profile}'}), 400
+    
+    results = rescore_city(app.config['DATA_FOLDER'], city, profile,
+                           cache=result_cache, frame_cache=frame_cache, spool=upload_spool,
+                           engine=app.config['CSV_ENGINE'],
+                           streaming_threshold=app.config['STREAMING_THRESHOLD'],
+                           chunksize=app.config['STREAMING_CHUNK_ROWS'])
+    
+    if results is None:
+        return jsonify({'success': False, 'error': 'No data available for this city'}), 404
+    elif results['success']:
+        return jsonify(results), 200
+    else:
+        return jsonify(results), 409
+
+
+@app.route('/overview', methods=['GET'])
+def overview():
+    """Region-wide KPIs and worst nodes for all cities in one response"""
+    return snapshot_response(load_overview_snapshot(app.config['DATA_FOLDER']))
+
+
+def _history_days():
+    try:
+        days = int(request.args.get('days', app.config['HISTORY_DEFAULT_DAYS']))
+    except ValueError:
+        return app.config['HISTORY_DEFAULT_DAYS']
+    return min(max(1, days), app.config['HISTORY_MAX_DAYS'])
+
+
+@app.route('/history/<city>', methods=['GET'])
+def city_history(city):
+    """Summary counts of every run for a city over the last ?days= days (default 90)"""
+    city = city.lower()
+    
+    if city not in CITIES:
+        return jsonify({'success': False, 'error': f'Invalid city: {city}'}), 400
+    
+    days = _history_days()
+    trend = history_store.city_trend(city, since_timestamp(days))
+    return jsonify({'success': True, 'city': city, 'days': days, 'trend': trend}), 200
+
+
+@app.route('/history/<city>/<kind>/<path:node>', methods=['GET'])
+def node_history(city, kind, node):
+    """Bad-modem trend for one AMP (kind 'amp', by AMP name) or ON node (kind 'on')"""
+    city = city.lower()
+    
+    if city not in CITIES:
+        return jsonify({'success': False, 'error': f'Invalid city: {city}'}), 400
+    
+    if kind not in ('amp', 'on'):
+        return jsonify({'success': False, 'error': f'Invalid node type: {kind}'}), 400
+    
+    days = _history_days()
+    trend = history_store.node_trend(city, kind, node, since_timestamp(days))
+    return jsonify({'success': True, 'city': city, 'kind': kind, 'node': node,
+                    'days': days, 'trend': trend}), 200
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,89 @@
+"""
+Analyze the daily exports for several cities in parallel.
+
+    python batch_analysis.py <directory> [--data-folder data] [--workers N]
+
+Every CSV in the directory is matched to a city by its file name
+(e.g. 'Novi Sad.csv', 'vrsac_2024-10-01.csv'). Each city is analyzed in its
+own process and its results are written to {data-folder}/{city}_latest.json,
+the same files the web application shows.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from city_results import analyze_city, city_from_filename
+from history_store import HistoryStore
+from modem_analysis import CSV_ENGINES
+from thresholds import PROFILES
+
+
+def find_city_files(directory):
+    """Map each city to its export in directory; exits on unknown or duplicate files"""
+    city_files = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith('.csv'):
+            continue
+        city = city_from_filename(name)
+        if city is None:
+            sys.exit(f'Cannot determine city for file: {name}')
+        if city in city_files:
+            sys.exit(f'More than one file for city {city}: {os.path.basename(city_files[city])}, {name}')
+        city_files[city] = os.path.join(directory, name)
+    return city_files
+
+
+def print_summary(city, results):
+    summary = results['summary']
+    print(f"\n{city}:")
+    print(f"  Ukupan broj modema: {summary['total_modems']}")
+    print(f"  Total Count USP+DSP: {summary['usp_dsp_count']}")
+    print(f"  Total Count USP+DSP+DSS: {summary['usp_dsp_dss_count']}")
+    for item in results['top_10_on'][:3]:
+        print(f"  {item['rank']}. {item['on_node']} - {item['on_name']}: {item['bad_count']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze modem exports for several cities in parallel.')
+    parser.add_argument('directory', help='directory with one CSV export per city')
+    parser.add_argument('--data-folder', default='data', help='where {city}_latest.json files are written')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: CPU count)')
+    parser.add_argument('--engine', default='auto', choices=CSV_ENGINES, help='CSV parser engine')
+    parser.add_argument('--chunksize', type=int, default=None, help='stream each file in chunks of this many rows')
+    parser.add_argument('--profile', default=None, choices=sorted(PROFILES),
+                        help='threshold profile (default: each city\'s configured profile)')
+    args = parser.parse_args(argv)
+
+    city_files = find_city_files(args.directory)
+    if not city_files:
+        sys.exit(f'No CSV files found in {args.directory}')
+    os.makedirs(args.data_folder, exist_ok=True)
+    history = HistoryStore(os.path.join(args.data_folder, 'history.sqlite'))
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(analyze_city, args.data_folder, city, path,
+                            engine=args.engine, chunksize=args.chunksize, profile=args.profile,
+                            history=history): city
+            for city, path in city_files.items()
+        }
+        for future in as_completed(futures):
+            city = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                results = {'success': False, 'error': str(e)}
+            if results['success']:
+                print_summary(city, results)
+            else:
+                failed.append(city)
+                print(f"\n{city}: FAILED\n{results['error']}", file=sys.stderr)
+
+    print(f"\n✓ Analyzed {len(city_files) - len(failed)} of {len(city_files)} cities")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
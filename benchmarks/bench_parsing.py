@@ -0,0 +1,77 @@
+"""
+Compare the old per-cell validation/dpath parsing with parse_modem_frame.
+
+    python benchmarks/bench_parsing.py [rows]
+"""
+import os
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from modem_analysis import parse_modem_frame  # noqa: E402
+from synthetic import write_export  # noqa: E402
+
+
+def legacy_parse(df):
+    """Per-cell .apply() parsing as analyze_modem_data used to do it"""
+    dss_col = df.columns[5]
+
+    def is_valid_number(val):
+        if pd.isna(val):
+            return False
+        if isinstance(val, (int, float)):
+            return not np.isnan(val)
+        str_val = str(val).strip()
+        if str_val == '-' or str_val == '' or str_val.lower() == 'nan':
+            return False
+        try:
+            float(str_val)
+            return True
+        except ValueError:
+            return False
+
+    valid = df['USP'].apply(is_valid_number) & df['DSP'].apply(is_valid_number) & df[dss_col].apply(is_valid_number)
+    df_valid = df[valid].copy()
+    for col in ('USP', 'DSP', dss_col):
+        df_valid[col] = pd.to_numeric(df_valid[col], errors='coerce')
+    df_valid['ON_NODE'] = df_valid['dpath'].str.extract(r'(ON-\d+-\d+)')
+
+    def extract_amp_code(dpath):
+        if pd.isna(dpath):
+            return None
+        matches = re.findall(r'(AMP-\d+-\d+)', str(dpath))
+        return matches[-1] if matches else None
+
+    df_valid['AMP_CODE'] = df_valid['dpath'].apply(extract_amp_code)
+    return df_valid
+
+
+def best_of(func, df, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(df)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 120_000
+    with tempfile.TemporaryDirectory() as tmp:
+        df = pd.read_csv(write_export(os.path.join(tmp, 'export.csv'), rows))
+
+    legacy = best_of(legacy_parse, df)
+    vectorized = best_of(parse_modem_frame, df)
+    print(f'rows:        {rows:,}')
+    print(f'legacy:      {legacy:.3f} s')
+    print(f'vectorized:  {vectorized:.3f} s')
+    print(f'speedup:     {legacy / vectorized:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Benchmarks of the analysis pipeline, in the style of asv: each suite has
+`params`, a `setup(rows)` and `time_*` (seconds) or `peakmem_*` (peak
+process RSS) methods. Run them with benchmarks/run.py.
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from city_results import analyze_city, ingest_city_delta  # noqa: E402
+from modem_analysis import ModemAccumulator, analyze_modem_data, parse_modem_frame, read_modem_csv  # noqa: E402
+from modem_state import load_modem_state  # noqa: E402
+from synthetic import ensure_export, generate_export  # noqa: E402
+
+# Rows per chunk in the streaming benchmarks (the app's STREAMING_CHUNK_ROWS)
+CHUNK_ROWS = 200_000
+
+# Share of an export's modems listed in the delta benchmark, and the shares
+# of those removed (missing reading) and brand new
+DELTA_SHARE = 0.005
+DELTA_REMOVED = 0.05
+DELTA_NEW = 0.05
+
+# Node name columns a delta only ever adds to (see ModemState.apply_delta),
+# left out when a delta is compared with a full analysis
+DELTA_NAME_COLUMNS = ('amp_code', 'on_name')
+
+
+class ParseSuite:
+    """Reading and parsing an export"""
+
+    params = [10_000, 100_000, 1_000_000]
+
+    def setup(self, rows):
+        self.path = ensure_export(rows)
+        self.raw = read_modem_csv(self.path)
+
+    def time_read_csv(self, rows):
+        read_modem_csv(self.path)
+
+    def time_read_csv_c_engine(self, rows):
+        read_modem_csv(self.path, engine='c')
+
+    def time_parse_frame(self, rows):
+        parse_modem_frame(self.raw)
+
+
+class AggregateSuite:
+    """Scoring and aggregating an already parsed export"""
+
+    params = [10_000, 100_000, 1_000_000]
+
+    def setup(self, rows):
+        self.frame = parse_modem_frame(read_modem_csv(ensure_export(rows)))
+
+    def time_aggregate(self, rows):
+        ModemAccumulator().add(self.frame).results()
+
+    def time_aggregate_with_offenders(self, rows):
+        ModemAccumulator(collect_offenders=True).add(self.frame).offenders()
+
+
+class AnalyzeSuite:
+    """analyze_modem_data end to end, loading the file whole or streaming it"""
+
+    params = [10_000, 100_000, 1_000_000]
+
+    def setup(self, rows):
+        self.path = ensure_export(rows)
+
+    def time_analyze(self, rows):
+        analyze_modem_data(self.path)
+
+    def time_analyze_streaming(self, rows):
+        analyze_modem_data(self.path, chunksize=CHUNK_ROWS)
+
+    def peakmem_analyze(self, rows):
+        analyze_modem_data(self.path)
+
+    def peakmem_analyze_streaming(self, rows):
+        analyze_modem_data(self.path, chunksize=CHUNK_ROWS)
+
+
+class UploadSuite:
+    """
+    POST /upload until the job is done, through the Flask test client and
+    the real job pool, in a scratch working directory. Result caching is
+    defeated by uploading a file with one extra byte each time.
+    """
+
+    params = [10_000, 100_000]
+
+    def setup(self, rows):
+        with open(ensure_export(rows), 'rb') as f:
+            self.body = f.read()
+        self.workdir = tempfile.TemporaryDirectory()
+        os.chdir(self.workdir.name)
+        import app
+        self.app = app
+        self.client = app.app.test_client()
+        self.uploads = 0
+        # Start the job pool before timing
+        self.time_upload(rows)
+
+    def teardown(self, rows):
+        if self.app._executor is not None:
+            self.app._executor.shutdown()
+        self.workdir.cleanup()
+
+    def time_upload(self, rows):
+        self.uploads += 1
+        body = self.body + b'\n' * self.uploads
+        response = self.client.post('/upload', data={'city': 'novi_sad', 'file': (io.BytesIO(body), 'export.csv')},
+                                    content_type='multipart/form-data')
+        job_id = response.get_json()['job_id']
+        while True:
+            job = self.client.get(f'/jobs/{job_id}').get_json()
+            if job['status'] in ('done', 'failed'):
+                break
+            time.sleep(0.005)
+        if job['status'] != 'done':
+            raise RuntimeError(job.get('error'))
+
+
+def _node_rows(rows):
+    # Aggregate rows without the name columns, in the order of their key (the first column)
+    rows = [{key: value for key, value in row.items() if key not in DELTA_NAME_COLUMNS} for row in rows]
+    return sorted(rows, key=lambda row: str(next(iter(row.values()))))
+
+
+def check_delta(results, aggregates, expected):
+    """
+    Raise if a delta's results and aggregates differ from a full analysis
+    (expected, with include_aggregates) of the export the delta leads to
+    """
+    mismatches = [field for field in expected['summary'] if results['summary'][field] != expected['summary'][field]]
+    for name in ('top_10_amp', 'top_10_on', 'top_20_dss'):
+        fields = [field for field in (expected[name][0] if expected[name] else {}) if field not in DELTA_NAME_COLUMNS]
+        if [{field: item[field] for field in fields} for item in results[name]] != \
+                [{field: item[field] for field in fields} for item in expected[name]]:
+            mismatches.append(name)
+    for kind in ('amp', 'on', 'paths'):
+        if _node_rows(aggregates[kind]) != _node_rows(expected['aggregates'][kind]):
+            mismatches.append(f'aggregates.{kind}')
+    if mismatches:
+        raise RuntimeError(f'delta differs from a full analysis in {", ".join(mismatches)}')
+
+
+class DeltaSuite:
+    """
+    ingest_city_delta on a city saved from a full export, with a delta
+    listing DELTA_SHARE of its modems: mostly changed readings, some
+    removed and some new modems. setup also checks that the delta gives
+    the results of a full analysis of the export it leads to, so the suite
+    fails if the two ever differ. Repeated runs apply the delta again,
+    which then only updates modems.
+    """
+
+    params = [10_000, 100_000, 1_000_000]
+
+    def setup(self, rows):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.data_folder = self.workdir.name
+        path = ensure_export(rows)
+        analyze_city(self.data_folder, 'novi_sad', path, digest='benchmark')
+
+        # Modems with valid readings, so each is in the saved state
+        export = pd.read_csv(path, dtype=str, keep_default_na=False)
+        valid = parse_modem_frame(read_modem_csv(path)).index.to_numpy()
+        rng = np.random.default_rng(0)
+        listed = max(20, int(rows * DELTA_SHARE))
+        delta = export.iloc[rng.choice(valid, listed, replace=False)].copy()
+        delta['USP'] = np.round(rng.normal(44, 6, listed), 1).astype(str)
+        delta['DSS'] = np.round(rng.normal(38, 3, listed), 1).astype(str)
+        removed = delta.index[:int(listed * DELTA_REMOVED)]
+        delta.loc[removed, 'DSP'] = '-'
+        new = generate_export(int(listed * DELTA_NEW), seed=1, start=rows, plant_rows=rows, missing_rate=0)
+        delta = pd.concat([delta, new.astype(str)])
+        self.delta_path = os.path.join(self.data_folder, 'delta.csv')
+        delta.to_csv(self.delta_path, index=False)
+
+        # The export after the delta: changed rows in place, new ones at the end
+        expected = export.copy()
+        expected.loc[delta.index[:listed]] = delta.iloc[:listed]
+        expected = pd.concat([expected.drop(removed), new.astype(str)])
+        expected_path = os.path.join(self.data_folder, 'expected.csv')
+        expected.to_csv(expected_path, index=False)
+
+        results = ingest_city_delta(self.data_folder, 'novi_sad', self.delta_path)
+        if not results['success']:
+            raise RuntimeError(results['error'])
+        aggregates = load_modem_state(self.data_folder, 'novi_sad').totals().aggregates()
+        check_delta(results, aggregates, analyze_modem_data(expected_path, include_aggregates=True))
+
+    def teardown(self, rows):
+        self.workdir.cleanup()
+
+    def time_delta(self, rows):
+        ingest_city_delta(self.data_folder, 'novi_sad', self.delta_path)
@@ -0,0 +1,143 @@
+"""
+Run the benchmark suites in bench_pipeline.py and catch regressions.
+
+    python benchmarks/run.py [--rows 10000 100000] [--filter Analyze]
+        [--repeat 5] [--save results.json] [--compare baseline.json]
+
+Every benchmark runs in a fresh process, so peak RSS is not inflated by
+earlier ones. With --compare the results are checked against a file
+written by --save and the exit status is 1 if anything got slower or
+bigger than --tolerance allows.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+import bench_pipeline  # noqa: E402
+from synthetic import ensure_export  # noqa: E402
+
+SUITES = [bench_pipeline.ParseSuite, bench_pipeline.AggregateSuite,
+          bench_pipeline.AnalyzeSuite, bench_pipeline.UploadSuite, bench_pipeline.DeltaSuite]
+
+# Benchmark method prefixes and the unit of their result
+KINDS = {'time_': 's', 'peakmem_': 'MB'}
+
+
+def benchmarks(suites, rows_filter, name_filter):
+    """(suite, method name, rows) for every benchmark selected"""
+    for suite in suites:
+        for rows in suite.params:
+            if rows_filter and rows not in rows_filter:
+                continue
+            for name in sorted(dir(suite)):
+                if name.startswith(tuple(KINDS)) and (not name_filter or name_filter in f'{suite.__name__}.{name}'):
+                    yield suite, name, rows
+
+
+def measure(suite, name, rows, repeat):
+    """Set up the suite, run one benchmark and return its value"""
+    instance = suite()
+    instance.setup(rows)
+    try:
+        method = getattr(instance, name)
+        if name.startswith('peakmem_'):
+            method(rows)
+            # ru_maxrss is in KB on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            method(rows)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+    finally:
+        if hasattr(instance, 'teardown'):
+            instance.teardown(rows)
+
+
+def _worker(connection, suite_name, name, rows, repeat):
+    suite = getattr(bench_pipeline, suite_name)
+    try:
+        connection.send(('ok', measure(suite, name, rows, repeat)))
+    except Exception as e:
+        connection.send(('error', f'{type(e).__name__}: {e}'))
+
+
+def run_isolated(context, suite, name, rows, repeat):
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_worker, args=(sender, suite.__name__, name, rows, repeat))
+    process.start()
+    # Close our copy of the sending end so recv() fails if the process dies
+    sender.close()
+    try:
+        status, value = receiver.recv()
+    except EOFError:
+        status, value = 'error', f'benchmark process exited with code {process.exitcode}'
+    process.join()
+    if status != 'ok':
+        raise RuntimeError(value)
+    return value
+
+
+def compare(results, baseline, tolerance):
+    """Names of benchmarks whose value grew by more than tolerance times the baseline"""
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if previous and result['value'] > previous['value'] * tolerance:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the analysis pipeline benchmarks.')
+    parser.add_argument('--rows', type=int, nargs='*', help='only these row counts')
+    parser.add_argument('--filter', default=None, help='only benchmarks whose Suite.method name contains this')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs per benchmark, the best is kept (default: 3)')
+    parser.add_argument('--save', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON file from an earlier --save to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='allowed ratio to the baseline before a result is a regression (default: 1.25)')
+    args = parser.parse_args()
+
+    selected = list(benchmarks(SUITES, args.rows, args.filter))
+    for rows in sorted({rows for _, _, rows in selected}):
+        ensure_export(rows)
+
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    failed = False
+    for suite, name, rows in selected:
+        key = f'{suite.__name__}.{name}({rows})'
+        unit = next(unit for prefix, unit in KINDS.items() if name.startswith(prefix))
+        try:
+            value = run_isolated(context, suite, name, rows, args.repeat)
+        except RuntimeError as e:
+            failed = True
+            print(f'{key:<55} failed: {e}')
+            continue
+        results[key] = {'value': value, 'unit': unit}
+        print(f'{key:<55} {value:>10.3f} {unit}')
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for key in regressions:
+            print(f'REGRESSION {key}: {baseline[key]["value"]:.3f} -> {results[key]["value"]:.3f} {results[key]["unit"]}')
+        failed = failed or bool(regressions)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Synthetic modem export generator for benchmarks.
+Produces CSV files shaped like the daily export (USP, DSP, dpath, AMP_NAME,
+DSS in column F, ON names in column N) with '-' and blank placeholders.
+
+    python benchmarks/synthetic.py export.csv --rows 1000000 [--seed 0]
+        [--skew 1.6] [--missing-rate 0.03] [--columns MAC,dpath,...]
+"""
+import argparse
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['MAC', 'dpath', 'USP', 'DSP', 'USNR', 'DSS', 'CMTS', 'IP',
+           'MODEL', 'FW', 'STATUS', 'AMP_NAME', 'ADDRESS', 'ON_NAME', 'UPTIME']
+
+# Positions the analysis reads DSS and ON names from, whatever their names
+DSS_POSITION = 5
+ON_NAME_POSITION = 13
+
+# Rows generated and written per step, so large files use bounded memory
+WRITE_CHUNK_ROWS = 500_000
+
+# Where ensure_export keeps generated files between runs
+CACHE_FOLDER = os.path.join(tempfile.gettempdir(), 'modem-analysis-bench')
+
+
+def _by_code(codes, labels):
+    # Format each distinct value once and spread it to the rows
+    uniques, inverse = np.unique(codes, return_inverse=True)
+    return np.array([labels(value) for value in uniques], dtype=object)[inverse]
+
+
+def generate_export(rows, seed=0, missing_rate=0.03, skew=1.6, columns=COLUMNS, start=0, plant_rows=None):
+    """
+    Return a DataFrame with `rows` synthetic modems.
+    skew is the Zipf exponent of modems per amplifier (lower = more skewed).
+    columns sets the layout: known names get synthetic data, unknown names
+    get '-'; DSS and ON names always go to columns F and N, as the
+    analysis reads them by position. start offsets the MAC addresses and
+    plant_rows sizes the node counts for the whole file, so chunks of one
+    file stay consistent.
+    """
+    if len(columns) <= ON_NAME_POSITION:
+        raise ValueError(f'A layout needs at least {ON_NAME_POSITION + 1} columns')
+    rng = np.random.default_rng(seed)
+    plant_rows = plant_rows or rows
+    on_count = max(5, plant_rows // 300)
+    amp_count = max(20, plant_rows // 40)
+
+    # A few amplifiers carry most of the modems, like the real plant
+    amp = (rng.zipf(skew, rows) - 1) % amp_count
+    on = amp % on_count
+
+    def reading(mean, spread):
+        values = np.round(rng.normal(mean, spread, rows), 1).astype(object)
+        draw = rng.random(rows)
+        values[draw < missing_rate * 2 / 3] = '-'
+        values[(draw >= missing_rate * 2 / 3) & (draw < missing_rate)] = ''
+        return values
+
+    # About a third of the modems sit behind a second amplifier in the cascade
+    cascade = rng.random(rows) < 0.3
+    dpath = _by_code(amp * 2 + cascade, lambda code: (
+        f'{(code // 2) % on_count % 7:03d}-002;ON-05-{(code // 2) % on_count:04d};AMP-05-{code // 2:05d}'
+        + (f';AMP-05-{code // 2 + 50000:05d}' if code % 2 else '')))
+
+    name_draw = rng.random(rows)
+    on_name = np.where(name_draw < 0.1, '-',
+                       np.where(name_draw < 0.3, _by_code(on, lambda node: f'Alias {node}'),
+                                _by_code(on, lambda node: f'ON-05-{node:04d} Cvor {node}')))
+
+    data = {
+        'MAC': np.char.add('00:1a:', np.char.zfill(np.char.mod('%x', np.arange(start, start + rows)), 8)),
+        'dpath': dpath,
+        'USP': reading(42, 5),
+        'DSP': reading(3, 5),
+        'USNR': np.round(rng.normal(36, 2, rows), 1),
+        'DSS': reading(39, 2.5),
+        'CMTS': 'CMTS-01',
+        'IP': '10.0.0.1',
+        'MODEL': 'CM-3.1',
+        'FW': '1.0',
+        'STATUS': 'online',
+        'AMP_NAME': _by_code(amp, lambda a: f'AMP {a} Glavna'),
+        'ADDRESS': '-',
+        'ON_NAME': on_name,
+        'UPTIME': rng.integers(0, 10 ** 6, rows),
+    }
+    positional = {DSS_POSITION: 'DSS', ON_NAME_POSITION: 'ON_NAME'}
+    return pd.DataFrame({
+        col: data[positional.get(position, col)] if positional.get(position, col) in data else '-'
+        for position, col in enumerate(columns)
+    }, columns=columns)
+
+
+def write_export(path, rows, seed=0, **options):
+    """Write a synthetic export of `rows` modems, WRITE_CHUNK_ROWS at a time"""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        for index, start in enumerate(range(0, rows, WRITE_CHUNK_ROWS)):
+            chunk = generate_export(min(WRITE_CHUNK_ROWS, rows - start), seed=seed + index,
+                                    start=start, plant_rows=rows, **options)
+            chunk.to_csv(f, index=False, header=index == 0)
+    return path
+
+
+def ensure_export(rows, seed=0):
+    """Path of a cached synthetic export with the default layout, generated on first use"""
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    path = os.path.join(CACHE_FOLDER, f'export-{rows}-{seed}.csv')
+    if not os.path.exists(path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        write_export(tmp_path, rows, seed=seed)
+        os.replace(tmp_path, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic modem export.')
+    parser.add_argument('path', help='output CSV file')
+    parser.add_argument('--rows', type=int, default=100_000, help='number of modems (default: 100000)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skew', type=float, default=1.6,
+                        help='Zipf exponent of modems per amplifier, lower is more skewed (default: 1.6)')
+    parser.add_argument('--missing-rate', type=float, default=0.03,
+                        help="share of readings written as '-' or blank (default: 0.03)")
+    parser.add_argument('--columns', default=','.join(COLUMNS),
+                        help='comma separated column layout (DSS is column F, ON names column N)')
+    args = parser.parse_args()
+
+    write_export(args.path, args.rows, seed=args.seed, skew=args.skew,
+                 missing_rate=args.missing_rate, columns=args.columns.split(','))
+    print(f'Wrote {args.rows:,} rows to {args.path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,632 @@
+import os
+import re
+import unicodedata
+from datetime import datetime
+
+import json_codec
+from file_lock import atomic_write, locked, lock_path_for
+from metrics import timed
+from modem_analysis import (AGGREGATES_VERSION, analyze_modem_data, analyze_modem_frame, load_modem_frame,
+                            read_modem_csv)
+from modem_state import ModemStateWriter, load_modem_state, remove_modem_state, state_path
+from anomalies import update_anomalies
+from offenders import save_offender_changes, save_offenders
+from rankings import RANKING_KINDS, SORT_KEYS, load_rankings, save_rankings
+from topology import save_topology
+from result_cache import cache_key
+from snapshots import load_snapshot
+from thresholds import get_profile, profile_for_city
+
+# List of cities to analyze
+CITIES = ['novi_sad', 'sombor', 'vrsac', 'zrenjanin', 'vrbas', 'kikinda']
+
+# Number of worst nodes per list kept for each city in the overview
+OVERVIEW_CITY_NODES = 3
+
+# Number of worst ON nodes across all cities in the overview
+OVERVIEW_REGION_NODES = 10
+
+# Result lists compared with the previous run:
+# (list, history node kind, node key, count and rank columns in the history)
+CHANGE_LISTS = [
+    ('top_10_amp', 'amp', 'amp_name', 'bad_count', 'bad_rank'),
+    ('top_10_on', 'on', 'on_node', 'bad_count', 'bad_rank'),
+    ('top_20_dss', 'on', 'on_node', 'dss_count', 'dss_rank')
+]
+
+
+def get_previous_identifiers(data_folder, city):
+    """Get identifiers from previous analysis to detect new entries"""
+    results = load_city_results(data_folder, city)
+    if not results:
+        return {'amp_names': set(), 'on_nodes': set(), 'dss_nodes': set()}
+    
+    identifiers = {
+        'amp_names': set(),
+        'on_nodes': set(),
+        'dss_nodes': set()
+    }
+    
+    # Extract AMP names from previous results
+    if 'top_10_amp' in results:
+        for item in results['top_10_amp']:
+            identifiers['amp_names'].add(item.get('amp_name', ''))
+    
+    # Extract ON nodes from previous results
+    if 'top_10_on' in results:
+        for item in results['top_10_on']:
+            identifiers['on_nodes'].add(item.get('on_node', ''))
+    
+    # Extract DSS nodes from previous results
+    if 'top_20_dss' in results:
+        for item in results['top_20_dss']:
+            identifiers['dss_nodes'].add(item.get('on_node', ''))
+    
+    return identifiers
+
+
+def calculate_summary_percentages(results):
+    """Calculate summary percentages only"""
+    total_modems = results['summary']['total_modems']
+    
+    if total_modems == 0:
+        return results
+    
+    # Summary percentages
+    results['summary']['usp_dsp_percentage'] = round(
+        (results['summary']['usp_dsp_count'] / total_modems) * 100, 2
+    )
+    results['summary']['usp_dsp_dss_percentage'] = round(
+        (results['summary']['usp_dsp_dss_count'] / total_modems) * 100, 2
+    )
+    results['summary']['healthy_count'] = total_modems - results['summary']['usp_dsp_dss_count']
+    results['summary']['healthy_percentage'] = round(
+        (results['summary']['healthy_count'] / total_modems) * 100, 2
+    )
+    
+    return results
+
+
+def mark_new_entries(results, previous_identifiers):
+    """Mark entries that are new compared to previous analysis"""
+    
+    # Mark new AMP entries
+    if 'top_10_amp' in results:
+        for item in results['top_10_amp']:
+            amp_name = item.get('amp_name', '')
+            item['is_new'] = amp_name not in previous_identifiers['amp_names']
+    
+    # Mark new ON node entries
+    if 'top_10_on' in results:
+        for item in results['top_10_on']:
+            on_node = item.get('on_node', '')
+            item['is_new'] = on_node not in previous_identifiers['on_nodes']
+    
+    # Mark new DSS node entries
+    if 'top_20_dss' in results:
+        for item in results['top_20_dss']:
+            on_node = item.get('on_node', '')
+            item['is_new'] = on_node not in previous_identifiers['dss_nodes']
+    
+    # Count new entries for summary
+    new_counts = {
+        'new_amp_count': sum(1 for item in results.get('top_10_amp', []) if item.get('is_new', False)),
+        'new_on_count': sum(1 for item in results.get('top_10_on', []) if item.get('is_new', False)),
+        'new_dss_count': sum(1 for item in results.get('top_20_dss', []) if item.get('is_new', False))
+    }
+    
+    results['new_entries_summary'] = new_counts
+    
+    return results
+
+
+def mark_changes(results, history, city, run_id):
+    """
+    Compare the top lists with the previous run of the whole population.
+    Adds previous_rank, rank_change (positive = moved up the list),
+    previous_bad_count and bad_count_delta to every entry, and marks an
+    entry as new only if the node had no bad modems in the previous run.
+    """
+    previous_run_id = history.previous_run_id(city, run_id)
+    new_counts = {}
+    
+    for list_name, kind, key, count_col, rank_col in CHANGE_LISTS:
+        items = results.get(list_name, [])
+        _mark_items(items, history, kind, key, count_col, rank_col, run_id, previous_run_id)
+        
+        prefix = list_name.split('_')[-1]
+        new_counts[f'new_{prefix}_count'] = sum(1 for item in items if item['is_new'])
+        if previous_run_id is not None:
+            new_counts[f'new_{prefix}_offenders'] = history.count_new_offenders(kind, count_col, run_id, previous_run_id)
+    
+    results['new_entries_summary'] = new_counts
+    
+    return results
+
+
+def _mark_items(items, history, kind, key, count_col, rank_col, run_id, previous_run_id):
+    """Add the previous run's rank and count to list entries (see mark_changes)"""
+    previous = {}
+    if previous_run_id is not None:
+        previous = history.compare_runs(kind, run_id, previous_run_id, [item[key] for item in items])
+    
+    for item in items:
+        if previous_run_id is None:
+            item['previous_rank'] = None
+            item['rank_change'] = None
+            item['previous_bad_count'] = None
+            item['bad_count_delta'] = None
+            item['is_new'] = True
+            continue
+        
+        row = previous.get(str(item[key]))
+        previous_count = row[count_col] if row else 0
+        previous_rank = row[rank_col] if row and rank_col else None
+        item['previous_rank'] = previous_rank
+        item['rank_change'] = previous_rank - item['rank'] if previous_rank else None
+        item['previous_bad_count'] = previous_count
+        item['bad_count_delta'] = item['bad_count'] - previous_count
+        item['is_new'] = previous_count == 0
+
+
+def mark_ranking_changes(items, history, city, run_id, kind, sort):
+    """
+    Compare a page of a ranking (see rankings.Rankings.page) with the run
+    before run_id, like mark_changes does for the top lists. Entries
+    sorted by percentage get no previous_rank, as the history keeps only
+    the count rankings.
+    """
+    count_col, rank_col = SORT_KEYS[sort]
+    previous_run_id = history.previous_run_id(city, run_id)
+    _mark_items(items, history, kind, RANKING_KINDS[kind][0], count_col, rank_col, run_id, previous_run_id)
+    return items
+
+
+def _write_json(path, data):
+    """
+    Write compact JSON (see json_codec) to a temporary file and rename it,
+    so readers never see a partial file
+    """
+    atomic_write(path, lambda f: f.write(json_codec.dumps(data)))
+
+
+def save_city_results(data_folder, city, results):
+    """
+    Save analysis results for a city to JSON file and update the overview.
+    Callers that compare with the previous results first should hold
+    city_lock for the whole read-compare-save sequence.
+    """
+    filepath = city_results_path(data_folder, city)
+    results.setdefault('timestamp', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    results['city'] = city
+    _write_json(filepath, results)
+    update_overview(data_folder, city, results)
+
+
+def city_results_path(data_folder, city):
+    return os.path.join(data_folder, f'{city}_latest.json')
+
+
+def city_lock(data_folder, city):
+    """
+    Exclusive lock on a city's saved results, across processes. Held while
+    a run is compared with the previous one and saved, so two uploads for
+    the same city are recorded one after the other.
+    """
+    return locked(lock_path_for(city_results_path(data_folder, city)))
+
+
+def load_city_snapshot(data_folder, city):
+    """Latest results file for a city as a cached JsonSnapshot, or None"""
+    return load_snapshot(city_results_path(data_folder, city))
+
+
+def load_city_results(data_folder, city):
+    """
+    Load latest analysis results for a city from JSON file.
+    The file is parsed once per process until it changes, so the
+    returned dictionary is shared and must not be modified.
+    """
+    snapshot = load_city_snapshot(data_folder, city)
+    return snapshot.data if snapshot else None
+
+
+def overview_path(data_folder):
+    return os.path.join(data_folder, 'overview.json')
+
+
+def _node_summary(item, key, name):
+    if 'bad_count' not in item:
+        # Results saved before per-node totals existed: total_count was the bad count
+        return {key: item.get(key), name: item.get(name), 'bad_count': item.get('total_count', 0),
+                'total_count': None, 'percentage': None}
+    return {
+        key: item.get(key),
+        name: item.get(name),
+        'bad_count': item['bad_count'],
+        'total_count': item.get('total_count'),
+        'percentage': item.get('percentage')
+    }
+
+
+def overview_entry(results):
+    """Summary KPIs and the worst few nodes of one city's results"""
+    return {
+        'timestamp': results.get('timestamp'),
+        'summary': results['summary'],
+        'worst_amp': [_node_summary(item, 'amp_name', 'amp_code')
+                      for item in results.get('top_10_amp', [])[:OVERVIEW_CITY_NODES]],
+        'worst_on': [_node_summary(item, 'on_node', 'on_name')
+                     for item in results.get('top_10_on', [])[:OVERVIEW_CITY_NODES]],
+        'worst_dss': [_node_summary(item, 'on_node', 'on_name')
+                      for item in results.get('top_20_dss', [])[:OVERVIEW_CITY_NODES]]
+    }
+
+
+def build_overview(entries):
+    """
+    Region-wide rollup from per-city overview entries: totals over all
+    cities, each city's entry and the worst ON nodes across the region.
+    """
+    region = {'total_modems': 0, 'usp_dsp_count': 0, 'usp_dsp_dss_count': 0, 'dss_only_count': 0}
+    worst_nodes = []
+    for city, entry in entries.items():
+        if entry is None:
+            continue
+        for field in region:
+            region[field] += entry['summary'].get(field, 0)
+        worst_nodes.extend(dict(node, city=city) for node in entry['worst_on'])
+    
+    region['healthy_count'] = region['total_modems'] - region['usp_dsp_dss_count']
+    region['cities_reporting'] = sum(1 for entry in entries.values() if entry is not None)
+    calculate_summary_percentages({'summary': region})
+    worst_nodes.sort(key=lambda node: node['bad_count'], reverse=True)
+    
+    return {
+        'success': True,
+        'updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'region': region,
+        'cities': {city: entries.get(city) for city in CITIES},
+        'worst_nodes': worst_nodes[:OVERVIEW_REGION_NODES]
+    }
+
+
+def _overview_entries_from_files(data_folder):
+    entries = {}
+    for city in CITIES:
+        results = load_city_results(data_folder, city)
+        entries[city] = overview_entry(results) if results else None
+    return entries
+
+
+def update_overview(data_folder, city, results):
+    """
+    Replace one city's entry in the overview rollup and rewrite it.
+    Only the changed city is recomputed; the others come from the
+    previous rollup (or the city files if there is none yet).
+    """
+    path = overview_path(data_folder)
+    with locked(lock_path_for(path)):
+        snapshot = load_snapshot(path)
+        if snapshot is not None:
+            entries = dict(snapshot.data['cities'])
+        else:
+            entries = _overview_entries_from_files(data_folder)
+        entries[city] = overview_entry(results)
+        _write_json(path, build_overview(entries))
+
+
+def load_overview_snapshot(data_folder):
+    """Overview rollup as a cached JsonSnapshot, built from the city files if missing"""
+    path = overview_path(data_folder)
+    snapshot = load_snapshot(path)
+    if snapshot is None:
+        with locked(lock_path_for(path)):
+            if load_snapshot(path) is None:
+                _write_json(path, build_overview(_overview_entries_from_files(data_folder)))
+        snapshot = load_snapshot(path)
+    return snapshot
+
+
+def city_from_filename(filename):
+    """
+    Match an export file name to a city, e.g. 'Novi Sad.csv' or
+    'vrsac_2024-10-01.csv'. Returns None if no city matches.
+    """
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    stem = unicodedata.normalize('NFKD', stem).encode('ascii', 'ignore').decode('ascii')
+    stem = re.sub(r'[\s\-]+', '_', stem.strip().lower())
+    matches = [city for city in CITIES if stem == city or stem.startswith(f'{city}_')]
+    return max(matches, key=len) if matches else None
+
+
+def _cached_frame(frame_cache, digest):
+    """An upload's parsed frame from frame_cache, or None"""
+    frame = frame_cache.get(digest)
+    # Frames cached before dpath was kept lack the topology, parse again
+    return frame if frame is not None and 'dpath' in frame.columns else None
+
+
+def score_upload(csv_file, profile, digest=None, engine='auto', chunksize=None,
+                 progress=None, cache=None, frame_cache=None, offender_cache=None,
+                 include_offenders=False, modem_writer=None, timings=None):
+    """
+    Analysis results (with aggregates) for an upload scored with a
+    threshold profile. Results are cached per (content digest, profile)
+    in cache; the parsed frame is cached per digest in frame_cache, so
+    scoring the same upload with another profile skips the CSV parsing.
+    With include_offenders the offender table is added under 'offenders'
+    and cached in offender_cache under the same key as the results.
+    With modem_writer (a modem_state.ModemStateWriter) the parsed rows are
+    written to it and the running totals are added under 'totals'; cached
+    results have no totals, so only a cached frame is used then.
+    csv_file may be None when only a cached frame should be used.
+    timings, if given (a metrics.Timings), gets the stage durations and
+    the outcome of each cache lookup.
+    """
+    key = cache_key(digest, get_profile(profile)) if digest else None
+    
+    # Reuse the analysis if the same file was scored with this profile before
+    if cache is not None and key is not None and modem_writer is None:
+        with timed(timings, 'cache_lookup'):
+            results = cache.get(key)
+        # Results cached with older aggregates are redone
+        hit = results is not None and results.get('aggregates', {}).get('version') == AGGREGATES_VERSION
+        if timings is not None:
+            timings.cache_lookup('results', hit)
+        if hit and include_offenders:
+            offenders = offender_cache.get(key) if offender_cache is not None else None
+            if timings is not None and offender_cache is not None:
+                timings.cache_lookup('offenders', offenders is not None)
+            hit = offenders is not None
+            results['offenders'] = offenders
+        if hit:
+            return results
+    
+    frame = None
+    if frame_cache is not None and digest:
+        with timed(timings, 'cache_lookup'):
+            frame = _cached_frame(frame_cache, digest)
+        if timings is not None:
+            timings.cache_lookup('frames', frame is not None)
+    if frame is not None:
+        results = analyze_modem_frame(frame, include_aggregates=True, profile=profile,
+                                      include_offenders=include_offenders, modem_writer=modem_writer,
+                                      timings=timings)
+    elif csv_file is None:
+        return {'success': False, 'error': 'The uploaded file is no longer cached, please upload it again'}
+    elif chunksize:
+        # Streamed files are too large to keep a parsed copy of
+        results = analyze_modem_data(csv_file, engine=engine, chunksize=chunksize, progress=progress,
+                                     include_aggregates=True, profile=profile,
+                                     include_offenders=include_offenders, modem_writer=modem_writer,
+                                     timings=timings)
+    else:
+        try:
+            frame = load_modem_frame(csv_file, engine=engine, progress=progress, timings=timings)
+        except Exception as e:
+            import traceback
+            return {
+                'success': False,
+                'error': f'{str(e)}\n{traceback.format_exc()}'
+            }
+        if frame_cache is not None and digest:
+            with timed(timings, 'cache_store'):
+                frame_cache.put(digest, frame)
+        results = analyze_modem_frame(frame, include_aggregates=True, profile=profile,
+                                      include_offenders=include_offenders, modem_writer=modem_writer,
+                                      timings=timings)
+    
+    if results['success'] and cache is not None and key is not None:
+        with timed(timings, 'cache_store'):
+            offenders = results.pop('offenders', None)
+            totals = results.pop('totals', None)
+            cache.put(key, results)
+            if offenders is not None:
+                if offender_cache is not None:
+                    offender_cache.put(key, offenders)
+                results['offenders'] = offenders
+            if totals is not None:
+                results['totals'] = totals
+    return results
+
+
+def _record_run(data_folder, city, results, aggregates, history=None, timings=None):
+    """
+    Save a run's plant topology counts, compare it with the previous run
+    (see analyze_city) and with the node baselines (see anomalies.py),
+    then save its node rankings and the results. An upload
+    with the same source_digest and profile as the latest results is the
+    same run again: it keeps that run's history record, timestamp and
+    anomalies and leaves the baselines alone. Call with city_lock held.
+    """
+    latest = load_city_results(data_folder, city)
+    repeated = (latest is not None and results.get('source_digest') is not None
+                and latest.get('source_digest') == results['source_digest']
+                and latest.get('profile') == results.get('profile'))
+    
+    with timed(timings, 'save_topology'):
+        save_topology(data_folder, city, aggregates.get('paths', []))
+    
+    run_id = None
+    if repeated:
+        ranked = load_rankings(data_folder, city)
+        run_id = ranked.run_id if ranked is not None else None
+    with timed(timings, 'history'):
+        if history is not None and run_id is not None:
+            # Compare with the run before the recorded one, as that run did
+            results['timestamp'] = latest['timestamp']
+            results = mark_changes(results, history, city, run_id)
+        elif history is not None:
+            # Record the run, then diff the whole population against the previous run
+            results['timestamp'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            run_id = history.record_run(city, results['timestamp'], results['summary'], aggregates)
+            results = mark_changes(results, history, city, run_id)
+        else:
+            # Without history only the previous top lists are known
+            results = mark_new_entries(results, get_previous_identifiers(data_folder, city))
+    
+    with timed(timings, 'anomalies'):
+        if repeated:
+            results['anomalies'] = latest.get('anomalies', [])
+        else:
+            results['anomalies'] = update_anomalies(data_folder, city, aggregates)
+    
+    with timed(timings, 'save_rankings'):
+        save_rankings(data_folder, city, aggregates, run_id)
+    
+    # Save results for this city
+    with timed(timings, 'save_results'):
+        save_city_results(data_folder, city, results)
+    return results
+
+
+def _state_is_current(data_folder, city, digest, profile):
+    # The saved modem state was built from this upload with this profile
+    latest = load_city_results(data_folder, city)
+    return (latest is not None and digest is not None and latest.get('source_digest') == digest
+            and latest.get('profile') == profile and os.path.exists(state_path(data_folder, city)))
+
+
+def analyze_city(data_folder, city, csv_file, engine='auto', chunksize=None, progress=None,
+                 profile=None, digest=None, cache=None, frame_cache=None, offender_cache=None,
+                 history=None, timings=None):
+    """
+    Full pipeline for one city: analyze the export, add summary
+    percentages, mark entries that are new since the previous run and
+    save the results and the offender table (see offenders.py).
+    When the export has a modem identifier column the per-modem state for
+    delta exports is saved too (see ingest_city_delta), written as the
+    export is read.
+    profile defaults to the city's threshold profile.
+    With digest (the upload's content hash) the caches are used, see
+    score_upload. With history (a HistoryStore) the run is recorded and
+    compared with the previous run of every node; without it only the
+    previous top lists are compared. timings, if given (a metrics.Timings),
+    gets the duration of each stage.
+    Returns the results dictionary.
+    """
+    profile = profile or profile_for_city(city)
+    writer = None if _state_is_current(data_folder, city, digest, profile) else ModemStateWriter(data_folder, city)
+    try:
+        results = score_upload(csv_file, profile, digest=digest, engine=engine, chunksize=chunksize,
+                               progress=progress, cache=cache, frame_cache=frame_cache,
+                               offender_cache=offender_cache, include_offenders=True,
+                               modem_writer=writer, timings=timings)
+        
+        if results['success']:
+            # Full-population counts go to the history store, not the latest file
+            aggregates = results.pop('aggregates')
+            offenders = results.pop('offenders')
+            totals = results.pop('totals', None)
+            results['source_digest'] = digest
+            
+            # Calculate summary percentages
+            results = calculate_summary_percentages(results)
+            
+            # Another upload for the city waits here, so it compares with this run
+            with city_lock(data_folder, city):
+                with timed(timings, 'save_offenders'):
+                    save_offenders(data_folder, city, offenders)
+                if writer is not None:
+                    with timed(timings, 'save_state'):
+                        if writer.has_ids:
+                            writer.save(totals, digest)
+                        else:
+                            remove_modem_state(data_folder, city)
+                results = _record_run(data_folder, city, results, aggregates, history, timings)
+    finally:
+        if writer is not None:
+            writer.discard()
+    
+    return results
+
+
+def ingest_city_delta(data_folder, city, csv_file, engine='auto', history=None, timings=None):
+    """
+    Update a city from a delta export that lists only the modems whose
+    readings changed, keyed by modem identifier (see ModemState.apply_delta).
+    Only the listed modems are read from the saved per-modem state; their
+    rows are logged and the node totals updated, the offender table gets
+    the change appended (see offenders.save_offender_changes) and the top
+    lists are rebuilt from the totals. The run is recorded and saved like
+    analyze_city. Needs a state saved by a full export with an identifier
+    column.
+    Returns the results dictionary, with 'delta' counting the modems
+    updated, added and removed.
+    """
+    try:
+        with timed(timings, 'read_csv'):
+            df = read_modem_csv(csv_file, engine=engine)
+        
+        with city_lock(data_folder, city):
+            with timed(timings, 'load_state'):
+                state = load_modem_state(data_folder, city)
+            if state is None:
+                return {
+                    'success': False,
+                    'error': 'No modem state for this city, upload a full export with a MAC column first'
+                }
+            
+            with timed(timings, 'aggregate'):
+                delta = state.apply_delta(df)
+            with timed(timings, 'top_lists'):
+                results = state.results()
+            # The offender table first: a delta applied again after a failed
+            # save replaces the same rows, so the two cannot drift apart
+            with timed(timings, 'save_offenders'):
+                save_offender_changes(data_folder, city, *state.offender_changes)
+            with timed(timings, 'save_state'):
+                state.save()
+            
+            aggregates = results.pop('aggregates')
+            results['delta'] = {'rows': len(df), **delta}
+            # No upload holds these readings, so there is nothing to re-score
+            results['source_digest'] = None
+            results = calculate_summary_percentages(results)
+            return _record_run(data_folder, city, results, aggregates, history, timings)
+        
+    except Exception as e:
+        import traceback
+        return {
+            'success': False,
+            'error': f'{str(e)}\n{traceback.format_exc()}'
+        }
+
+
+def rescore_city(data_folder, city, profile, cache=None, frame_cache=None, spool=None, engine='auto',
+                 streaming_threshold=None, chunksize=None):
+    """
+    What-if analysis: score the city's latest upload with another
+    threshold profile, without saving anything. The upload comes from the
+    cached frame or, failing that, from spool (an UploadSpool) while the
+    file is still there; files over streaming_threshold bytes are read in
+    chunks of chunksize rows, as when they were uploaded.
+    Returns the results dictionary, or None if the city has no results.
+    """
+    latest = load_city_results(data_folder, city)
+    if latest is None:
+        return None
+    
+    digest = latest.get('source_digest')
+    if digest is None:
+        # Delta runs (and runs saved before digests were kept) have no upload behind them
+        return {'success': False, 'error': 'No source upload exists for the latest results, '
+                                           'upload a full export to re-score them'}
+    
+    csv_file = None
+    if spool is not None and os.path.exists(spool.path(digest)):
+        csv_file = spool.path(digest)
+        spool.touch(csv_file)
+        if streaming_threshold is None or os.path.getsize(csv_file) <= streaming_threshold:
+            chunksize = None
+    
+    results = score_upload(csv_file, profile, digest=digest, engine=engine, chunksize=chunksize,
+                           cache=cache, frame_cache=frame_cache)
+    if results['success']:
+        results.pop('aggregates')
+        results = calculate_summary_percentages(results)
+        results['what_if'] = True
+        results['city'] = city
+        results['timestamp'] = latest.get('timestamp')
+    return results
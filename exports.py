@@ -0,0 +1,147 @@
+import csv
+import io
+import tempfile
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # Optional, CSV export is always available
+    Workbook = None
+
+from modem_analysis import OFFENDER_COLUMNS
+
+# Export formats offered, with their MIME types
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+
+# Top lists of the results, by export section: (results key, sheet title, columns).
+# Columns are (result field, header) pairs; headers follow the old daily script
+TOP_LIST_SECTIONS = {
+    'amp': ('top_10_amp', 'Top 10 AMP', [
+        ('rank', 'Rank'),
+        ('amp_name', 'AMP_NAME'),
+        ('amp_code', 'AMP_CODE'),
+        ('bad_count', 'Total_Count'),
+        ('total_count', 'Modem_Count'),
+        ('percentage', 'Percentage'),
+        ('usp_count', 'USP_Count'),
+        ('dsp_count', 'DSP_Count')
+    ]),
+    'on': ('top_10_on', 'Top 10 ON', [
+        ('rank', 'Rank'),
+        ('on_node', 'ON_NODE'),
+        ('on_name', 'ON_NAME'),
+        ('bad_count', 'Total_Count'),
+        ('total_count', 'Modem_Count'),
+        ('percentage', 'Percentage'),
+        ('usp_count', 'USP_Count'),
+        ('dsp_count', 'DSP_Count')
+    ]),
+    'dss': ('top_20_dss', 'Top 20 DSS', [
+        ('rank', 'Rank'),
+        ('on_node', 'ON_NODE'),
+        ('on_name', 'ON_NAME'),
+        ('bad_count', 'DSS_Count'),
+        ('total_count', 'Modem_Count'),
+        ('percentage', 'Percentage')
+    ])
+}
+
+# Section with every flagged modem, read from the saved offender table
+BAD_MODEMS_SECTION = 'bad_modems'
+
+# Workbook with every section, like the one the old daily script wrote
+REPORT_SECTION = 'report'
+
+EXPORT_SECTIONS = (*TOP_LIST_SECTIONS, BAD_MODEMS_SECTION, REPORT_SECTION)
+
+# Offender rows converted and written per step
+EXPORT_CHUNK_ROWS = 20_000
+
+# Bytes per block when sending a finished workbook
+WORKBOOK_BLOCK_SIZE = 64 * 1024
+
+# Summary lines written under the AMP table of the report
+SUMMARY_LINES = [
+    ('total_modems', 'Ukupan broj modema:'),
+    ('usp_dsp_count', 'Total Count USP+DSP:'),
+    ('usp_dsp_dss_count', 'Total Count USP+DSP+DSS:')
+]
+
+
+def available_formats():
+    return [fmt for fmt in EXPORT_FORMATS if fmt != 'xlsx' or Workbook is not None]
+
+
+def top_list_sheet(results, section):
+    """(title, headers, row chunks) for one top list of the results"""
+    key, title, columns = TOP_LIST_SECTIONS[section]
+    rows = [tuple(item.get(field) for field, _ in columns) for item in results.get(key, [])]
+    return title, [header for _, header in columns], [rows]
+
+
+def offender_sheet(offenders):
+    """(title, headers, row chunks) for a saved offender table, read chunk by chunk"""
+    chunks = (frame.itertuples(index=False, name=None)
+              for frame in offenders.iter_frames(EXPORT_CHUNK_ROWS))
+    return 'Bad modems', list(OFFENDER_COLUMNS), chunks
+
+
+def summary_rows(results):
+    summary = results.get('summary', {})
+    return [(label, summary.get(field)) for field, label in SUMMARY_LINES]
+
+
+def iter_csv(headers, row_chunks):
+    """
+    Generate a CSV file chunk by chunk as UTF-8 bytes. Starts with a byte
+    order mark so Excel shows the Serbian node names correctly.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(headers)
+    for rows in row_chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def write_workbook(sheets, footer=None):
+    """
+    Write sheets of (title, headers, row chunks) with a write-only openpyxl
+    workbook, which streams rows to disk instead of keeping cells in memory.
+    footer rows are appended to the first sheet after a blank line.
+    Returns the finished file, rewound.
+    """
+    if Workbook is None:
+        raise RuntimeError('Excel export needs the openpyxl package')
+    workbook = Workbook(write_only=True)
+    for index, (title, headers, row_chunks) in enumerate(sheets):
+        sheet = workbook.create_sheet(title)
+        sheet.append(headers)
+        for rows in row_chunks:
+            for row in rows:
+                sheet.append(row)
+        if index == 0 and footer:
+            sheet.append([])
+            for row in footer:
+                sheet.append(row)
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+
+def iter_file(output):
+    """Send a file in blocks and close it once it has been sent"""
+    try:
+        for block in iter(lambda: output.read(WORKBOOK_BLOCK_SIZE), b''):
+            yield block
+    finally:
+        output.close()
@@ -0,0 +1,61 @@
+import os
+import tempfile
+from contextlib import contextmanager, nullcontext
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, fall back to no locking
+    fcntl = None
+
+
+@contextmanager
+def locked(lock_path):
+    """
+    Hold an exclusive advisory lock on lock_path for the duration of the block.
+    Works across processes (gunicorn workers, pool processes, the batch CLI).
+    """
+    with open(lock_path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def lock_path_for(path):
+    """Lock file used to guard path (kept next to it, hidden)"""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'.{name}.lock')
+
+
+@contextmanager
+def temporary_path(directory, name=''):
+    """
+    Path of a new empty file in directory (hidden, named after name), for
+    writing a file before renaming it into place. The file is removed when
+    the block ends unless it has been renamed.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{name}_', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp_path
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def atomic_write(path, write, mode='wb', encoding=None, lock=False):
+    """
+    Replace path with what write(f) writes to a temporary file next to it,
+    so readers never see a partial file. With lock the whole write holds
+    the lock of path (see lock_path_for).
+    """
+    directory, name = os.path.split(path)
+    with locked(lock_path_for(path)) if lock else nullcontext():
+        with temporary_path(directory, name) as tmp_path:
+            with open(tmp_path, mode, encoding=encoding) as f:
+                write(f)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
@@ -0,0 +1,195 @@
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta
+
+# Same format as the 'timestamp' field of saved results; sorts chronologically
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+COUNT_COLUMNS = ['total_count', 'bad_count', 'usp_count', 'dsp_count', 'dss_count']
+RANK_COLUMNS = ['bad_rank', 'dss_rank']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    city TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    total_modems INTEGER NOT NULL,
+    usp_dsp_count INTEGER NOT NULL,
+    usp_dsp_dss_count INTEGER NOT NULL,
+    dss_only_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_runs_city_time ON runs (city, timestamp);
+
+CREATE TABLE IF NOT EXISTS amp_history (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    city TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    amp_name TEXT NOT NULL,
+    amp_code TEXT,
+    total_count INTEGER NOT NULL,
+    bad_count INTEGER NOT NULL,
+    usp_count INTEGER NOT NULL,
+    dsp_count INTEGER NOT NULL,
+    dss_count INTEGER NOT NULL,
+    bad_rank INTEGER,
+    dss_rank INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_amp_history_node ON amp_history (city, amp_name, timestamp);
+CREATE INDEX IF NOT EXISTS idx_amp_history_run ON amp_history (run_id, amp_name);
+
+CREATE TABLE IF NOT EXISTS on_history (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    city TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    on_node TEXT NOT NULL,
+    on_name TEXT,
+    total_count INTEGER NOT NULL,
+    bad_count INTEGER NOT NULL,
+    usp_count INTEGER NOT NULL,
+    dsp_count INTEGER NOT NULL,
+    dss_count INTEGER NOT NULL,
+    bad_rank INTEGER,
+    dss_rank INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_on_history_node ON on_history (city, on_node, timestamp);
+CREATE INDEX IF NOT EXISTS idx_on_history_run ON on_history (run_id, on_node);
+'''
+
+# Node tables and their key/name columns
+NODE_TABLES = {
+    'amp': ('amp_history', 'amp_name', 'amp_code'),
+    'on': ('on_history', 'on_node', 'on_name')
+}
+
+
+def since_timestamp(days):
+    """Timestamp string for `days` days ago"""
+    return (datetime.now() - timedelta(days=days)).strftime(TIMESTAMP_FORMAT)
+
+
+def _percentage(part, total):
+    return round((part / total * 100), 2) if total > 0 else 0
+
+
+class HistoryStore:
+    """
+    Append-only SQLite history of every analysis run: the summary and the
+    per-AMP and per-ON counts for the whole population of each city.
+    Indexed on (city, node, timestamp), so a node's trend is a single
+    index range scan. A connection is opened per call, which keeps the
+    store safe to use from gunicorn workers and pool processes.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._migrate(conn)
+            conn.executescript(SCHEMA)
+
+    @staticmethod
+    def _migrate(conn):
+        # Databases created before ranks were stored lack the rank columns,
+        # and their run indexes cover run_id only
+        for table, key_col, _ in NODE_TABLES.values():
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+            if columns and 'bad_rank' not in columns:
+                for col in RANK_COLUMNS:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN {col} INTEGER')
+                conn.execute(f'DROP INDEX IF EXISTS idx_{table}_run')
+        conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def record_run(self, city, timestamp, summary, aggregates):
+        """Append one analysis run; returns the run ID"""
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                'INSERT INTO runs (city, timestamp, total_modems, usp_dsp_count, usp_dsp_dss_count, dss_only_count) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (city, timestamp, summary['total_modems'], summary['usp_dsp_count'],
+                 summary['usp_dsp_dss_count'], summary['dss_only_count']))
+            run_id = cursor.lastrowid
+
+            for kind, (table, key_col, name_col) in NODE_TABLES.items():
+                columns = ['run_id', 'city', 'timestamp', key_col, name_col] + COUNT_COLUMNS + RANK_COLUMNS
+                rows = [
+                    (run_id, city, timestamp, str(row[key_col]), row[name_col])
+                    + tuple(int(row[col]) for col in COUNT_COLUMNS)
+                    + tuple(row.get(col) for col in RANK_COLUMNS)
+                    for row in aggregates.get(kind, [])
+                ]
+                conn.executemany(
+                    f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                    rows)
+        return run_id
+
+    def previous_run_id(self, city, run_id):
+        """ID of the run recorded for the city just before run_id, or None"""
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT id FROM runs WHERE city = ? AND id < ? ORDER BY id DESC LIMIT 1',
+                               (city, run_id)).fetchone()
+        return row['id'] if row else None
+
+    def compare_runs(self, kind, run_id, previous_run_id, nodes):
+        """
+        Join the given nodes of run_id with the same nodes in previous_run_id.
+        Returns {node: previous row or None} with bad/DSS counts and ranks.
+        """
+        table, key_col, _ = NODE_TABLES[kind]
+        nodes = [str(node) for node in nodes]
+        if not nodes:
+            return {}
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f'SELECT cur.{key_col} AS node, prev.bad_count, prev.dss_count, prev.bad_rank, prev.dss_rank '
+                f'FROM {table} cur LEFT JOIN {table} prev '
+                f'ON prev.run_id = ? AND prev.{key_col} = cur.{key_col} '
+                f'WHERE cur.run_id = ? AND cur.{key_col} IN ({", ".join("?" * len(nodes))})',
+                [previous_run_id, run_id] + nodes).fetchall()
+        return {row['node']: (dict(row) if row['bad_count'] is not None else None) for row in rows}
+
+    def count_new_offenders(self, kind, count_col, run_id, previous_run_id):
+        """Nodes flagged in run_id (count_col > 0) that had no flagged modems in previous_run_id"""
+        table, key_col, _ = NODE_TABLES[kind]
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                f'SELECT COUNT(*) AS new_count FROM {table} cur LEFT JOIN {table} prev '
+                f'ON prev.run_id = ? AND prev.{key_col} = cur.{key_col} '
+                f'WHERE cur.run_id = ? AND cur.{count_col} > 0 AND COALESCE(prev.{count_col}, 0) = 0',
+                (previous_run_id, run_id)).fetchone()
+        return row['new_count']
+
+    def city_trend(self, city, since):
+        """Summary of every run for a city since the given timestamp"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                'SELECT timestamp, total_modems, usp_dsp_count, usp_dsp_dss_count, dss_only_count '
+                'FROM runs WHERE city = ? AND timestamp >= ? ORDER BY timestamp',
+                (city, since)).fetchall()
+        trend = []
+        for row in rows:
+            point = dict(row)
+            point['usp_dsp_dss_percentage'] = _percentage(row['usp_dsp_dss_count'], row['total_modems'])
+            trend.append(point)
+        return trend
+
+    def node_trend(self, city, kind, node, since):
+        """Counts for one AMP (kind 'amp', by name) or ON node (kind 'on') since the given timestamp"""
+        table, key_col, name_col = NODE_TABLES[kind]
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f'SELECT timestamp, {name_col}, {", ".join(COUNT_COLUMNS)} FROM {table} '
+                f'WHERE city = ? AND {key_col} = ? AND timestamp >= ? ORDER BY timestamp',
+                (city, node, since)).fetchall()
+        trend = []
+        for row in rows:
+            point = dict(row)
+            point['percentage'] = _percentage(row['bad_count'], row['total_count'])
+            trend.append(point)
+        return trend
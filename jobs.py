@@ -0,0 +1,75 @@
+import os
+import re
+import time
+import uuid
+
+import json_codec
+from file_lock import atomic_write
+
+# Job states reported by the status endpoint, in order
+JOB_STATES = ('queued', 'parsing', 'aggregating', 'done', 'failed')
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def is_valid_job_id(job_id):
+    return bool(JOB_ID_PATTERN.match(job_id or ''))
+
+
+class JobStore:
+    """
+    Status of background upload jobs, one JSON file per job.
+    Files are replaced atomically, so any gunicorn worker (or the pool
+    process running the job) can read and update them.
+    """
+
+    def __init__(self, directory, max_age=24 * 60 * 60):
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f'{job_id}.json')
+
+    def _write(self, job_id, job):
+        atomic_write(self._path(job_id), lambda f: f.write(json_codec.dumps(job)))
+
+    def create(self, job_id, city):
+        """Register a new queued job"""
+        self.cleanup()
+        now = time.time()
+        job = {'job_id': job_id, 'city': city, 'status': 'queued', 'rows': 0,
+               'created': now, 'updated': now}
+        self._write(job_id, job)
+        return job
+
+    def get(self, job_id):
+        """Return the job status dictionary, or None if unknown"""
+        try:
+            with open(self._path(job_id), 'rb') as f:
+                return json_codec.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def update(self, job_id, **fields):
+        """Merge fields into the job status"""
+        job = self.get(job_id) or {'job_id': job_id}
+        job.update(fields)
+        job['updated'] = time.time()
+        self._write(job_id, job)
+        return job
+
+    def cleanup(self):
+        """Remove status files of jobs older than max_age"""
+        cutoff = time.time() - self.max_age
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,27 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # Optional, the standard library encoder is used instead
+    orjson = None
+
+# Name of the encoder in use, for diagnostics
+ENCODER = 'orjson' if orjson is not None else 'json'
+
+if orjson is not None:
+    # NumPy scalars and arrays may be left in results; keys are not always strings
+    _ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def dumps(data):
+    """Compact UTF-8 JSON bytes (no indentation or spaces after separators)"""
+    if orjson is not None:
+        return orjson.dumps(data, option=_ORJSON_OPTIONS)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def loads(body):
+    """Parse JSON from bytes or str"""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
@@ -0,0 +1,236 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from file_lock import atomic_write, locked, lock_path_for
+
+# Metric name -> (type, help text)
+METRICS = {
+    'modem_stage_duration_seconds': ('histogram', 'Time spent in each analysis and upload stage'),
+    'modem_analysis_duration_seconds': ('histogram', 'Total time to analyze one upload, per city'),
+    'modem_modems_analyzed_total': ('counter', 'Modems with valid readings analyzed, per city'),
+    'modem_jobs_total': ('counter', 'Finished upload jobs, per city and status'),
+    'modem_cache_requests_total': ('counter', 'Cache lookups, per cache and outcome (hit or miss)')
+}
+
+# Histogram bucket upper bounds, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# File the values of exited processes are added to (see MetricsStore.collect)
+ARCHIVE_FILE = 'archive.json'
+
+
+class Timings:
+    """
+    Durations of the stages of one upload, plus cache lookup outcomes.
+    A stage that runs several times (e.g. once per chunk) adds up.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.cache = {}
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def cache_lookup(self, cache, hit):
+        key = (cache, 'hit' if hit else 'miss')
+        self.cache[key] = self.cache.get(key, 0) + 1
+
+    def as_dict(self):
+        """Stage durations in milliseconds, for the API response"""
+        return {stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()}
+
+
+def timed(timings, stage):
+    """timings.span(stage), or a no-op context when timings is None"""
+    return timings.span(stage) if timings is not None else contextlib.nullcontext()
+
+
+class MetricsStore:
+    """
+    Counters and histograms kept in memory by each process and written to
+    one JSON file per process in a shared directory, so /metrics can add
+    up every gunicorn worker and analysis process. Files are named by pid
+    and a random run id, so a process that gets the pid of an earlier one
+    never overwrites its values. Values of processes that have exited are
+    added to ARCHIVE_FILE, so totals never go backwards.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _state(self):
+        # A forked process starts over instead of re-counting its parent's values
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._file = f'{self._pid}-{uuid.uuid4().hex}.json'
+            self._counters = {}
+            self._histograms = {}
+        return self._counters, self._histograms
+
+    def inc(self, name, labels=None, value=1):
+        key = _series_key(name, labels)
+        with self._lock:
+            counters, _ = self._state()
+            counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = _series_key(name, labels)
+        with self._lock:
+            _, histograms = self._state()
+            histogram = histograms.setdefault(key, {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0, 'count': 0})
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def record_timings(self, timings):
+        """Add one upload's stage durations and cache lookups"""
+        for stage, seconds in timings.stages.items():
+            self.observe('modem_stage_duration_seconds', seconds, {'stage': stage})
+        for (cache, outcome), count in timings.cache.items():
+            self.inc('modem_cache_requests_total', {'cache': cache, 'outcome': outcome}, count)
+
+    def flush(self):
+        """Write this process's values to its file"""
+        with self._lock:
+            counters, histograms = self._state()
+            data = {'counters': counters, 'histograms': histograms}
+            atomic_write(os.path.join(self.directory, self._file), lambda f: json.dump(data, f),
+                         mode='w', encoding='utf-8')
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _archive_exited(self):
+        """Add the files of processes that have exited to ARCHIVE_FILE and remove them"""
+        exited = [name for name in os.listdir(self.directory) if _process_exited(name)]
+        if not exited:
+            return
+        archive_path = os.path.join(self.directory, ARCHIVE_FILE)
+        with locked(lock_path_for(archive_path)):
+            archive = self._read(ARCHIVE_FILE) or {'counters': {}, 'histograms': {}, 'archived': []}
+            # A file archived by a run that stopped before removing it is not added twice
+            archived = set(archive['archived'])
+            for name in exited:
+                data = self._read(name) if name not in archived else None
+                if data is not None:
+                    _add_values(archive['counters'], archive['histograms'], data)
+                    archive['archived'].append(name)
+            archive['archived'] = [name for name in archive['archived']
+                                   if os.path.exists(os.path.join(self.directory, name))]
+            atomic_write(archive_path, lambda f: json.dump(archive, f), mode='w', encoding='utf-8')
+            for name in archive['archived']:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def collect(self):
+        """Values of every process added together: (counters, histograms)"""
+        self._archive_exited()
+        counters = {}
+        histograms = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            data = self._read(name)
+            if data is not None:
+                _add_values(counters, histograms, data)
+        return counters, histograms
+
+
+def _add_values(counters, histograms, data):
+    # Add one file's counters and histograms to the totals
+    for key, value in data['counters'].items():
+        counters[key] = counters.get(key, 0) + value
+    for key, histogram in data['histograms'].items():
+        total = histograms.setdefault(key, {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0, 'count': 0})
+        total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+        total['sum'] += histogram['sum']
+        total['count'] += histogram['count']
+
+
+def _process_exited(name):
+    """Whether a metrics file belongs to a process that is no longer running"""
+    stem, extension = os.path.splitext(name)
+    pid, _, run_id = stem.partition('-')
+    if extension != '.json' or not pid.isdigit():
+        return False
+    if not run_id:
+        # Named by pid alone before run ids; no process writes these any more
+        return True
+    if os.name == 'nt':
+        # os.kill would end the process; its file is kept
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
+
+def _series_key(name, labels):
+    # Stored as the exposition-format series name, e.g. 'jobs_total{city="vrsac"}'
+    if not labels:
+        return name
+    pairs = ','.join(f'{label}="{_escape(value)}"' for label, value in sorted(labels.items()))
+    return f'{name}{{{pairs}}}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _split_key(key):
+    name, _, labels = key.partition('{')
+    return name, labels.rstrip('}')
+
+
+def _bucket_labels(labels, bound):
+    le = f'le="{bound}"'
+    return f'{{{labels},{le}}}' if labels else f'{{{le}}}'
+
+
+def render(counters, histograms):
+    """Counters and histograms in the Prometheus text exposition format"""
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'counter':
+            for key in sorted(k for k in counters if _split_key(k)[0] == name):
+                lines.append(f'{key} {counters[key]}')
+        else:
+            for key in sorted(k for k in histograms if _split_key(k)[0] == name):
+                _, labels = _split_key(key)
+                histogram = histograms[key]
+                for bound, count in zip(DURATION_BUCKETS, histogram['buckets']):
+                    lines.append(f'{name}_bucket{_bucket_labels(labels, bound)} {count}')
+                lines.append(f'{name}_bucket{_bucket_labels(labels, "+Inf")} {histogram["count"]}')
+                suffix = f'{{{labels}}}' if labels else ''
+                lines.append(f'{name}_sum{suffix} {histogram["sum"]}')
+                lines.append(f'{name}_count{suffix} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
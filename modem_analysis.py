@@ -1,207 +1,741 @@
+import importlib.util
+import os
+
 import pandas as pd
 import numpy as np
+from pandas.api.types import is_numeric_dtype
+
+from metrics import timed
+from thresholds import DEFAULT_PROFILE, compile_profile
+
+# Placeholders the export uses for missing readings
+MISSING_SENTINELS = ('-', '', 'nan')
+
+# Position used when a group has no flagged rows
+NO_POSITION = np.iinfo(np.int64).max
+
+# How group_stats columns combine when merging partial results
+GROUP_STATS_MERGE = {
+    'total_count': 'sum',
+    'bad_count': 'sum',
+    'usp_count': 'sum',
+    'dsp_count': 'sum',
+    'dss_count': 'sum',
+    'first_bad': 'min',
+    'first_dss': 'min'
+}
+
+# Per-node reading histograms behind the median readings in the aggregates:
+# bins of READING_BIN_WIDTH dB over a window per reading (low, high), wide
+# enough for every profile's limits; readings outside it are counted in its
+# first or last bin
+READING_BIN_WIDTH = 0.5
+READING_WINDOWS = {
+    'USP': (20.0, 65.0),
+    'DSP': (-20.0, 25.0),
+    'DSS': (20.0, 50.0)
+}
+
+# Bumped when aggregates() changes shape, so older cached results are redone
+AGGREGATES_VERSION = 3
+
+# Column positions of DSS (column F) and ON names (column N) in the export
+DSS_COLUMN_INDEX = 5
+ON_NAME_COLUMN_INDEX = 13
+
+# Columns read from the export, after renaming the positional ones
+NUMERIC_COLUMNS = ['USP', 'DSP', 'DSS']
+TEXT_COLUMNS = ['dpath', 'AMP_NAME', 'ON_NAME']
+
+# Export columns that identify a modem, in order of preference; the first
+# one present is read as MODEM_ID (exports without one are still accepted)
+MODEM_ID_COLUMNS = ('MAC', 'MAC_ADDRESS', 'CM_MAC')
+
+# Columns of the offender table (one row per modem flagged by any rule);
+# ROW is the modem's row number in the export as Excel shows it (header = 1)
+OFFENDER_COLUMNS = ['ROW', 'MODEM_ID', 'ON_NODE', 'ON_NAME', 'AMP_CODE', 'AMP_NAME',
+                    'USP', 'DSP', 'DSS', 'USP_BAD', 'DSP_BAD', 'DSS_BAD']
 
-def analyze_modem_data(csv_file):
+# CSV parser engines accepted by read_modem_csv ('auto' prefers pyarrow)
+CSV_ENGINES = ('auto', 'c', 'pyarrow')
+
+# ON node and AMP codes inside dpath, e.g. "005-002;ON-05-0001;AMP-05-01270"
+ON_NODE_PATTERN = r'(ON-\d+-\d+)'
+LAST_AMP_PATTERN = r'.*(AMP-\d+-\d+)'
+
+
+def parse_numeric(values):
     """
-    Analyze modem data from uploaded CSV file.
-    Returns a dictionary with analysis results.
+    Convert a column to float in one vectorized pass.
+    '-', blank and non-numeric text become NaN; negative numbers are kept.
+    """
+    if is_numeric_dtype(values):
+        return values.astype(float)
+    values = values.where(~values.isin(MISSING_SENTINELS))
+    return pd.to_numeric(values, errors='coerce')
+
+
+def extract_codes(values, pattern):
+    """
+    Vectorized regex extraction that runs once per distinct value.
+    dpath repeats for every modem behind the same amplifier, so this is
+    far cheaper than extracting on every row.
+    """
+    codes, uniques = pd.factorize(values)
+    extracted = pd.Series(uniques, dtype=object).str.extract(pattern, expand=False).to_numpy()
+    extracted = np.where(pd.isna(extracted), None, extracted)
+    result = np.where(codes >= 0, extracted[codes], None) if len(uniques) else np.full(len(codes), None)
+    return pd.Series(result, index=values.index, dtype=object)
+
+
+def resolve_engine(engine):
+    """Pick the CSV parser engine, falling back to C when pyarrow is missing"""
+    engine = (engine or 'auto').lower()
+    if engine not in CSV_ENGINES:
+        raise ValueError(f'Unknown CSV engine: {engine}')
+    if engine == 'auto':
+        return 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
+    return engine
+
+
+def resolve_columns(csv_file):
+    """
+    Read only the header and map the export's column names to the names
+    used by the analysis (DSS is column F, ON names are column N).
+    """
+    header = pd.read_csv(csv_file, nrows=0).columns
+    if hasattr(csv_file, 'seek'):
+        csv_file.seek(0)
+    if len(header) <= max(DSS_COLUMN_INDEX, ON_NAME_COLUMN_INDEX):
+        raise ValueError(f'Expected at least {ON_NAME_COLUMN_INDEX + 1} columns, found {len(header)}')
+    missing = [col for col in ('USP', 'DSP', 'dpath', 'AMP_NAME') if col not in header]
+    if missing:
+        raise ValueError(f'Missing required columns: {", ".join(missing)}')
+    columns = {
+        'USP': 'USP',
+        'DSP': 'DSP',
+        'dpath': 'dpath',
+        'AMP_NAME': 'AMP_NAME',
+        header[DSS_COLUMN_INDEX]: 'DSS',
+        header[ON_NAME_COLUMN_INDEX]: 'ON_NAME'
+    }
+    for col in MODEM_ID_COLUMNS:
+        if col in header and col not in columns:
+            columns[col] = 'MODEM_ID'
+            break
+    return columns
+
+
+def _load_columns(csv_file, engine, numeric_dtype, chunksize=None):
+    columns = resolve_columns(csv_file)
+    source_names = {target: source for source, target in columns.items()}
+    dtypes = {source_names[col]: numeric_dtype for col in NUMERIC_COLUMNS}
+    dtypes.update({source_names[col]: 'category' for col in TEXT_COLUMNS})
+    if 'MODEM_ID' in source_names:
+        dtypes[source_names['MODEM_ID']] = object
+    # The C engine parses files on disk from a memory map instead of
+    # reading them into a buffer. pyarrow reads them into its own buffers
+    # either way, so a memory map would only add the mapped pages
+    options = {'memory_map': True} if engine == 'c' and isinstance(csv_file, (str, os.PathLike)) else {}
+    reader = pd.read_csv(csv_file, usecols=list(columns), dtype=dtypes,
+                         na_values=['-'], engine=engine, chunksize=chunksize, **options)
+    if chunksize:
+        return (chunk.rename(columns=columns) for chunk in reader)
+    return reader.rename(columns=columns)
+
+
+def read_modem_csv(csv_file, engine='auto'):
+    """
+    Load the six columns the analysis uses with explicit dtypes.
+    Readings are parsed as float with '-' treated as missing; name columns
+    are categorical. If a reading column holds other text the columns are
+    re-read as strings and cleaned by parse_numeric.
     """
+    engine = resolve_engine(engine)
     try:
-        # Read CSV file
-        df = pd.read_csv(csv_file)
-        
-        # Get column F name (DSS column - index 5)
-        dss_col = df.columns[5]
-        
-        # Get column N name (ON names - index 13)
-        on_names_col = df.columns[13]
-        
-        # Function to check if value is a valid number (including negatives)
-        # Returns True for valid numbers, False for '-', blank, or non-numeric
-        def is_valid_number(val):
-            if pd.isna(val):
-                return False
-            if isinstance(val, (int, float)):
-                return not np.isnan(val)
-            # String check - exclude literal dash '-' but allow negative numbers like '-5.2'
-            str_val = str(val).strip()
-            if str_val == '-' or str_val == '' or str_val.lower() == 'nan':
-                return False
-            try:
-                float(str_val)
-                return True
-            except ValueError:
-                return False
-        
-        # Create masks for valid values in each column
-        usp_valid = df['USP'].apply(is_valid_number)
-        dsp_valid = df['DSP'].apply(is_valid_number)
-        dss_valid = df[dss_col].apply(is_valid_number)
-        
-        # Filter dataframe to only include rows with valid values in ALL three columns
-        valid_mask = usp_valid & dsp_valid & dss_valid
-        df_valid = df[valid_mask].copy()
-        
-        # Now convert to numeric (this will work properly since we filtered valid values)
-        df_valid['USP'] = pd.to_numeric(df_valid['USP'], errors='coerce')
-        df_valid['DSP'] = pd.to_numeric(df_valid['DSP'], errors='coerce')
-        df_valid[dss_col] = pd.to_numeric(df_valid[dss_col], errors='coerce')
-        
-        # Extract ON node from dpath column
-        df_valid['ON_NODE'] = df_valid['dpath'].str.extract(r'(ON-\d+-\d+)')
-        
-        # Extract AMP code from dpath column (last AMP-XX-XXXXX pattern)
-        def extract_amp_code(dpath):
-            if pd.isna(dpath):
-                return None
-            import re
-            matches = re.findall(r'(AMP-\d+-\d+)', str(dpath))
-            return matches[-1] if matches else None
-        
-        df_valid['AMP_CODE'] = df_valid['dpath'].apply(extract_amp_code)
-        
-        # Create a mapping of ON_NODE to the text in column N
-        def get_valid_on_name(on_node):
-            rows_with_on = df_valid[df_valid['ON_NODE'] == on_node]
-            valid_names = rows_with_on[on_names_col]
-            valid_names = valid_names[valid_names.notna() & (valid_names != '-') & (valid_names != '')]
-            
-            names_with_code = valid_names[valid_names.str.contains(str(on_node), regex=False, na=False)]
-            
-            if len(names_with_code) > 0:
-                return names_with_code.iloc[0]
-            elif len(valid_names) > 0:
-                return valid_names.iloc[0]
-            return 'Unknown'
-        
-        on_node_to_name = {}
-        for on_node in df_valid['ON_NODE'].dropna().unique():
-            on_node_to_name[on_node] = get_valid_on_name(on_node)
-        
-        # Create mapping of AMP_NAME to AMP_CODE
-        amp_name_to_code = {}
-        for amp_name in df_valid['AMP_NAME'].dropna().unique():
-            amp_rows = df_valid[df_valid['AMP_NAME'] == amp_name]
-            codes = amp_rows['AMP_CODE'].dropna().unique()
-            amp_name_to_code[amp_name] = codes[-1] if len(codes) > 0 else 'N/A'
-        
-        # Count total valid modems (only those with valid USP, DSP, and DSS values)
-        count_total_modems = len(df_valid)
-        
-        # Count rows that meet USP/DSP conditions (PWR issues)
-        pwr_condition = ((df_valid['USP'] > 50.9) | (df_valid['USP'] < 33) | 
-                         (df_valid['DSP'] > 15.9) | (df_valid['DSP'] < -8.9))
-        count_usp_dsp = pwr_condition.sum()
-        
-        # Count rows that meet DSS condition only (SNR issues, not already counted in PWR)
-        dss_condition = df_valid[dss_col] < 36
-        dss_only_condition = dss_condition & ~pwr_condition
-        count_dss_only = dss_only_condition.sum()
-        
-        # Count rows that meet ANY condition (total bad modems)
-        any_bad_condition = pwr_condition | dss_condition
-        count_usp_dsp_dss = any_bad_condition.sum()
-        
-        # Filter rows that meet the PWR conditions for AMP and ON analysis
-        filtered_df = df_valid[pwr_condition]
-        
-        # TOP 10 AMP ANALYSIS
-        top_10_amp = filtered_df['AMP_NAME'].value_counts().head(10)
+        return _load_columns(csv_file, engine, 'float64')
+    except ValueError:
+        if hasattr(csv_file, 'seek'):
+            csv_file.seek(0)
+        return _load_columns(csv_file, engine, object)
+
+
+def iter_modem_chunks(csv_file, chunksize, numeric_dtype='float64'):
+    """
+    Yield the analyzed columns in chunks of chunksize rows.
+    Uses the C engine (pyarrow cannot stream); row index keeps counting
+    across chunks.
+    """
+    yield from _load_columns(csv_file, 'c', numeric_dtype, chunksize=chunksize)
+
+def parse_modem_frame(df):
+    """
+    Build the working frame used by the analysis.
+    Keeps only rows with valid USP, DSP and DSS values and adds the
+    ON_NODE and AMP_CODE columns extracted from dpath, which is kept for
+    the topology tree (and MODEM_ID when the export has an identifier
+    column).
+    """
+    usp = parse_numeric(df['USP'])
+    dsp = parse_numeric(df['DSP'])
+    dss = parse_numeric(df['DSS'])
+    valid = usp.notna() & dsp.notna() & dss.notna()
+
+    dpath = df['dpath'][valid]
+    frame = pd.DataFrame({
+        'USP': usp[valid],
+        'DSP': dsp[valid],
+        'DSS': dss[valid],
+        'AMP_NAME': df['AMP_NAME'][valid],
+        'ON_NAME': df['ON_NAME'][valid],
+        'dpath': dpath,
+        'ON_NODE': extract_codes(dpath, ON_NODE_PATTERN),
+        # Greedy prefix makes the group capture the last AMP code in the path
+        'AMP_CODE': extract_codes(dpath, LAST_AMP_PATTERN)
+    })
+    if 'MODEM_ID' in df.columns:
+        frame['MODEM_ID'] = df['MODEM_ID'][valid]
+    return frame
+
+
+def offender_rows(frame, usp_bad, dsp_bad, dss_bad):
+    """Rows of a parsed frame flagged by any rule, as an offender table (see OFFENDER_COLUMNS)"""
+    flagged = usp_bad | dsp_bad | dss_bad
+    rows = frame[flagged]
+    return pd.DataFrame({
+        'ROW': rows.index.to_numpy() + 2,
+        'MODEM_ID': rows['MODEM_ID'].astype(object) if 'MODEM_ID' in rows.columns else None,
+        'ON_NODE': rows['ON_NODE'].astype(object),
+        'ON_NAME': rows['ON_NAME'].astype(object),
+        'AMP_CODE': rows['AMP_CODE'].astype(object),
+        'AMP_NAME': rows['AMP_NAME'].astype(object),
+        'USP': rows['USP'],
+        'DSP': rows['DSP'],
+        'DSS': rows['DSS'],
+        'USP_BAD': usp_bad[flagged],
+        'DSP_BAD': dsp_bad[flagged],
+        'DSS_BAD': dss_bad[flagged]
+    }, columns=OFFENDER_COLUMNS).reset_index(drop=True)
+
+
+def group_stats(keys, usp_bad, dsp_bad, dss_bad):
+    """
+    Aggregate per-group counters for one key column in a single pass.
+    Returns a DataFrame indexed by group key with total, bad (USP/DSP),
+    USP, DSP and DSS counts plus the row position of the first bad/DSS hit.
+    Row positions come from the frame index, so chunks keep global positions.
+    """
+    codes, uniques = pd.factorize(keys.to_numpy(), use_na_sentinel=True)
+    known = codes >= 0
+    size = len(uniques)
+    pwr_bad = usp_bad | dsp_bad
+    row_positions = keys.index.to_numpy()
+
+    def count(flag):
+        return np.bincount(codes[known & flag], minlength=size)
+
+    def first_position(flag):
+        # Row position of the first flagged row per group (NO_POSITION if none)
+        selected = np.flatnonzero(known & flag)
+        first = np.full(size, NO_POSITION, dtype=np.int64)
+        group_codes, first_index = np.unique(codes[selected], return_index=True)
+        first[group_codes] = row_positions[selected[first_index]]
+        return first
+
+    return pd.DataFrame({
+        'total_count': np.bincount(codes[known], minlength=size),
+        'bad_count': count(pwr_bad),
+        'usp_count': count(usp_bad),
+        'dsp_count': count(dsp_bad),
+        'dss_count': count(dss_bad),
+        'first_bad': first_position(pwr_bad),
+        'first_dss': first_position(dss_bad)
+    }, index=pd.Index(uniques, dtype=object))
+
+
+def merge_group_stats(left, right):
+    """Combine two group_stats tables: counts add up, first positions take the minimum"""
+    combined = pd.concat([left, right])
+    return combined.groupby(level=0, sort=False).agg(GROUP_STATS_MERGE)
+
+
+def subtract_group_stats(left, right):
+    """
+    Take the rows counted in right out of left (both group_stats tables,
+    right's groups all in left): counts are subtracted and groups left
+    without rows are dropped. A first position cannot be undone, so also
+    returns the groups whose first_bad or first_dss came from right; their
+    positions must be recomputed from the remaining rows.
+    """
+    counts = [col for col, how in GROUP_STATS_MERGE.items() if how == 'sum']
+    stats = left.copy()
+    stats.loc[right.index, counts] -= right[counts]
+    current = stats.loc[right.index]
+    stale = ((right['first_bad'] != NO_POSITION) & (right['first_bad'] == current['first_bad'])) | \
+            ((right['first_dss'] != NO_POSITION) & (right['first_dss'] == current['first_dss']))
+    return stats[stats['total_count'] > 0], right.index[stale.to_numpy()]
+
+
+def _reading_bins():
+    """Bin count of each reading's window and the offset of its bins in a histogram row"""
+    sizes = [int(round((high - low) / READING_BIN_WIDTH)) for low, high in READING_WINDOWS.values()]
+    return sizes, np.concatenate([[0], np.cumsum(sizes)[:-1]]).tolist()
+
+
+class ReadingCounts:
+    """
+    Histograms of the USP, DSP and DSS readings per group (see
+    READING_WINDOWS): counts[i] holds the bins of every reading of group
+    groups[i]. Like the group_stats counts, histograms add up across chunks
+    and can be subtracted again, which an exact median cannot; both are
+    done on the int32 arrays, rows aligned by group.
+    """
+
+    def __init__(self, groups, counts):
+        self.groups = groups
+        self.counts = counts
+
+    @classmethod
+    def from_frame(cls, keys, frame):
+        """Histograms of a parsed frame's readings, grouped by keys"""
+        if isinstance(keys.dtype, pd.CategoricalDtype):
+            # Category codes spare hashing the names again
+            codes, uniques = keys.cat.codes.to_numpy(dtype=np.int64), keys.cat.categories.to_numpy(dtype=object)
+        else:
+            codes, uniques = pd.factorize(keys.to_numpy(), use_na_sentinel=True)
+        known = codes >= 0
+        sizes, offsets = _reading_bins()
+        width = sum(sizes)
+        cells = []
+        for (col, (low, _)), size, offset in zip(READING_WINDOWS.items(), sizes, offsets):
+            bins = np.floor((frame[col].to_numpy(dtype=float)[known] - low) / READING_BIN_WIDTH)
+            bins = np.clip(bins, 0, size - 1).astype(np.int64)
+            cells.append(codes[known] * width + offset + bins)
+        counts = np.bincount(np.concatenate(cells), minlength=len(uniques) * width).reshape(len(uniques), width)
+        used = counts.any(axis=1)
+        return cls(pd.Index(uniques[used], dtype=object), counts[used].astype(np.int32))
+
+    def __len__(self):
+        return len(self.groups)
+
+    def merge(self, other):
+        """Add other's readings to these, in place; returns self"""
+        at = self.groups.get_indexer(other.groups)
+        new = at < 0
+        if new.any():
+            at[new] = len(self.groups) + np.arange(int(new.sum()))
+            self.groups = self.groups.append(other.groups[new])
+            self.counts = np.concatenate([self.counts, np.zeros((int(new.sum()), self.counts.shape[1]), dtype=np.int32)])
+        self.counts[at] += other.counts
+        return self
+
+    def subtract(self, other):
+        """Take other's readings out of these (other's groups all here), in place; empty groups are dropped"""
+        at = self.groups.get_indexer(other.groups)
+        self.counts[at] -= other.counts
+        empty = at[~self.counts[at].any(axis=1)]
+        if len(empty):
+            kept = np.ones(len(self.groups), dtype=bool)
+            kept[empty] = False
+            self.groups = self.groups[kept]
+            self.counts = self.counts[kept]
+        return self
+
+    def medians(self):
+        """
+        Median USP, DSP and DSS per group, as the centre of the bin holding
+        the median (within READING_BIN_WIDTH / 2 inside the window)
+        """
+        sizes, offsets = _reading_bins()
+        medians = {}
+        for (col, (low, _)), size, offset in zip(READING_WINDOWS.items(), sizes, offsets):
+            cumulative = self.counts[:, offset:offset + size].cumsum(axis=1)
+            total = cumulative[:, -1:]
+            # Bins of the two middle readings (the same one for an odd count)
+            lower = (cumulative < (total + 1) // 2).sum(axis=1)
+            upper = (cumulative < total // 2 + 1).sum(axis=1)
+            medians[f'{col.lower()}_median'] = low + ((lower + upper) / 2 + 0.5) * READING_BIN_WIDTH
+        return pd.DataFrame(medians, index=self.groups)
+
+
+def top_groups(stats, count_col, first_col, n):
+    """
+    Top N groups by count, ties broken by first appearance
+    (same ordering as value_counts() on the flagged rows).
+    """
+    hits = stats[stats[count_col] > 0].sort_values(first_col, kind='stable')
+    return hits.sort_values(count_col, ascending=False, kind='stable').head(n)
+
+
+def rank_groups(stats, count_col, first_col):
+    """
+    Rank of every group in the same order as top_groups (1 = most flagged).
+    Groups without flagged rows get None.
+    """
+    ordered = top_groups(stats, count_col, first_col, len(stats))
+    ranks = pd.Series(range(1, len(ordered) + 1), index=ordered.index, dtype=object)
+    return ranks.reindex(stats.index).astype(object).where(lambda r: r.notna(), None)
+
+
+def on_name_candidates(on_nodes, names):
+    """
+    Candidate display names per ON node from column N: the first valid name
+    and the first name that contains the ON code, with their row positions.
+    """
+    valid = on_nodes.notna() & names.notna() & (names != '-') & (names != '')
+    pairs = pd.DataFrame({
+        'on_node': on_nodes[valid].astype(object),
+        'name': names[valid].astype(object),
+        'position': on_nodes.index[valid]
+    }).drop_duplicates(['on_node', 'name'])
+    pairs['has_code'] = [str(on_node) in str(name) for on_node, name in zip(pairs['on_node'], pairs['name'])]
+    return _first_on_names(pairs)
+
+
+def _first_on_names(pairs):
+    pairs = pairs.sort_values('position', kind='stable')
+    first_coded = pairs[pairs['has_code']].drop_duplicates('on_node')
+    first_any = pairs.drop_duplicates('on_node')
+    return pd.concat([first_coded, first_any]).drop_duplicates(['on_node', 'name'])
+
+
+def map_on_names(candidates):
+    """
+    Map each ON node to its display name.
+    Prefers the first name that contains the ON code, then the first valid name.
+    """
+    preferred = candidates.sort_values(['has_code', 'position'], ascending=[False, True], kind='stable')
+    preferred = preferred.drop_duplicates('on_node')
+    return dict(zip(preferred['on_node'], preferred['name']))
+
+
+def amp_code_pairs(amp_names, amp_codes):
+    """Distinct (AMP_NAME, AMP_CODE) pairs with the row position where each first appears"""
+    pairs = pd.DataFrame({
+        'amp_name': amp_names.astype(object),
+        'amp_code': amp_codes,
+        'position': amp_names.index
+    }).dropna()
+    return pairs.drop_duplicates(['amp_name', 'amp_code'])
+
+
+def map_amp_codes(pairs):
+    """Map each AMP_NAME to the last distinct AMP code seen for it in dpath"""
+    last_seen = pairs.sort_values('position', kind='stable').drop_duplicates('amp_name', keep='last')
+    return dict(zip(last_seen['amp_name'], last_seen['amp_code']))
+
+
+def _percentage(part, total):
+    return round(float(part / total * 100), 2) if total > 0 else 0
+
+
+class ModemAccumulator:
+    """
+    Running totals for one analysis: summary counts, per-AMP, per-ON and
+    per-dpath group_stats, ON name candidates and AMP code pairs. Rows are scored
+    with a threshold profile (name or CompiledProfile).
+    Memory grows with the number of nodes, not rows, and two accumulators
+    can be merged, so an export can be folded in chunk by chunk.
+    With collect_offenders the flagged rows are kept as well (see offenders),
+    and every frame added is also passed to modem_writer's add, if given
+    (a modem_state.ModemStateWriter).
+    """
+
+    def __init__(self, profile=DEFAULT_PROFILE, collect_offenders=False, modem_writer=None):
+        self.profile = compile_profile(profile) if isinstance(profile, str) else profile
+        self.collect_offenders = collect_offenders
+        self.modem_writer = modem_writer
+        self.offender_chunks = []
+        self.total_modems = 0
+        self.usp_dsp_count = 0
+        self.usp_dsp_dss_count = 0
+        self.dss_only_count = 0
+        self.amp_stats = None
+        self.on_stats = None
+        self.path_stats = None
+        self.amp_readings = None
+        self.on_readings = None
+        self.on_names = None
+        self.amp_codes = None
+
+    def add(self, df_valid):
+        """Fold a parsed frame (see parse_modem_frame) into the totals"""
+        # Row-level condition flags, evaluated once for the whole frame
+        usp_bad, dsp_bad, dss_condition = self.profile.evaluate(df_valid)
+        pwr_condition = usp_bad | dsp_bad
+
+        chunk = ModemAccumulator(self.profile)
+        chunk.total_modems = len(df_valid)
+        chunk.usp_dsp_count = int(pwr_condition.sum())
+        chunk.usp_dsp_dss_count = int((pwr_condition | dss_condition).sum())
+        chunk.dss_only_count = int((dss_condition & ~pwr_condition).sum())
+        chunk.amp_stats = group_stats(df_valid['AMP_NAME'], usp_bad, dsp_bad, dss_condition)
+        chunk.on_stats = group_stats(df_valid['ON_NODE'], usp_bad, dsp_bad, dss_condition)
+        chunk.path_stats = group_stats(df_valid['dpath'], usp_bad, dsp_bad, dss_condition)
+        chunk.amp_readings = ReadingCounts.from_frame(df_valid['AMP_NAME'], df_valid)
+        chunk.on_readings = ReadingCounts.from_frame(df_valid['ON_NODE'], df_valid)
+        chunk.on_names = on_name_candidates(df_valid['ON_NODE'], df_valid['ON_NAME'])
+        chunk.amp_codes = amp_code_pairs(df_valid['AMP_NAME'], df_valid['AMP_CODE'])
+        if self.collect_offenders:
+            chunk.offender_chunks.append(offender_rows(df_valid, usp_bad, dsp_bad, dss_condition))
+        if self.modem_writer is not None:
+            self.modem_writer.add(df_valid)
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """Merge another accumulator into this one"""
+        self.total_modems += other.total_modems
+        self.usp_dsp_count += other.usp_dsp_count
+        self.usp_dsp_dss_count += other.usp_dsp_dss_count
+        self.dss_only_count += other.dss_only_count
+        self.offender_chunks.extend(other.offender_chunks)
+        if self.amp_stats is None:
+            self.amp_stats = other.amp_stats
+            self.on_stats = other.on_stats
+            self.path_stats = other.path_stats
+            self.amp_readings = other.amp_readings
+            self.on_readings = other.on_readings
+            self.on_names = other.on_names
+            self.amp_codes = other.amp_codes
+        elif other.amp_stats is not None:
+            self.amp_stats = merge_group_stats(self.amp_stats, other.amp_stats)
+            self.on_stats = merge_group_stats(self.on_stats, other.on_stats)
+            self.path_stats = merge_group_stats(self.path_stats, other.path_stats)
+            self.amp_readings.merge(other.amp_readings)
+            self.on_readings.merge(other.on_readings)
+            self.on_names = _first_on_names(pd.concat([self.on_names, other.on_names]))
+            amp_codes = pd.concat([self.amp_codes, other.amp_codes]).sort_values('position', kind='stable')
+            self.amp_codes = amp_codes.drop_duplicates(['amp_name', 'amp_code'])
+        return self
+
+    def offenders(self):
+        """Every flagged modem in export order, as one offender table"""
+        if not self.offender_chunks:
+            return pd.DataFrame(columns=OFFENDER_COLUMNS)
+        return pd.concat(self.offender_chunks, ignore_index=True)
+
+    def aggregates(self):
+        """
+        Per-AMP and per-ON counts for every node (not just the top lists),
+        as lists of row dictionaries. bad_rank/dss_rank give each node's
+        position in the full USP/DSP and DSS rankings, usp_median,
+        dsp_median and dss_median its median readings (see ReadingCounts.medians).
+        'paths' has the counts of every distinct dpath, for the topology
+        tree (topology.py).
+        """
+        if self.amp_stats is None:
+            return {'version': AGGREGATES_VERSION, 'amp': [], 'on': [], 'paths': []}
+
+        count_columns = ['total_count', 'bad_count', 'usp_count', 'dsp_count', 'dss_count']
+
+        def node_table(stats, readings, key_col):
+            table = stats[count_columns].copy()
+            table['bad_rank'] = rank_groups(stats, 'bad_count', 'first_bad')
+            table['dss_rank'] = rank_groups(stats, 'dss_count', 'first_dss')
+            table = table.join(readings.medians())
+            return table.rename_axis(key_col).reset_index()
+
+        amp_table = node_table(self.amp_stats, self.amp_readings, 'amp_name')
+        amp_table.insert(1, 'amp_code', amp_table['amp_name'].map(map_amp_codes(self.amp_codes)).fillna('N/A'))
+        on_table = node_table(self.on_stats, self.on_readings, 'on_node')
+        on_table.insert(1, 'on_name', on_table['on_node'].map(map_on_names(self.on_names)).fillna('Unknown'))
+        path_table = self.path_stats[count_columns].rename_axis('dpath').reset_index()
+        return {
+            'version': AGGREGATES_VERSION,
+            'amp': amp_table.to_dict('records'),
+            'on': on_table.to_dict('records'),
+            'paths': path_table.to_dict('records')
+        }
+
+    def results(self):
+        """Build the analysis result dictionary (summary and top lists)"""
         results_amp = []
-        for i, amp_name in enumerate(top_10_amp.index, 1):
-            amp_data = filtered_df[filtered_df['AMP_NAME'] == amp_name]
-            
-            # Total modems for this AMP (from valid data)
-            total_amp_modems = len(df_valid[df_valid['AMP_NAME'] == amp_name])
-            bad_amp_modems = len(amp_data)
-            
-            usp_count = ((amp_data['USP'] > 50.9) | (amp_data['USP'] < 33)).sum()
-            dsp_count = ((amp_data['DSP'] > 15.9) | (amp_data['DSP'] < -8.9)).sum()
-            
-            # Calculate percentage of bad modems for this AMP
-            percentage = round((bad_amp_modems / total_amp_modems * 100), 2) if total_amp_modems > 0 else 0
-            
-            results_amp.append({
-                'rank': i,
-                'amp_name': amp_name,
-                'amp_code': amp_name_to_code.get(amp_name, 'N/A'),
-                'bad_count': int(bad_amp_modems),
-                'total_count': int(total_amp_modems),
-                'percentage': percentage,
-                'usp_count': int(usp_count),
-                'dsp_count': int(dsp_count)
-            })
-        
-        # TOP 10 ON NODES ANALYSIS
-        top_10_on = filtered_df['ON_NODE'].value_counts().head(10)
         results_on = []
-        for i, on_node in enumerate(top_10_on.index, 1):
-            on_data = filtered_df[filtered_df['ON_NODE'] == on_node]
-            
-            # Total modems for this ON node (from valid data)
-            total_on_modems = len(df_valid[df_valid['ON_NODE'] == on_node])
-            bad_on_modems = len(on_data)
-            
-            usp_count = ((on_data['USP'] > 50.9) | (on_data['USP'] < 33)).sum()
-            dsp_count = ((on_data['DSP'] > 15.9) | (on_data['DSP'] < -8.9)).sum()
-            
-            column_n_text = on_node_to_name.get(on_node, 'Unknown')
-            
-            # Calculate percentage of bad modems for this ON node
-            percentage = round((bad_on_modems / total_on_modems * 100), 2) if total_on_modems > 0 else 0
-            
-            results_on.append({
-                'rank': i,
-                'on_node': on_node,
-                'on_name': column_n_text,
-                'bad_count': int(bad_on_modems),
-                'total_count': int(total_on_modems),
-                'percentage': percentage,
-                'usp_count': int(usp_count),
-                'dsp_count': int(dsp_count)
-            })
-        
-        # TOP 20 DSS ANALYSIS
-        filtered_dss = df_valid[df_valid[dss_col] < 36]
-        top_20_dss = filtered_dss['ON_NODE'].value_counts().head(20)
         results_dss = []
-        for i, on_node in enumerate(top_20_dss.index, 1):
-            column_n_text = on_node_to_name.get(on_node, 'Unknown')
-            
-            # Total modems for this ON node (from valid data)
-            total_on_modems = len(df_valid[df_valid['ON_NODE'] == on_node])
-            bad_dss_modems = int(top_20_dss[on_node])
-            
-            # Calculate percentage of bad modems for this ON node
-            percentage = round((bad_dss_modems / total_on_modems * 100), 2) if total_on_modems > 0 else 0
-            
-            results_dss.append({
-                'rank': i,
-                'on_node': on_node,
-                'on_name': column_n_text,
-                'bad_count': bad_dss_modems,
-                'total_count': int(total_on_modems),
-                'percentage': percentage
-            })
-        
-        # Return all results
+
+        if self.amp_stats is not None:
+            on_node_to_name = map_on_names(self.on_names)
+            amp_name_to_code = map_amp_codes(self.amp_codes)
+
+            # TOP 10 AMP ANALYSIS
+            for i, (amp_name, row) in enumerate(top_groups(self.amp_stats, 'bad_count', 'first_bad', 10).iterrows(), 1):
+                results_amp.append({
+                    'rank': i,
+                    'amp_name': amp_name,
+                    'amp_code': amp_name_to_code.get(amp_name, 'N/A'),
+                    'bad_count': int(row['bad_count']),
+                    'total_count': int(row['total_count']),
+                    'percentage': _percentage(row['bad_count'], row['total_count']),
+                    'usp_count': int(row['usp_count']),
+                    'dsp_count': int(row['dsp_count'])
+                })
+
+            # TOP 10 ON NODES ANALYSIS
+            for i, (on_node, row) in enumerate(top_groups(self.on_stats, 'bad_count', 'first_bad', 10).iterrows(), 1):
+                results_on.append({
+                    'rank': i,
+                    'on_node': on_node,
+                    'on_name': on_node_to_name.get(on_node, 'Unknown'),
+                    'bad_count': int(row['bad_count']),
+                    'total_count': int(row['total_count']),
+                    'percentage': _percentage(row['bad_count'], row['total_count']),
+                    'usp_count': int(row['usp_count']),
+                    'dsp_count': int(row['dsp_count'])
+                })
+
+            # TOP 20 DSS ANALYSIS
+            for i, (on_node, row) in enumerate(top_groups(self.on_stats, 'dss_count', 'first_dss', 20).iterrows(), 1):
+                results_dss.append({
+                    'rank': i,
+                    'on_node': on_node,
+                    'on_name': on_node_to_name.get(on_node, 'Unknown'),
+                    'bad_count': int(row['dss_count']),
+                    'total_count': int(row['total_count']),
+                    'percentage': _percentage(row['dss_count'], row['total_count'])
+                })
+
         return {
             'success': True,
             'summary': {
-                'total_modems': int(count_total_modems),
-                'usp_dsp_count': int(count_usp_dsp),
-                'usp_dsp_dss_count': int(count_usp_dsp_dss),
-                'dss_only_count': int(count_dss_only),
-                'healthy_count': int(count_total_modems - count_usp_dsp_dss)
+                'total_modems': int(self.total_modems),
+                'usp_dsp_count': int(self.usp_dsp_count),
+                'usp_dsp_dss_count': int(self.usp_dsp_dss_count),
+                'dss_only_count': int(self.dss_only_count),
+                'healthy_count': int(self.total_modems - self.usp_dsp_dss_count)
             },
             'top_10_amp': results_amp,
             'top_10_on': results_on,
             'top_20_dss': results_dss
         }
+
+
+def _report(progress, stage, rows=0):
+    if progress is not None:
+        progress(stage, rows)
+
+
+def _fold_chunks(chunks, progress, profile, collect_offenders, modem_writer, timings):
+    accumulator = ModemAccumulator(profile, collect_offenders, modem_writer)
+    rows = 0
+    while True:
+        with timed(timings, 'read_csv'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return accumulator
+        rows += len(chunk)
+        _report(progress, 'aggregating', rows)
+        with timed(timings, 'parse_frame'):
+            frame = parse_modem_frame(chunk)
+        with timed(timings, 'aggregate'):
+            accumulator.add(frame)
+
+
+def load_modem_frame(csv_file, engine='auto', progress=None, timings=None):
+    """Read and parse a whole export into the working frame (see parse_modem_frame)"""
+    _report(progress, 'parsing')
+    with timed(timings, 'read_csv'):
+        df = read_modem_csv(csv_file, engine=engine)
+    _report(progress, 'aggregating', len(df))
+    with timed(timings, 'parse_frame'):
+        return parse_modem_frame(df)
+
+
+def accumulate_modem_data(csv_file, engine='auto', chunksize=None, progress=None,
+                          profile=DEFAULT_PROFILE, collect_offenders=False, modem_writer=None,
+                          timings=None):
+    """
+    Read and fold an export into a ModemAccumulator.
+    With chunksize set the CSV is streamed in chunks of that many rows,
+    so memory stays bounded by the chunk size and the number of nodes.
+    progress, if given, is called as progress(stage, rows_read) with
+    stage 'parsing' or 'aggregating'. timings, if given (a
+    metrics.Timings), gets the time spent reading, parsing and aggregating.
+    """
+    if not chunksize:
+        frame = load_modem_frame(csv_file, engine=engine, progress=progress, timings=timings)
+        with timed(timings, 'aggregate'):
+            return ModemAccumulator(profile, collect_offenders, modem_writer).add(frame)
+
+    _report(progress, 'parsing')
+    try:
+        return _fold_chunks(iter_modem_chunks(csv_file, chunksize), progress, profile,
+                            collect_offenders, modem_writer, timings)
+    except ValueError:
+        # A reading column holds text; start over with string readings
+        if hasattr(csv_file, 'seek'):
+            csv_file.seek(0)
+        if modem_writer is not None:
+            modem_writer.clear()
+        _report(progress, 'parsing')
+        return _fold_chunks(iter_modem_chunks(csv_file, chunksize, numeric_dtype=object), progress,
+                            profile, collect_offenders, modem_writer, timings)
+
+
+def _analysis_results(accumulator, include_aggregates, timings=None):
+    with timed(timings, 'top_lists'):
+        results = accumulator.results()
+    results['profile'] = accumulator.profile.name
+    if include_aggregates:
+        with timed(timings, 'aggregates'):
+            results['aggregates'] = accumulator.aggregates()
+    if accumulator.collect_offenders:
+        with timed(timings, 'offenders'):
+            results['offenders'] = accumulator.offenders()
+    if accumulator.modem_writer is not None:
+        # The modem state keeps the running totals, not the rows collected for this run
+        accumulator.collect_offenders = False
+        accumulator.offender_chunks = []
+        accumulator.modem_writer = None
+        results['totals'] = accumulator
+    return results
+
+
+def analyze_modem_data(csv_file, engine='auto', chunksize=None, progress=None,
+                       include_aggregates=False, profile=DEFAULT_PROFILE, include_offenders=False,
+                       modem_writer=None, timings=None):
+    """
+    Analyze modem data from uploaded CSV file.
+    Pass chunksize to stream large exports instead of loading them whole.
+    With include_aggregates the per-node counts for the whole population
+    are added under 'aggregates' (see ModemAccumulator.aggregates).
+    With include_offenders the flagged modems are added under 'offenders'
+    as a DataFrame (see OFFENDER_COLUMNS); pop it before serializing.
+    With modem_writer (a modem_state.ModemStateWriter) the parsed rows are
+    written to it as they are parsed (chunk by chunk when streaming) and
+    the running totals, a ModemAccumulator, are added under 'totals'.
+    profile names the threshold profile (see thresholds.py).
+    timings, if given (a metrics.Timings), gets the duration of each stage.
+    Returns a dictionary with analysis results.
+    """
+    try:
+        accumulator = accumulate_modem_data(csv_file, engine=engine, chunksize=chunksize,
+                                            progress=progress, profile=profile,
+                                            collect_offenders=include_offenders,
+                                            modem_writer=modem_writer, timings=timings)
+        return _analysis_results(accumulator, include_aggregates, timings)
+        
+    except Exception as e:
+        import traceback
+        return {
+            'success': False,
+            'error': f'{str(e)}\n{traceback.format_exc()}'
+        }
+
+
+def analyze_modem_frame(frame, include_aggregates=False, profile=DEFAULT_PROFILE, include_offenders=False,
+                        modem_writer=None, timings=None):
+    """
+    Score an already parsed frame (see load_modem_frame) with a profile.
+    Used to re-score a cached upload without parsing the CSV again.
+    """
+    try:
+        with timed(timings, 'aggregate'):
+            accumulator = ModemAccumulator(profile, include_offenders, modem_writer).add(frame)
+        return _analysis_results(accumulator, include_aggregates, timings)
         
     except Exception as e:
         import traceback
         return {
             'success': False,
             'error': f'{str(e)}\n{traceback.format_exc()}'
-        }
\ No newline at end of file
+        }
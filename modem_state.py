@@ -0,0 +1,579 @@
+import io
+import os
+import pickle
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from file_lock import atomic_write
+from modem_analysis import (MODEM_ID_COLUMNS, NO_POSITION, ModemAccumulator, offender_rows, parse_modem_frame,
+                            subtract_group_stats)
+from offenders import read_offenders
+
+# Parsed columns kept for every modem, besides its POSITION
+STATE_COLUMNS = ['USP', 'DSP', 'DSS', 'AMP_NAME', 'ON_NAME', 'dpath', 'ON_NODE', 'AMP_CODE']
+
+# Readings and node names of STATE_COLUMNS; saved names are codes into a
+# table of distinct values per part
+READING_COLUMNS = STATE_COLUMNS[:3]
+NAME_COLUMNS = STATE_COLUMNS[3:]
+
+# Node columns of the running totals: accumulator attribute -> key column
+STATS_COLUMNS = {
+    'amp_stats': 'AMP_NAME',
+    'on_stats': 'ON_NODE',
+    'path_stats': 'dpath'
+}
+
+# Reading histograms of the running totals (see modem_analysis.ReadingCounts)
+READING_ATTRIBUTES = ['amp_readings', 'on_readings']
+
+# group_stats first-position columns
+FIRST_COLUMNS = ('first_bad', 'first_dss')
+
+# Offender table drill-down kind (see offenders.INDEX_COLUMNS) holding the
+# flagged modems of each stats attribute's groups, for recomputing their
+# first positions. path_stats first positions are not used (the topology
+# keeps counts only) and are left as they are
+FIRST_POSITION_KINDS = {
+    'amp_stats': 'amp',
+    'on_stats': 'on'
+}
+
+# Modems per part file of a saved modem table
+PART_ROWS = 200_000
+
+# Share of the modem table the delta log may hold before the table is
+# rewritten with the logged rows folded in (see ModemState.compact)
+COMPACT_FRACTION = 0.05
+
+
+def state_folder(data_folder, city):
+    return os.path.join(data_folder, f'{city}_modems')
+
+
+def state_path(data_folder, city):
+    """The saved totals, which also name the modem table they go with"""
+    return os.path.join(state_folder(data_folder, city), 'state.pkl')
+
+
+def _legacy_state_path(data_folder, city):
+    # Older versions pickled the whole state into this one file
+    return os.path.join(data_folder, f'{city}_modems.pkl')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _empty_rows():
+    """State rows (see _state_rows) without any rows, with their dtypes"""
+    rows = pd.DataFrame({col: pd.Series(dtype=np.float64 if col in READING_COLUMNS else object)
+                         for col in STATE_COLUMNS})
+    rows['POSITION'] = np.zeros(0, dtype=np.int64)
+    rows.index = pd.Index([], dtype=object, name='MODEM_ID')
+    return rows
+
+
+def _state_rows(frame, positions):
+    """Parsed rows as state rows: text as plain objects, keyed by MODEM_ID"""
+    rows = pd.DataFrame({
+        col: frame[col].astype(object) if frame[col].dtype.name == 'category' else frame[col]
+        for col in STATE_COLUMNS
+    }, columns=STATE_COLUMNS)
+    rows['POSITION'] = np.asarray(positions, dtype=np.int64)
+    rows.index = pd.Index(frame['MODEM_ID'].astype(str).to_numpy(), dtype=object, name='MODEM_ID')
+    return rows
+
+
+def _as_frame(modems, sort=False):
+    """
+    State rows shaped like a parsed frame again: indexed by position, with
+    MODEM_ID. group_stats expects rows in position order; pass sort for
+    rows that are not.
+    """
+    frame = modems.reset_index().set_index('POSITION')
+    return frame.sort_index(kind='stable') if sort else frame
+
+
+def _hash_ids(ids):
+    """64-bit hashes of modem identifiers (strings), the keys a part is searched by"""
+    # Identifiers are nearly all distinct, so hashing them directly beats factorizing first
+    return pd.util.hash_array(np.asarray(ids, dtype=object), categorize=False)
+
+
+def _decode(codes, values):
+    decoded = values[np.clip(codes, 0, None)].astype(object) if len(values) else np.full(len(codes), None)
+    decoded[codes < 0] = None
+    return decoded
+
+
+def _save_array(path, array):
+    atomic_write(path, lambda f: np.save(f, array))
+
+
+def _write_part(folder, number, rows):
+    """
+    Save state rows (names may be categorical) as part number of a modem
+    table: one record array for memory-mapped reads, the distinct names,
+    and the hashes of the rows' MODEM_IDs in sorted order with the row of
+    each (the keys).
+    """
+    ids = np.asarray(rows.index.to_numpy(), dtype=str)
+    dtype = ([(col, np.float64) for col in READING_COLUMNS] + [('POSITION', np.int64)]
+             + [(col, np.int32) for col in NAME_COLUMNS] + [('MODEM_ID', ids.dtype)])
+    table = np.empty(len(rows), dtype=dtype)
+    names = {}
+    for col in READING_COLUMNS:
+        table[col] = rows[col].to_numpy(dtype=np.float64)
+    table['POSITION'] = rows['POSITION'].to_numpy()
+    for col in NAME_COLUMNS:
+        codes, uniques = pd.factorize(rows[col])
+        table[col] = codes
+        names[col] = np.asarray([str(value) for value in uniques], dtype=str)
+    table['MODEM_ID'] = ids
+
+    hashes = _hash_ids(ids)
+    order = np.argsort(hashes, kind='stable')
+    prefix = os.path.join(folder, str(number))
+    _save_array(f'{prefix}.rows.npy', table)
+    atomic_write(f'{prefix}.names.npz', lambda f: np.savez(f, **names))
+    _save_array(f'{prefix}.hashes.npy', hashes[order])
+    _save_array(f'{prefix}.order.npy', order.astype(np.int32))
+
+
+class _Part:
+    """One part of a saved modem table, memory-mapped, so a lookup reads only the rows it needs"""
+
+    def __init__(self, folder, number):
+        self.prefix = os.path.join(folder, str(number))
+        self.rows = np.load(f'{self.prefix}.rows.npy', mmap_mode='r')
+        self.hashes = np.load(f'{self.prefix}.hashes.npy', mmap_mode='r')
+        self.order = np.load(f'{self.prefix}.order.npy', mmap_mode='r')
+
+    def find(self, ids, hashes):
+        """Row of each modem (ids, an array of strings, and their hashes) in this part, or -1"""
+        start = np.searchsorted(self.hashes, hashes, side='left')
+        end = np.searchsorted(self.hashes, hashes, side='right')
+        found = np.full(len(ids), -1, dtype=np.int64)
+        hit = np.flatnonzero(end > start)
+        rows = np.asarray(self.order[start[hit]], dtype=np.int64)
+        match = self.rows['MODEM_ID'][rows] == ids[hit]
+        found[hit[match]] = rows[match]
+        # Another modem with the same hash, rare enough to check one by one
+        for i in hit[~match & (end[hit] - start[hit] > 1)]:
+            for row in self.order[start[i] + 1:end[i]]:
+                if self.rows['MODEM_ID'][row] == ids[i]:
+                    found[i] = row
+        return found
+
+    def frame(self, rows):
+        """State rows (see _state_rows) at rows, an array of row numbers"""
+        table = self.rows[rows]
+        with np.load(f'{self.prefix}.names.npz', allow_pickle=False) as saved:
+            names = {col: saved[col] for col in NAME_COLUMNS}
+        frame = pd.DataFrame({
+            col: table[col] if col in READING_COLUMNS else _decode(table[col], names[col])
+            for col in STATE_COLUMNS
+        }, columns=STATE_COLUMNS)
+        frame['POSITION'] = table['POSITION'].astype(np.int64)
+        frame.index = pd.Index(table['MODEM_ID'].astype(object), dtype=object, name='MODEM_ID')
+        return frame
+
+    def keyed_rows(self):
+        """Row numbers that have a key, in row order"""
+        return np.sort(self.order)
+
+
+class _PartWriter:
+    """
+    Writes state rows to a new modem table folder in parts of at most
+    PART_ROWS rows. Frames of half that or more (e.g. streamed chunks)
+    are written as they come; smaller ones are gathered first.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.parts = 0
+        self._pending = []
+        self._pending_rows = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def add(self, rows):
+        """Add state rows; rows added later replace earlier rows of the same modem"""
+        if len(rows) < PART_ROWS // 2:
+            self._pending.append(rows)
+            self._pending_rows += len(rows)
+            if self._pending_rows >= PART_ROWS // 2:
+                self._flush()
+            return
+        # Keep the order rows were added in, which decides between rows of the same modem
+        self._flush()
+        for start in range(0, len(rows), PART_ROWS):
+            self._write(rows.iloc[start:start + PART_ROWS])
+
+    def _write(self, rows):
+        _write_part(self.folder, self.parts, rows)
+        self.parts += 1
+
+    def _flush(self):
+        if self._pending:
+            self._write(pd.concat(self._pending) if len(self._pending) > 1 else self._pending[0])
+        self._pending = []
+        self._pending_rows = 0
+
+    def finish(self):
+        """Write the gathered rows and give every modem one key; returns the number of keyed rows"""
+        self._flush()
+        return self._drop_duplicates()
+
+    def _drop_duplicates(self):
+        """
+        Take the keys of all but the last row of each modem added more than
+        once out of the parts. Their rows stay in the parts, unreachable.
+        """
+        parts = [_Part(self.folder, number) for number in range(self.parts)]
+        if not parts:
+            return 0
+        hashes = np.concatenate([part.hashes for part in parts])
+        owners = np.repeat(np.arange(len(parts), dtype=np.int32), [len(part.hashes) for part in parts])
+        slots = np.concatenate([np.arange(len(part.hashes), dtype=np.int32) for part in parts])
+        # Stable, so keys of the same hash stay in the order the rows were added
+        order = np.argsort(hashes, kind='stable')
+        same = np.flatnonzero(hashes[order][1:] == hashes[order][:-1])
+        if not len(same):
+            return len(hashes)
+
+        def ids(keys):
+            values = np.empty(len(keys), dtype=object)
+            for number, part in enumerate(parts):
+                mine = owners[keys] == number
+                values[mine] = part.rows['MODEM_ID'][part.order[slots[keys[mine]]]]
+            return values
+
+        earlier, later = order[same], order[same + 1]
+        dropped = earlier[ids(earlier) == ids(later)]
+        for number, part in enumerate(parts):
+            drop = slots[dropped[owners[dropped] == number]]
+            if len(drop):
+                kept = np.ones(len(part.hashes), dtype=bool)
+                kept[drop] = False
+                _save_array(f'{part.prefix}.hashes.npy', np.asarray(part.hashes)[kept])
+                _save_array(f'{part.prefix}.order.npy', np.asarray(part.order)[kept])
+        return len(hashes) - len(dropped)
+
+
+def _read_index(data_folder, city):
+    try:
+        with open(state_path(data_folder, city), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_index(data_folder, city, index):
+    atomic_write(state_path(data_folder, city),
+                 lambda f: pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class ModemStateWriter:
+    """
+    Saves a city's modem state from a full export. Parsed frames are passed
+    to add as they are read (see modem_analysis.ModemAccumulator) and their
+    rows with a MODEM_ID are written to a new modem table part by part, so
+    a streamed export is never held whole. The city's previous state stays
+    in place until save.
+    """
+
+    def __init__(self, data_folder, city):
+        self.data_folder = data_folder
+        self.city = city
+        self.saved = False
+        self._start()
+
+    def _start(self):
+        self.generation = uuid.uuid4().hex
+        self.has_ids = False
+        self.next_position = 0
+        self._parts = _PartWriter(os.path.join(state_folder(self.data_folder, self.city), self.generation))
+
+    def add(self, frame):
+        """Write the rows of a parsed frame (see parse_modem_frame) that have a MODEM_ID"""
+        if len(frame):
+            self.next_position = max(self.next_position, int(frame.index.max()) + 1)
+        if 'MODEM_ID' not in frame.columns:
+            return
+        self.has_ids = True
+        frame = frame[frame['MODEM_ID'].notna().to_numpy()]
+        # Names stay categorical, as parsed, which spares hashing them again
+        rows = frame[STATE_COLUMNS].assign(POSITION=frame.index.to_numpy(dtype=np.int64))
+        rows.index = pd.Index(frame['MODEM_ID'].to_numpy(dtype=object), dtype=object, name='MODEM_ID')
+        self._parts.add(rows)
+
+    def clear(self):
+        """Drop the rows written so far, e.g. before the export is read again"""
+        self.discard()
+        self._start()
+
+    def save(self, totals, source_digest=None):
+        """
+        Make the written modem table and totals (the export's
+        ModemAccumulator) the city's state, replacing the previous one.
+        A modem listed twice keeps its last row; the export's other rows,
+        the earlier ones and those without a MODEM_ID, stay counted in the
+        totals as they are. Call with the city lock held.
+        """
+        rows = self._parts.finish()
+        previous = _read_index(self.data_folder, self.city)
+        _write_index(self.data_folder, self.city, {
+            'generation': self.generation,
+            'parts': self._parts.parts,
+            'rows': rows,
+            'next_position': self.next_position,
+            'source_digest': source_digest,
+            'log_bytes': 0,
+            'log_rows': 0,
+            'totals': totals
+        })
+        self.saved = True
+        if previous is not None and previous['generation'] != self.generation:
+            shutil.rmtree(os.path.join(state_folder(self.data_folder, self.city), previous['generation']),
+                          ignore_errors=True)
+        _remove(_legacy_state_path(self.data_folder, self.city))
+
+    def discard(self):
+        """Delete the written modem table, unless it was saved"""
+        if not self.saved:
+            shutil.rmtree(self._parts.folder, ignore_errors=True)
+
+
+class ModemState:
+    """
+    Latest readings of every modem of a city, keyed by MODEM_ID, and the
+    running totals (a ModemAccumulator) they add up to, as saved on disk:
+    the modems of the last full export in a memory-mapped modem table, the
+    rows of modems listed by deltas since in an append-only log, and the
+    totals. A delta (see apply_delta) looks up only the modems it lists and
+    saves only their rows and the totals, so it costs time in proportion
+    to the changed rows and the nodes, not the modems. Once the log holds
+    COMPACT_FRACTION of the table, the table is rewritten with it.
+    POSITION is the modem's row position in the export it first appeared
+    in; new modems are numbered after the export's last row, so top list
+    ties break in the same order as in a full analysis.
+    """
+
+    def __init__(self, data_folder, city, index):
+        self.data_folder = data_folder
+        self.city = city
+        self.index = index
+        self.log = _read_log(self._log_path(), index['log_bytes'])
+        self.offender_changes = None
+        self._parts = None
+        self._pending = None
+
+    def _folder(self):
+        return os.path.join(state_folder(self.data_folder, self.city), self.index['generation'])
+
+    def _log_path(self):
+        return os.path.join(self._folder(), 'log.pkl')
+
+    def parts(self):
+        """The modem table's parts, memory-mapped on first use"""
+        if self._parts is None:
+            self._parts = [_Part(self._folder(), number) for number in range(self.index['parts'])]
+        return self._parts
+
+    def totals(self):
+        """Running totals of the current modems"""
+        return self.index['totals']
+
+    def _current_rows(self, ids):
+        """State rows of the modems in ids (an Index of strings) that are current, indexed by MODEM_ID"""
+        latest = self.log[~self.log.index.duplicated(keep='last')]
+        logged = ids.isin(latest.index)
+        found = latest.loc[ids[logged]]
+        found = [found[~found['REMOVED'].to_numpy()].drop(columns='REMOVED')]
+        rest = ids[~logged]
+        if len(rest):
+            keys, hashes = np.asarray(rest, dtype=str), _hash_ids(rest)
+            for part in self.parts():
+                at = part.find(keys, hashes)
+                found.append(part.frame(at[at >= 0]))
+        found = [rows for rows in found if len(rows)]
+        return pd.concat(found) if found else _empty_rows()
+
+    def apply_delta(self, df):
+        """
+        Update the state from a delta export (read with read_modem_csv):
+        modems listed with valid readings are added or replaced, modems
+        listed with a missing reading are removed. Only the listed modems
+        are looked up; save logs their new rows and offender_changes holds
+        the change to the city's offender table (see
+        offenders.save_offender_changes). Returns counts of the modems
+        'updated', 'added' and 'removed'.
+        ON display names and AMP codes are only ever added, as in a full
+        analysis a node keeps the first name seen for it.
+        """
+        if 'MODEM_ID' not in df.columns:
+            raise ValueError(f'A delta export needs a modem identifier column ({", ".join(MODEM_ID_COLUMNS)})')
+        listed = df[df['MODEM_ID'].notna().to_numpy()]
+        listed = listed[~listed['MODEM_ID'].astype(str).duplicated(keep='last').to_numpy()]
+        listed_ids = pd.Index(listed['MODEM_ID'].astype(str).to_numpy(), dtype=object)
+        frame = parse_modem_frame(listed)
+        old = self._current_rows(listed_ids)
+        totals = self.totals()
+
+        # Modems already present keep their position, new ones are numbered after the last
+        valid_ids = listed_ids[listed.index.get_indexer(frame.index)]
+        at = old.index.get_indexer(valid_ids)
+        known = at >= 0
+        positions = np.zeros(len(valid_ids), dtype=np.int64)
+        positions[known] = old['POSITION'].to_numpy()[at[known]]
+        added = int((~known).sum())
+        positions[~known] = self.index['next_position'] + np.arange(added)
+        self.index['next_position'] += added
+        rows = _state_rows(frame, positions)
+        gone = old[~old.index.isin(valid_ids)]
+
+        stale = self._subtract(totals, ModemAccumulator(totals.profile).add(_as_frame(old, sort=True)))
+        current = _as_frame(rows, sort=True)
+        totals.merge(ModemAccumulator(totals.profile).add(current))
+
+        # The offender table loses the old rows of the listed modems and gains the flagged new ones
+        self.offender_changes = (old['POSITION'].to_numpy() + 2,
+                                 offender_rows(current, *totals.profile.evaluate(current)))
+        self._refresh_first_positions(totals, stale)
+        self._pending = pd.concat([rows.assign(REMOVED=False), gone.assign(REMOVED=True)])
+        return {'updated': int(known.sum()), 'added': added, 'removed': len(gone)}
+
+    @staticmethod
+    def _subtract(totals, removed):
+        """Take removed's rows out of totals; returns the stale groups per stats attribute"""
+        totals.total_modems -= removed.total_modems
+        totals.usp_dsp_count -= removed.usp_dsp_count
+        totals.usp_dsp_dss_count -= removed.usp_dsp_dss_count
+        totals.dss_only_count -= removed.dss_only_count
+        stale = {}
+        if removed.amp_stats is None:
+            return stale
+        for attr in STATS_COLUMNS:
+            stats, stale[attr] = subtract_group_stats(getattr(totals, attr), getattr(removed, attr))
+            setattr(totals, attr, stats)
+        for attr in READING_ATTRIBUTES:
+            getattr(totals, attr).subtract(getattr(removed, attr))
+        return stale
+
+    def _refresh_first_positions(self, totals, stale):
+        """
+        Recompute first_bad/first_dss of groups whose first flagged modem
+        changed, from the offender table with this delta's change applied:
+        it holds every flagged modem, by node and in export order.
+        """
+        groups = {attr: stale[attr].intersection(getattr(totals, attr).index)
+                  for attr in FIRST_POSITION_KINDS if attr in stale}
+        if not any(len(names) for names in groups.values()):
+            return
+        table = read_offenders(self.data_folder, self.city)
+        if table is None:
+            raise FileNotFoundError(f'No bad modem list saved for {self.city}, upload a full export')
+        table = table.updated(*self.offender_changes)
+        for attr, names in groups.items():
+            first = np.full((len(names), len(FIRST_COLUMNS)), NO_POSITION, dtype=np.int64)
+            for i, name in enumerate(names):
+                rows = table.node_rows(FIRST_POSITION_KINDS[attr], name)
+                numbers = table.column('ROW', rows)
+                flags = (table.column('USP_BAD', rows).astype(bool) | table.column('DSP_BAD', rows).astype(bool),
+                         table.column('DSS_BAD', rows).astype(bool))
+                for j, flag in enumerate(flags):
+                    if flag.any():
+                        first[i, j] = numbers[flag][0] - 2
+            getattr(totals, attr).loc[names, list(FIRST_COLUMNS)] = first
+
+    def results(self):
+        """Analysis results of the current state, like analyze_modem_data with include_aggregates"""
+        totals = self.totals()
+        results = totals.results()
+        results['profile'] = totals.profile.name
+        results['aggregates'] = totals.aggregates()
+        return results
+
+    def save(self):
+        """
+        Log the rows of the last apply_delta and save the totals, replacing
+        the saved ones atomically; once the log holds COMPACT_FRACTION of
+        the modem table, compact it. Call with the city lock held.
+        """
+        record = pickle.dumps(self._pending, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(self._log_path(), 'ab') as f:
+            # Drop what a save that did not finish may have appended
+            f.truncate(self.index['log_bytes'])
+            f.write(record)
+        self.index['log_bytes'] += len(record)
+        self.index['log_rows'] += len(self._pending)
+        self.log = pd.concat([self.log, self._pending]) if len(self.log) else self._pending
+        self._pending = None
+        if self.index['log_rows'] > COMPACT_FRACTION * self.index['rows']:
+            self.compact()
+        else:
+            _write_index(self.data_folder, self.city, self.index)
+
+    def compact(self):
+        """
+        Rewrite the modem table with the logged rows folded in, as a new
+        generation, and start an empty log. The table is read and written
+        part by part, so memory stays bounded by PART_ROWS.
+        """
+        parts, previous = self.parts(), self._folder()
+        self.index['generation'] = uuid.uuid4().hex
+        writer = _PartWriter(self._folder())
+        logged = self.log['POSITION'].to_numpy()
+        for part in parts:
+            rows = part.frame(part.keyed_rows())
+            writer.add(rows[~np.isin(rows['POSITION'].to_numpy(), logged)])
+        latest = self.log[~self.log.index.duplicated(keep='last')]
+        writer.add(latest[~latest['REMOVED'].to_numpy()].drop(columns='REMOVED').sort_values('POSITION'))
+        rows = writer.finish()
+        self.index.update(parts=writer.parts, rows=rows, log_bytes=0, log_rows=0)
+        _write_index(self.data_folder, self.city, self.index)
+        shutil.rmtree(previous, ignore_errors=True)
+        self.log = _read_log(self._log_path(), 0)
+        self._parts = None
+
+
+def _read_log(path, size):
+    """State rows logged by deltas (see ModemState.save), in order, from the first size bytes of the log"""
+    if not size:
+        return _empty_rows().assign(REMOVED=np.zeros(0, dtype=bool))
+    with open(path, 'rb') as f:
+        log = io.BytesIO(f.read(size))
+    records = []
+    while log.tell() < size:
+        records.append(pickle.load(log))
+    return pd.concat(records) if len(records) > 1 else records[0]
+
+
+def load_modem_state(data_folder, city):
+    """
+    The city's saved ModemState, or None if there is none. Only the
+    totals and the delta log are read; the modem table stays on disk and
+    is memory-mapped when a delta looks modems up, so nothing of it is
+    kept in memory between deltas.
+    """
+    index = _read_index(data_folder, city)
+    if index is None:
+        return None
+    return ModemState(data_folder, city, index)
+
+
+def remove_modem_state(data_folder, city):
+    """Delete a city's state, e.g. when the latest export has no modem identifiers"""
+    index = _read_index(data_folder, city)
+    _remove(state_path(data_folder, city))
+    if index is not None:
+        shutil.rmtree(os.path.join(state_folder(data_folder, city), index['generation']), ignore_errors=True)
+    _remove(_legacy_state_path(data_folder, city))
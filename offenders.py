@@ -0,0 +1,321 @@
+import io
+import os
+import pickle
+import threading
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from file_lock import atomic_write, locked, lock_path_for
+from modem_analysis import OFFENDER_COLUMNS
+from snapshots import FileCache
+
+# Drill-down keys: node kind -> offender column the table is indexed by
+INDEX_COLUMNS = {
+    'amp': 'AMP_NAME',
+    'amp_code': 'AMP_CODE',
+    'on': 'ON_NODE'
+}
+
+# Share of a saved table's size its change log (see save_offender_changes)
+# may grow to before the table is saved again with the changes folded in
+COMPACT_FRACTION = 0.1
+
+
+def offenders_path(data_folder, city):
+    return os.path.join(data_folder, f'{city}_offenders.npz')
+
+
+def offender_changes_path(data_folder, city):
+    return os.path.join(data_folder, f'{city}_offenders.changes')
+
+
+def _encode_column(values):
+    """
+    Array(s) stored for one offender column. Text columns are stored as
+    integer codes into a table of distinct values, since node names repeat
+    for every modem behind the same node.
+    """
+    if values.dtype != object and not isinstance(values.dtype, pd.StringDtype):
+        return {'': values.to_numpy()}
+    codes, uniques = pd.factorize(values)
+    return {
+        '.codes': codes.astype(np.int32),
+        '.values': np.asarray([str(value) for value in uniques], dtype=str)
+    }
+
+
+def node_index(codes, size):
+    """
+    Row positions grouped by node code: rows of node c are
+    order[offsets[c]:offsets[c + 1]], in export order. Rows without a
+    node (code -1) sort first and belong to no node.
+    """
+    order = np.argsort(codes, kind='stable').astype(np.int32)
+    offsets = np.searchsorted(codes[order], np.arange(size + 1)).astype(np.int32)
+    return order, offsets
+
+
+def _write_table(path, offenders):
+    # Each table gets a new GENERATION, so changes logged for the table it
+    # replaces are never applied to it
+    arrays = {'GENERATION': np.asarray(uuid.uuid4().hex)}
+    for col in OFFENDER_COLUMNS:
+        for suffix, array in _encode_column(offenders[col]).items():
+            arrays[f'{col}{suffix}'] = array
+    for col in INDEX_COLUMNS.values():
+        arrays[f'{col}.order'], arrays[f'{col}.offsets'] = node_index(arrays[f'{col}.codes'],
+                                                                     len(arrays[f'{col}.values']))
+
+    atomic_write(path, lambda f: np.savez(f, **arrays))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def save_offenders(data_folder, city, offenders):
+    """
+    Persist a city's offender table (see modem_analysis.OFFENDER_COLUMNS)
+    as uncompressed NumPy arrays, one per column, replacing the previous
+    table and its changes atomically. The node columns in INDEX_COLUMNS
+    also get a drill-down index (see node_index).
+    """
+    path = offenders_path(data_folder, city)
+    with locked(lock_path_for(path)):
+        _write_table(path, offenders)
+        _remove(offender_changes_path(data_folder, city))
+
+
+def save_offender_changes(data_folder, city, removed, offenders):
+    """
+    Change a city's saved offender table without writing it again: rows
+    whose ROW is in removed are dropped and the rows of offenders (an
+    offender table) are added, replacing any row with the same ROW. The
+    change is appended to a log next to the table and applied when the
+    table is loaded; once the log outgrows COMPACT_FRACTION of the table,
+    the table is saved again with the changes folded in.
+    """
+    path = offenders_path(data_folder, city)
+    changes_path = offender_changes_path(data_folder, city)
+    with locked(lock_path_for(path)):
+        table = read_offenders(data_folder, city)
+        if table is None:
+            raise FileNotFoundError(f'No offender table saved for {city}')
+        change = (table.generation, np.asarray(removed, dtype=np.int64), offenders)
+        with open(changes_path, 'ab') as f:
+            f.write(pickle.dumps(change, protocol=pickle.HIGHEST_PROTOCOL))
+        if os.path.getsize(changes_path) > COMPACT_FRACTION * os.path.getsize(path):
+            _write_table(path, table.updated(*change[1:]).frame())
+            _remove(changes_path)
+
+
+def _fold_changes(changes):
+    """
+    Net effect of change records (see save_offender_changes), applied in
+    order: the ROW numbers they touch, sorted, and the rows they leave, in
+    ROW order. The last record to name a ROW decides it.
+    """
+    if not changes:
+        return np.empty(0, dtype=np.int64), pd.DataFrame(columns=OFFENDER_COLUMNS)
+    numbers, picks = [], []
+    added = 0
+    for _, removed, rows in changes:
+        numbers += [removed, rows['ROW'].to_numpy(dtype=np.int64)]
+        picks += [np.full(len(removed), -1), added + np.arange(len(rows))]
+        added += len(rows)
+    events = pd.Series(np.concatenate(picks), index=np.concatenate(numbers))
+    last = events[~events.index.duplicated(keep='last')].to_numpy()
+    rows = pd.concat([rows for _, _, rows in changes], ignore_index=True).iloc[last[last >= 0]]
+    return np.unique(events.index.to_numpy()), rows.sort_values('ROW', kind='stable', ignore_index=True)
+
+
+class OffenderTable:
+    """
+    A saved offender table and the changes logged for it since it was
+    saved (see save_offender_changes). Text columns are decoded only for
+    the rows that are read, so slicing a large table stays cheap.
+    Rows are addressed by id: the saved rows by their position in the
+    file, rows added by changes after those.
+    """
+
+    def __init__(self, arrays, changes=()):
+        self._arrays = arrays
+        self.generation = str(arrays['GENERATION']) if 'GENERATION' in arrays else ''
+        self._changes = [change for change in changes if change[0] == self.generation]
+        self._saved = len(arrays['ROW'])
+        self._touched, self._added = _fold_changes(self._changes)
+        self._order = None
+        self._added_rows = {}
+        self._node_codes = {}
+        self._patched = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows()) if self._changes else self._saved
+
+    def updated(self, removed, offenders):
+        """This table with one more change applied, as save_offender_changes would"""
+        return OffenderTable(self._arrays, self._changes + [(self.generation, removed, offenders)])
+
+    def with_changes(self, changes):
+        """This table with change records read from its log; kept while the same records are passed"""
+        if not changes:
+            return self
+        with self._lock:
+            if self._patched is None or self._patched[0] is not changes:
+                self._patched = (changes, OffenderTable(self._arrays, changes))
+            return self._patched[1]
+
+    def _saved_column(self, col, rows):
+        if col in self._arrays:
+            return self._arrays[col][rows]
+        codes = self._arrays[f'{col}.codes'][rows]
+        values = self._arrays[f'{col}.values']
+        decoded = values[np.clip(codes, 0, None)].astype(object) if len(values) else np.full(len(codes), None)
+        decoded[codes < 0] = None
+        return decoded
+
+    def _live(self, rows):
+        """Saved rows (ids) that no change has touched"""
+        if not len(self._touched):
+            return rows
+        return rows[~np.isin(self._arrays['ROW'][rows], self._touched)]
+
+    def _merge(self, saved, added):
+        """Ids of saved rows and of added rows (positions in the added rows), in ROW order"""
+        if not len(added):
+            return saved
+        ids = np.concatenate([saved, self._saved + added])
+        numbers = np.concatenate([self._arrays['ROW'][saved], self._added['ROW'].to_numpy()[added]])
+        return ids[np.argsort(numbers, kind='stable')]
+
+    def _rows(self):
+        """Ids of every row, in export order"""
+        if self._order is None:
+            self._order = self._merge(self._live(np.arange(self._saved)), np.arange(len(self._added)))
+        return self._order
+
+    def column(self, col, rows=slice(None)):
+        """Values of one column for rows (a slice or an array of row ids)"""
+        if not self._changes:
+            return self._saved_column(col, rows)
+        ids = self._rows()[rows] if isinstance(rows, slice) else np.asarray(rows)
+        added = ids >= self._saved
+        saved = self._saved_column(col, ids[~added])
+        if not added.any():
+            return saved
+        extra = self._added[col].to_numpy()[ids[added] - self._saved]
+        values = np.empty(len(ids), dtype=np.result_type(saved, extra))
+        values[~added] = saved
+        values[added] = extra
+        return values
+
+    def frame(self, rows=slice(None)):
+        """Rows (a slice or an array of row ids) as a DataFrame"""
+        return pd.DataFrame({col: self.column(col, rows) for col in OFFENDER_COLUMNS},
+                            columns=OFFENDER_COLUMNS)
+
+    def iter_frames(self, chunk_rows):
+        """Yield the whole table in frames of chunk_rows rows"""
+        for start in range(0, len(self), chunk_rows):
+            yield self.frame(slice(start, start + chunk_rows))
+
+    def node_rows(self, kind, node):
+        """Row ids of one node's offenders (kind from INDEX_COLUMNS), in export order"""
+        col = INDEX_COLUMNS[kind]
+        with self._lock:
+            if col not in self._node_codes:
+                values = self._arrays[f'{col}.values']
+                self._node_codes[col] = {value: code for code, value in enumerate(values.tolist())}
+                if f'{col}.order' not in self._arrays:
+                    # Saved before the drill-down index existed
+                    self._arrays[f'{col}.order'], self._arrays[f'{col}.offsets'] = node_index(
+                        self._arrays[f'{col}.codes'], len(values))
+                if self._changes:
+                    keys = self._added[col].to_numpy(dtype=object)
+                    self._added_rows[col] = pd.Series(np.arange(len(keys))).groupby(keys).indices
+        code = self._node_codes[col].get(node)
+        if code is None:
+            rows = np.empty(0, dtype=np.int32)
+        else:
+            offsets = self._arrays[f'{col}.offsets']
+            rows = self._arrays[f'{col}.order'][offsets[code]:offsets[code + 1]]
+        if not self._changes:
+            return rows
+        return self._merge(self._live(rows), self._added_rows[col].get(node, np.empty(0, dtype=np.int64)))
+
+
+class _SavedArrays(dict):
+    """Arrays of an open .npz file, each read from it on first use"""
+
+    def __init__(self, saved):
+        super().__init__()
+        self._saved = saved
+
+    def __missing__(self, name):
+        value = self[name] = self._saved[name]
+        return value
+
+    def __contains__(self, name):
+        return super().__contains__(name) or name in self._saved.files
+
+
+def _read_offenders(path, stat):
+    try:
+        with np.load(path, allow_pickle=False) as saved:
+            return OffenderTable({name: saved[name] for name in saved.files})
+    except (OSError, ValueError):
+        return None
+
+
+def _read_changes(path, stat):
+    with open(path, 'rb') as f:
+        log = io.BytesIO(f.read(stat.st_size))
+    changes = []
+    while log.tell() < stat.st_size:
+        try:
+            changes.append(pickle.load(log))
+        except (pickle.UnpicklingError, EOFError):
+            # A change still being written
+            break
+    return changes
+
+
+_tables = FileCache(_read_offenders)
+_changes = FileCache(_read_changes)
+
+
+def load_offenders(data_folder, city):
+    """
+    The city's saved offender table with its changes applied, or None if
+    there is none. Tables and change logs are cached per process and
+    re-read only when a file's mtime or size changes, so drill-down
+    requests do not load the arrays again.
+    """
+    table = _tables.get(offenders_path(data_folder, city))
+    if table is None:
+        return None
+    return table.with_changes(_changes.get(offender_changes_path(data_folder, city)))
+
+
+def read_offenders(data_folder, city):
+    """
+    The city's saved offender table with its changes applied, or None,
+    read without the per-process cache. Columns are read from the file on
+    first use, so looking up a few nodes reads little of a large table.
+    """
+    try:
+        saved = np.load(offenders_path(data_folder, city), allow_pickle=False)
+    except FileNotFoundError:
+        return None
+    changes_path = offender_changes_path(data_folder, city)
+    try:
+        changes = _read_changes(changes_path, os.stat(changes_path))
+    except FileNotFoundError:
+        changes = []
+    return OffenderTable(_SavedArrays(saved), changes)
@@ -0,0 +1,142 @@
+import os
+
+import numpy as np
+
+from file_lock import atomic_write
+from snapshots import FileCache
+
+# Ranked node kinds: key column and display column in the aggregates
+RANKING_KINDS = {
+    'amp': ('amp_name', 'amp_code'),
+    'on': ('on_node', 'on_name')
+}
+
+# Sort keys: count and rank columns of the history the entries are compared with
+# (see city_results.mark_ranking_changes); percentage ranks are not kept there
+SORT_KEYS = {
+    'bad_count': ('bad_count', 'bad_rank'),
+    'percentage': ('bad_count', None),
+    'dss': ('dss_count', 'dss_rank')
+}
+
+COUNT_COLUMNS = ['total_count', 'bad_count', 'usp_count', 'dsp_count', 'dss_count']
+
+
+def rankings_path(data_folder, city):
+    return os.path.join(data_folder, f'{city}_rankings.npz')
+
+
+def _sort_orders(counts, bad_rank, dss_rank):
+    """
+    Node positions in ranking order for every sort key. Only nodes with a
+    flagged modem are ranked; bad_count and dss follow the top lists
+    (bad_rank/dss_rank), percentage ties keep the bad_count order.
+    """
+    bad = np.flatnonzero(bad_rank > 0)
+    dss = np.flatnonzero(dss_rank > 0)
+    bad_order = bad[np.argsort(bad_rank[bad], kind='stable')]
+    total = counts['total_count'][bad_order]
+    percentage = np.round(counts['bad_count'][bad_order] / np.maximum(total, 1) * 100, 2)
+    return {
+        'bad_count': bad_order,
+        'percentage': bad_order[np.argsort(-percentage, kind='stable')],
+        'dss': dss[np.argsort(dss_rank[dss], kind='stable')]
+    }
+
+
+class Rankings:
+    """
+    Every AMP and ON node of a city's latest run with its counts and the
+    node order for each sort key, computed once when the run is saved. A
+    page of any size is sliced from the order, so a longer list needs
+    neither the upload nor the analysis again.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        run_id = int(arrays['run_id'])
+        self.run_id = run_id if run_id >= 0 else None
+
+    def page(self, kind, sort='bad_count', offset=0, n=10, min_total=1):
+        """
+        Entries offset to offset + n of a ranking, as (number of ranked
+        nodes, entries). Entries have the shape of the top lists in the
+        results; sorted by 'dss' they are shaped like top_20_dss, with the
+        DSS count and percentage as bad_count and percentage. rank is the
+        node's place in the whole ranking, also when min_total leaves
+        nodes out, so it compares with the ranks of earlier runs.
+        """
+        if kind not in RANKING_KINDS:
+            raise ValueError(f'Unknown node type: {kind}')
+        if sort not in SORT_KEYS:
+            raise ValueError(f'Unknown sort key: {sort}')
+        key_col, name_col = RANKING_KINDS[kind]
+        arrays = {col: self.arrays[f'{kind}_{col}'] for col in [key_col, name_col] + COUNT_COLUMNS}
+        order = self.arrays[f'{kind}_order_{sort}']
+        ranks = np.arange(1, len(order) + 1)
+        if min_total > 1:
+            kept = arrays['total_count'][order] >= min_total
+            order = order[kept]
+            ranks = ranks[kept]
+
+        count_col = 'dss_count' if sort == 'dss' else 'bad_count'
+        entries = []
+        for rank, i in zip(ranks[offset:offset + n].tolist(), order[offset:offset + n]):
+            count = int(arrays[count_col][i])
+            total = int(arrays['total_count'][i])
+            entry = {
+                'rank': rank,
+                key_col: str(arrays[key_col][i]),
+                name_col: str(arrays[name_col][i]),
+                'bad_count': count,
+                'total_count': total,
+                # Rounded as in the top lists
+                'percentage': round(count / total * 100, 2) if total > 0 else 0
+            }
+            if sort != 'dss':
+                entry['usp_count'] = int(arrays['usp_count'][i])
+                entry['dsp_count'] = int(arrays['dsp_count'][i])
+            entries.append(entry)
+        return len(order), entries
+
+
+def save_rankings(data_folder, city, aggregates, run_id=None):
+    """
+    Persist the node rankings of a run from its aggregates (see
+    ModemAccumulator.aggregates), replacing the previous file atomically.
+    run_id is the run's history ID, for comparing entries with the run
+    before it.
+    """
+    arrays = {'run_id': np.asarray(run_id if run_id is not None else -1, dtype=np.int64)}
+    for kind, (key_col, name_col) in RANKING_KINDS.items():
+        rows = aggregates.get(kind, [])
+        arrays[f'{kind}_{key_col}'] = np.asarray([str(row[key_col]) for row in rows], dtype=str)
+        arrays[f'{kind}_{name_col}'] = np.asarray([str(row[name_col]) for row in rows], dtype=str)
+        counts = {col: np.asarray([row[col] for row in rows], dtype=np.int64) for col in COUNT_COLUMNS}
+        for col, values in counts.items():
+            arrays[f'{kind}_{col}'] = values
+        ranks = {col: np.asarray([row[col] or 0 for row in rows], dtype=np.int64) for col in ('bad_rank', 'dss_rank')}
+        for sort, order in _sort_orders(counts, ranks['bad_rank'], ranks['dss_rank']).items():
+            arrays[f'{kind}_order_{sort}'] = order
+
+    path = rankings_path(data_folder, city)
+    atomic_write(path, lambda f: np.savez(f, **arrays), lock=True)
+
+
+def _read_rankings(path, stat):
+    try:
+        with np.load(path, allow_pickle=False) as saved:
+            return Rankings({name: saved[name] for name in saved.files})
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+_rankings = FileCache(_read_rankings)
+
+
+def load_rankings(data_folder, city):
+    """
+    The city's Rankings, or None if there are none. Loaded once per
+    process and again only when the file's mtime or size changes.
+    """
+    return _rankings.get(rankings_path(data_folder, city))
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import pickle
+
+import json_codec
+from file_lock import atomic_write
+
+# Bytes read per step while hashing an upload
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_digest(stream):
+    """
+    SHA-256 of a file-like object, read in blocks so large uploads are
+    never held in memory twice. Rewinds the stream afterwards.
+    """
+    digest = hashlib.sha256()
+    for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b''):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def cache_key(content_digest, profile):
+    """Combine the upload hash with a threshold profile definition"""
+    config = json.dumps(profile, sort_keys=True)
+    return hashlib.sha256(f'{content_digest}:{config}'.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Analysis results stored as one JSON file per key in a shared directory,
+    so every gunicorn worker sees the same entries. Least recently used
+    entries (by file mtime, refreshed on every hit) are evicted once the
+    entry count or total size goes over the limit.
+    """
+
+    suffix = '.json'
+
+    def __init__(self, directory, max_entries=50, max_bytes=50 * 1024 * 1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}{self.suffix}')
+
+    def _read(self, f):
+        return json_codec.loads(f.read())
+
+    def _write(self, f, value):
+        f.write(json_codec.dumps(value))
+
+    def get(self, key):
+        """Return cached results for key, or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                results = self._read(f)
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return results
+
+    def contains(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, results):
+        """Store results for key and evict old entries"""
+        atomic_write(self._path(key), lambda f: self._write(f, results))
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until both limits are met"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        entries.sort(reverse=True)
+        total_bytes = 0
+        for index, (_, size, name) in enumerate(entries):
+            total_bytes += size
+            if index >= self.max_entries or total_bytes > self.max_bytes:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+class FrameCache(ResultCache):
+    """
+    Parsed upload frames (see modem_analysis.load_modem_frame), keyed by the
+    upload's content hash, so a file can be re-scored with another threshold
+    profile without parsing the CSV again. Same storage and eviction as
+    ResultCache; frames are pickled with their categorical dtypes.
+    """
+
+    suffix = '.pkl'
+
+    def _read(self, f):
+        return pickle.load(f)
+
+    def _write(self, f, value):
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,116 @@
+import gzip
+import hashlib
+import os
+import threading
+
+import json_codec
+
+try:
+    import brotli
+except ImportError:  # Optional, gzip is always available
+    brotli = None
+
+# Content encodings offered for cached snapshots, in order of preference
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+class JsonSnapshot:
+    """
+    One JSON file as it was on disk at a given mtime: the raw bytes (served
+    as-is), a content hash for the ETag, the parsed data and compressed
+    variants, each computed once.
+    """
+
+    def __init__(self, body, mtime):
+        self.body = body
+        self.mtime = mtime
+        self.etag = hashlib.sha1(body).hexdigest()
+        self._data = None
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    @property
+    def data(self):
+        """Parsed JSON; shared between callers, so treat it as read-only"""
+        if self._data is None:
+            self._data = json_codec.loads(self.body)
+        return self._data
+
+    def encoded(self, encoding):
+        """Body compressed with 'gzip' or 'br'"""
+        with self._lock:
+            if encoding not in self._encoded:
+                if encoding == 'br':
+                    self._encoded[encoding] = brotli.compress(self.body)
+                else:
+                    self._encoded[encoding] = gzip.compress(self.body, compresslevel=6)
+            return self._encoded[encoding]
+
+
+class FileCache:
+    """
+    Values built from files, cached per process and built again only when
+    a file's mtime or size changes, so a hit costs one stat(). load(path,
+    stat) builds the value, or returns None if the file cannot be used.
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """The value for path, or None if the file does not exist or load gives None"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.forget(path)
+            return None
+
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._entries.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        value = self.load(path, stat)
+        if value is not None:
+            with self._lock:
+                self._entries[path] = (version, value)
+        return value
+
+    def put(self, path, value):
+        """Cache value for path as it is now, e.g. right after writing it"""
+        stat = os.stat(path)
+        with self._lock:
+            self._entries[path] = ((stat.st_mtime_ns, stat.st_size), value)
+
+    def forget(self, path):
+        """Drop the cached value for path"""
+        with self._lock:
+            self._entries.pop(path, None)
+
+
+def _read_snapshot(path, stat):
+    with open(path, 'rb') as f:
+        return JsonSnapshot(f.read(), stat.st_mtime)
+
+
+_snapshots = FileCache(_read_snapshot)
+
+
+def load_snapshot(path):
+    """
+    Return the JsonSnapshot for path, or None if the file does not exist.
+    Snapshots are cached per process and re-read only when the file's
+    mtime or size changes, so repeated requests cost one stat().
+    """
+    return _snapshots.get(path)
+
+
+def preferred_encoding(accept_encodings):
+    """Best encoding from ENCODINGS the client accepts (a werkzeug MIMEAccept), or None"""
+    for encoding in ENCODINGS:
+        if accept_encodings[encoding]:
+            return encoding
+    return None
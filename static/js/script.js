@@ -161,11 +161,10 @@ function uploadFile() {
     })
         .then(response => response.json())
         .then(data => {
-            hideLoading();
-
             if (data.success) {
-                displayResults(data);
+                pollJob(data.job_id);
             } else {
+                hideLoading();
                 showError(data.error || 'An error occurred while processing the file');
             }
         })
@@ -175,6 +174,55 @@ function uploadFile() {
         });
 }
 
+// Upload job stages shown while the analysis runs in the background
+const jobStageText = {
+    'queued': 'Fajl je u redu za analizu...',
+    'parsing': 'Učitavanje CSV fajla...',
+    'aggregating': 'Analiza modema...'
+};
+
+// Give up polling a job after this many status checks, one per second
+const JOB_POLL_LIMIT = 30 * 60;
+
+// Poll the upload job until it is done or failed
+function pollJob(jobId, attempt = 1) {
+    fetch(`/jobs/${jobId}`)
+        .then(response => response.json())
+        .then(job => {
+            if (!job.success) {
+                hideLoading();
+                showError(job.error || 'An error occurred while processing the file');
+            } else if (job.status === 'done') {
+                hideLoading();
+                setLoadingText('Analyzing modem data...');
+                displayResults(job.results);
+            } else if (job.status === 'failed') {
+                hideLoading();
+                setLoadingText('Analyzing modem data...');
+                showError(job.error || 'An error occurred while processing the file');
+            } else if (attempt >= JOB_POLL_LIMIT) {
+                hideLoading();
+                setLoadingText('Analyzing modem data...');
+                showError('The analysis is taking too long, please reload the page later or upload the file again');
+            } else {
+                let text = jobStageText[job.status] || 'Analyzing modem data...';
+                if (job.rows) {
+                    text += ` (${job.rows.toLocaleString()} redova)`;
+                }
+                setLoadingText(text);
+                setTimeout(() => pollJob(jobId, attempt + 1), 1000);
+            }
+        })
+        .catch(error => {
+            hideLoading();
+            showError('Network error: ' + error.message);
+        });
+}
+
+function setLoadingText(text) {
+    safeUpdateElement('loadingText', text);
+}
+
 // Helper function to get percentage badge class based on value
 function getPercentageClass(percentage) {
     if (percentage >= 50) {
@@ -186,6 +234,17 @@ function getPercentageClass(percentage) {
     }
 }
 
+// Rank change indicator: moving up the list means more bad modems than before
+function rankChangeBadge(item) {
+    if (!item.rank_change) {
+        return '';
+    }
+    const direction = item.rank_change > 0 ? 'up' : 'down';
+    const arrow = item.rank_change > 0 ? '▲' : '▼';
+    const delta = item.bad_count_delta > 0 ? `+${item.bad_count_delta}` : item.bad_count_delta;
+    return `<span class="rank-change ${direction}" title="Prethodno: ${item.previous_rank}. mesto, ${item.previous_bad_count} modema (${delta})">${arrow}${Math.abs(item.rank_change)}</span>`;
+}
+
 // Safe element update function
 function safeUpdateElement(id, value) {
     const element = document.getElementById(id);
@@ -201,6 +260,94 @@ function safeUpdateStyle(id, property, value) {
     }
 }
 
+// Drill-down Functions
+const DRILLDOWN_PAGE_SIZE = 100;
+let drilldown = null;
+
+function makeDrillable(row, kind, node, title) {
+    row.classList.add('drillable');
+    row.title = 'Prikaži loše modeme';
+    row.addEventListener('click', () => openDrilldown(kind, node, title));
+}
+
+function openDrilldown(kind, node, title) {
+    drilldown = { city: currentCity, kind, node, offset: 0 };
+    document.getElementById('drilldownTableBody').innerHTML = '';
+    safeUpdateElement('drilldownTitle', title);
+    const section = document.getElementById('drilldownSection');
+    section.style.display = 'block';
+    loadDrilldownPage().then(() => section.scrollIntoView({ behavior: 'smooth', block: 'start' }));
+}
+
+function closeDrilldown() {
+    drilldown = null;
+    const section = document.getElementById('drilldownSection');
+    if (section) {
+        section.style.display = 'none';
+    }
+}
+
+function readingCell(value, bad) {
+    return `<td class="${bad ? 'bad-reading' : ''}">${value}</td>`;
+}
+
+async function loadDrilldownPage() {
+    const request = drilldown;
+    if (!request) {
+        return;
+    }
+    const node = encodeURIComponent(request.node);
+    const url = `/drilldown/${request.city}/${request.kind}/${node}?offset=${request.offset}&limit=${DRILLDOWN_PAGE_SIZE}`;
+
+    try {
+        const response = await fetch(url);
+        const data = await response.json();
+        if (drilldown !== request) {
+            return;
+        }
+        if (!data.success) {
+            safeUpdateElement('drilldownCount', data.error || 'Greška pri učitavanju');
+            document.getElementById('drilldownMore').style.display = 'none';
+            return;
+        }
+
+        const body = document.getElementById('drilldownTableBody');
+        data.modems.forEach(modem => {
+            const row = document.createElement('tr');
+            row.innerHTML = `
+                <td>${modem.ROW}</td>
+                <td>${modem.MODEM_ID || '-'}</td>
+                <td>${modem.ON_NODE || '-'}</td>
+                <td>${modem.AMP_NAME || '-'}</td>
+                ${readingCell(modem.USP, modem.USP_BAD)}
+                ${readingCell(modem.DSP, modem.DSP_BAD)}
+                ${readingCell(modem.DSS, modem.DSS_BAD)}
+            `;
+            body.appendChild(row);
+        });
+
+        request.offset += data.modems.length;
+        safeUpdateElement('drilldownCount', `Prikazano ${request.offset} od ${data.total}`);
+        document.getElementById('drilldownMore').style.display = request.offset < data.total ? 'inline-block' : 'none';
+    } catch (error) {
+        console.error('Error loading drill-down:', error);
+    }
+}
+
+document.getElementById('drilldownMore').addEventListener('click', loadDrilldownPage);
+
+// Export Functions
+function updateExportLinks(city) {
+    const badModemsLink = document.getElementById('exportBadModems');
+    const reportLink = document.getElementById('exportReport');
+    if (badModemsLink) {
+        badModemsLink.href = `/export/${city}/bad_modems?format=csv`;
+    }
+    if (reportLink) {
+        reportLink.href = `/export/${city}/report?format=xlsx`;
+    }
+}
+
 // Display Functions
 function displayResults(data) {
     // Show results section
@@ -222,106 +369,255 @@ function displayResults(data) {
         lastUpdated.style.display = 'flex';
     }
 
+    // Point the download links at the current city's exports
+    updateExportLinks(currentCity);
+    closeDrilldown();
+
     // Update Network Health Dashboard
     updateHealthDashboard(data);
 
     // Display new entries summary if available
     displayNewEntriesSummary(data.new_entries_summary);
 
-    // Populate Top 10 AMP table
-    const ampTableBody = document.getElementById('ampTableBody');
-    if (ampTableBody) {
-        ampTableBody.innerHTML = '';
-        data.top_10_amp.forEach(item => {
-            const row = document.createElement('tr');
-            if (item.is_new) {
-                row.classList.add('new-entry');
-            }
-            const percentClass = getPercentageClass(item.percentage);
-            row.innerHTML = `
-                <td>${item.rank}</td>
-                <td>
-                    ${item.amp_name}
-                    ${item.is_new ? '<span class="new-badge">NOVO</span>' : ''}
-                </td>
-                <td><span class="amp-code">${item.amp_code || 'N/A'}</span></td>
-                <td>
-                    <span class="bad-count">${item.bad_count}</span>
-                    <span class="percentage-badge ${percentClass}">${item.percentage}%</span>
-                    <span class="total-info">od ${item.total_count}</span>
-                </td>
-                <td>${item.usp_count}</td>
-                <td>${item.dsp_count}</td>
-            `;
-            ampTableBody.appendChild(row);
-        });
+    // Tables and charts are loaded per section when they come into view
+    resetRankings(data);
+
+    // Smooth scroll to results
+    setTimeout(() => {
+        results.scrollIntoView({ behavior: 'smooth', block: 'start' });
+    }, 100);
+}
+
+// Ranking Sections
+// Each table and the charts are fetched from /rankings when they scroll
+// into view; the charts use the first page of each table's default order
+const RANKING_SECTIONS = {
+    amp: { kind: 'amp', sort: 'bad_count', size: 10, list: 'top_10_amp', section: 'ampSection', prefix: 'amp' },
+    on: { kind: 'on', sort: 'bad_count', size: 10, list: 'top_10_on', section: 'onSection', prefix: 'on' },
+    dss: { kind: 'on', sort: 'dss', size: 20, list: 'top_20_dss', section: 'dssSection', prefix: 'dss' }
+};
+let rankings = null;
+let rankingObserver = null;
+
+function ampRankingRow(item) {
+    const row = document.createElement('tr');
+    if (item.is_new) {
+        row.classList.add('new-entry');
     }
+    const percentClass = getPercentageClass(item.percentage);
+    row.innerHTML = `
+        <td>${item.rank}${rankChangeBadge(item)}</td>
+        <td>
+            ${item.amp_name}
+            ${item.is_new ? '<span class="new-badge">NOVO</span>' : ''}
+        </td>
+        <td><span class="amp-code">${item.amp_code || 'N/A'}</span></td>
+        <td>
+            <span class="bad-count">${item.bad_count}</span>
+            <span class="percentage-badge ${percentClass}">${item.percentage}%</span>
+            <span class="total-info">od ${item.total_count}</span>
+        </td>
+        <td>${item.usp_count}</td>
+        <td>${item.dsp_count}</td>
+    `;
+    makeDrillable(row, 'amp', item.amp_name, item.amp_name);
+    return row;
+}
 
-    // Populate Top 10 ON table
-    const onTableBody = document.getElementById('onTableBody');
-    if (onTableBody) {
-        onTableBody.innerHTML = '';
-        data.top_10_on.forEach(item => {
-            const row = document.createElement('tr');
-            if (item.is_new) {
-                row.classList.add('new-entry');
-            }
-            const percentClass = getPercentageClass(item.percentage);
-            row.innerHTML = `
-                <td>${item.rank}</td>
-                <td>
-                    ${item.on_node}
-                    ${item.is_new ? '<span class="new-badge">NOVO</span>' : ''}
-                </td>
-                <td>${item.on_name}</td>
-                <td>
-                    <span class="bad-count">${item.bad_count}</span>
-                    <span class="percentage-badge ${percentClass}">${item.percentage}%</span>
-                    <span class="total-info">od ${item.total_count}</span>
-                </td>
-                <td>${item.usp_count}</td>
-                <td>${item.dsp_count}</td>
-            `;
-            onTableBody.appendChild(row);
-        });
+function onRankingRow(item) {
+    const row = document.createElement('tr');
+    if (item.is_new) {
+        row.classList.add('new-entry');
     }
+    const percentClass = getPercentageClass(item.percentage);
+    row.innerHTML = `
+        <td>${item.rank}${rankChangeBadge(item)}</td>
+        <td>
+            ${item.on_node}
+            ${item.is_new ? '<span class="new-badge">NOVO</span>' : ''}
+        </td>
+        <td>${item.on_name}</td>
+        <td>
+            <span class="bad-count">${item.bad_count}</span>
+            <span class="percentage-badge ${percentClass}">${item.percentage}%</span>
+            <span class="total-info">od ${item.total_count}</span>
+        </td>
+        <td>${item.usp_count}</td>
+        <td>${item.dsp_count}</td>
+    `;
+    makeDrillable(row, 'on', item.on_node, `${item.on_node} - ${item.on_name}`);
+    return row;
+}
 
-    // Populate Top 20 DSS table
-    const dssTableBody = document.getElementById('dssTableBody');
-    if (dssTableBody) {
-        dssTableBody.innerHTML = '';
-        data.top_20_dss.forEach(item => {
-            const row = document.createElement('tr');
-            if (item.is_new) {
-                row.classList.add('new-entry');
-            }
-            const percentClass = getPercentageClass(item.percentage);
-            row.innerHTML = `
-                <td>${item.rank}</td>
-                <td>
-                    ${item.on_node}
-                    ${item.is_new ? '<span class="new-badge">NOVO</span>' : ''}
-                </td>
-                <td>${item.on_name}</td>
-                <td>
-                    <span class="bad-count">${item.bad_count}</span>
-                    <span class="percentage-badge ${percentClass}">${item.percentage}%</span>
-                    <span class="total-info">od ${item.total_count}</span>
-                </td>
-            `;
-            dssTableBody.appendChild(row);
+function dssRankingRow(item) {
+    const row = document.createElement('tr');
+    if (item.is_new) {
+        row.classList.add('new-entry');
+    }
+    const percentClass = getPercentageClass(item.percentage);
+    row.innerHTML = `
+        <td>${item.rank}${rankChangeBadge(item)}</td>
+        <td>
+            ${item.on_node}
+            ${item.is_new ? '<span class="new-badge">NOVO</span>' : ''}
+        </td>
+        <td>${item.on_name}</td>
+        <td>
+            <span class="bad-count">${item.bad_count}</span>
+            <span class="percentage-badge ${percentClass}">${item.percentage}%</span>
+            <span class="total-info">od ${item.total_count}</span>
+        </td>
+    `;
+    makeDrillable(row, 'on', item.on_node, `${item.on_node} - ${item.on_name}`);
+    return row;
+}
+
+const RANKING_ROWS = { amp: ampRankingRow, on: onRankingRow, dss: dssRankingRow };
+
+function resetRankings(data) {
+    if (rankingObserver) {
+        rankingObserver.disconnect();
+    }
+    if (ampChartInstance) ampChartInstance.destroy();
+    if (onChartInstance) onChartInstance.destroy();
+    if (dssChartInstance) dssChartInstance.destroy();
+    ampChartInstance = onChartInstance = dssChartInstance = null;
+
+    rankings = { city: currentCity, data, first: {}, sections: {} };
+    Object.entries(RANKING_SECTIONS).forEach(([name, config]) => {
+        rankings.sections[name] = { sort: config.sort, offset: 0, total: 0, loaded: false };
+        document.getElementById(`${config.prefix}TableBody`).innerHTML = '';
+        const sortSelect = document.getElementById(`${config.prefix}RankingSort`);
+        if (sortSelect) {
+            sortSelect.value = config.sort;
+        }
+        updateRankingFooter(name);
+    });
+    rankings.chartsLoaded = false;
+
+    const load = (element) => {
+        if (element.id === 'chartsSection') {
+            loadRankingCharts();
+        } else {
+            const name = Object.keys(RANKING_SECTIONS).find(key => RANKING_SECTIONS[key].section === element.id);
+            loadRankingPage(name);
+        }
+    };
+    const elements = ['chartsSection', ...Object.values(RANKING_SECTIONS).map(config => config.section)]
+        .map(id => document.getElementById(id))
+        .filter(element => element);
+
+    if (!('IntersectionObserver' in window)) {
+        elements.forEach(load);
+        return;
+    }
+    rankingObserver = new IntersectionObserver((entries, observer) => {
+        entries.filter(entry => entry.isIntersecting).forEach(entry => {
+            observer.unobserve(entry.target);
+            load(entry.target);
         });
+    }, { rootMargin: '200px' });
+    elements.forEach(element => rankingObserver.observe(element));
+}
+
+async function fetchRanking(request, name, sort, offset) {
+    const config = RANKING_SECTIONS[name];
+    const url = `/rankings/${request.city}/${config.kind}?sort=${sort}&n=${config.size}&offset=${offset}`;
+    const response = await fetch(url);
+    if (response.status === 404 && offset === 0 && sort === config.sort) {
+        // Results saved before rankings were kept: use the list in the results
+        const items = request.data[config.list] || [];
+        return { items, total: items.length };
     }
+    const page = await response.json();
+    if (!page.success) {
+        throw new Error(page.error || 'Failed to load ranking');
+    }
+    return page;
+}
 
-    // Create charts
-    createCharts(data);
+// First page in the default order, shared by a table and its chart
+function firstRankingPage(request, name) {
+    if (!request.first[name]) {
+        request.first[name] = fetchRanking(request, name, RANKING_SECTIONS[name].sort, 0);
+    }
+    return request.first[name];
+}
 
-    // Smooth scroll to results
-    setTimeout(() => {
-        results.scrollIntoView({ behavior: 'smooth', block: 'start' });
-    }, 100);
+async function loadRankingPage(name) {
+    const request = rankings;
+    const state = request ? request.sections[name] : null;
+    if (!state || state.loading) {
+        return;
+    }
+    state.loading = true;
+    try {
+        const page = state.offset === 0 && state.sort === RANKING_SECTIONS[name].sort
+            ? await firstRankingPage(request, name)
+            : await fetchRanking(request, name, state.sort, state.offset);
+        if (rankings !== request || request.sections[name] !== state) {
+            return;
+        }
+        const body = document.getElementById(`${RANKING_SECTIONS[name].prefix}TableBody`);
+        page.items.forEach(item => body.appendChild(RANKING_ROWS[name](item)));
+        state.offset += page.items.length;
+        state.total = page.total;
+        state.loaded = true;
+        updateRankingFooter(name);
+    } catch (error) {
+        console.error('Error loading ranking:', error);
+    } finally {
+        state.loading = false;
+    }
 }
 
+async function loadRankingCharts() {
+    const request = rankings;
+    if (!request || request.chartsLoaded) {
+        return;
+    }
+    request.chartsLoaded = true;
+    try {
+        const [amp, on, dss] = await Promise.all(['amp', 'on', 'dss'].map(name => firstRankingPage(request, name)));
+        if (rankings === request) {
+            createCharts({ top_10_amp: amp.items, top_10_on: on.items, top_20_dss: dss.items });
+        }
+    } catch (error) {
+        console.error('Error loading charts:', error);
+    }
+}
+
+function changeRankingSort(name, sort) {
+    if (!rankings) {
+        return;
+    }
+    rankings.sections[name] = { sort, offset: 0, total: 0, loaded: false };
+    document.getElementById(`${RANKING_SECTIONS[name].prefix}TableBody`).innerHTML = '';
+    updateRankingFooter(name);
+    loadRankingPage(name);
+}
+
+function updateRankingFooter(name) {
+    const prefix = RANKING_SECTIONS[name].prefix;
+    const state = rankings.sections[name];
+    safeUpdateElement(`${prefix}RankingCount`, state.loaded ? `Prikazano ${state.offset} od ${state.total}` : '');
+    const more = document.getElementById(`${prefix}RankingMore`);
+    if (more) {
+        more.style.display = state.loaded && state.offset < state.total ? 'inline-block' : 'none';
+    }
+}
+
+Object.entries(RANKING_SECTIONS).forEach(([name, config]) => {
+    const more = document.getElementById(`${config.prefix}RankingMore`);
+    if (more) {
+        more.addEventListener('click', () => loadRankingPage(name));
+    }
+    const sortSelect = document.getElementById(`${config.prefix}RankingSort`);
+    if (sortSelect) {
+        sortSelect.addEventListener('change', () => changeRankingSort(name, sortSelect.value));
+    }
+});
+
 // Network Health Dashboard
 function updateHealthDashboard(data) {
     const total = data.summary.total_modems;
@@ -0,0 +1,144 @@
+"""
+Named threshold profiles and the compiled rule evaluator.
+
+A profile sets the limits outside of which a modem counts as bad:
+
+    {
+        'usp_min': 33, 'usp_max': 50.9,
+        'dsp_min': -8.9, 'dsp_max': 15.9,
+        'dss_min': 36,
+        'node_classes': [
+            # Optional overrides for a class of nodes, matched by regex
+            {'name': 'rpd', 'column': 'ON_NAME', 'pattern': 'rpd', 'usp_max': 52}
+        ]
+    }
+
+Extra profiles and the profile used for each city can be loaded from a
+JSON file named by THRESHOLD_PROFILES_FILE:
+{"profiles": {"name": {...}}, "cities": {"novi_sad": "name"}}.
+"""
+import copy
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+LIMIT_NAMES = ('usp_min', 'usp_max', 'dsp_min', 'dsp_max', 'dss_min')
+
+DEFAULT_PROFILE = 'default'
+
+PROFILES = {
+    'default': {
+        'usp_min': 33,
+        'usp_max': 50.9,
+        'dsp_min': -8.9,
+        'dsp_max': 15.9,
+        'dss_min': 36
+    },
+    # Limits of the original daily analysis script
+    'legacy': {
+        'usp_min': 33,
+        'usp_max': 50.9,
+        'dsp_min': -6.9,
+        'dsp_max': 14.9,
+        'dss_min': 36
+    }
+}
+
+# Profile used for each city; cities not listed use DEFAULT_PROFILE
+CITY_PROFILES = {}
+
+
+def _load_profiles_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    for name, profile in config.get('profiles', {}).items():
+        PROFILES[name] = validate_profile(profile)
+    CITY_PROFILES.update(config.get('cities', {}))
+
+
+def validate_profile(profile):
+    """Check that a profile defines every limit; returns it unchanged"""
+    missing = [name for name in LIMIT_NAMES if name not in profile]
+    if missing:
+        raise ValueError(f'Threshold profile is missing: {", ".join(missing)}')
+    for node_class in profile.get('node_classes', []):
+        if 'pattern' not in node_class:
+            raise ValueError(f'Node class {node_class.get("name", "?")} has no pattern')
+    return profile
+
+
+def get_profile(name):
+    """Profile definition by name; raises KeyError for unknown profiles"""
+    if name not in PROFILES:
+        raise KeyError(f'Unknown threshold profile: {name}')
+    return copy.deepcopy(PROFILES[name])
+
+
+def profile_for_city(city):
+    return CITY_PROFILES.get(city, DEFAULT_PROFILE)
+
+
+def _match(values, pattern):
+    # Regex match evaluated once per distinct value, then spread to rows
+    codes, uniques = pd.factorize(values)
+    matched = pd.Series(uniques, dtype=object).astype(str).str.contains(pattern, case=False, regex=True).to_numpy()
+    return np.where(codes >= 0, matched[codes] if len(uniques) else False, False)
+
+
+class CompiledProfile:
+    """
+    A profile prepared for evaluation: limits are plain floats and node
+    classes are applied as per-row limit arrays, so every rule is one
+    vectorized comparison over the whole frame.
+    """
+
+    def __init__(self, name, profile):
+        profile = validate_profile(profile)
+        self.name = name
+        self.definition = profile
+        self.limits = {limit: float(profile[limit]) for limit in LIMIT_NAMES}
+        self.node_classes = [
+            (node_class.get('column', 'ON_NAME'), node_class['pattern'],
+             {limit: float(node_class[limit]) for limit in LIMIT_NAMES if limit in node_class})
+            for node_class in profile.get('node_classes', [])
+        ]
+
+    def _row_limits(self, frame):
+        if not self.node_classes:
+            return self.limits
+        limits = {limit: np.full(len(frame), value) for limit, value in self.limits.items()}
+        for column, pattern, overrides in self.node_classes:
+            in_class = _match(frame[column], pattern)
+            for limit, value in overrides.items():
+                limits[limit][in_class] = value
+        return limits
+
+    def evaluate(self, frame):
+        """
+        Row flags for a parsed frame (see modem_analysis.parse_modem_frame):
+        returns (usp_bad, dsp_bad, dss_bad) boolean arrays.
+        """
+        limits = self._row_limits(frame)
+        usp = frame['USP'].to_numpy()
+        dsp = frame['DSP'].to_numpy()
+        dss = frame['DSS'].to_numpy()
+        usp_bad = (usp > limits['usp_max']) | (usp < limits['usp_min'])
+        dsp_bad = (dsp > limits['dsp_max']) | (dsp < limits['dsp_min'])
+        dss_bad = dss < limits['dss_min']
+        return usp_bad, dsp_bad, dss_bad
+
+
+_compiled = {}
+
+
+def compile_profile(name):
+    """Compiled profile by name, compiled once per process"""
+    if name not in _compiled:
+        _compiled[name] = CompiledProfile(name, get_profile(name))
+    return _compiled[name]
+
+
+if os.environ.get('THRESHOLD_PROFILES_FILE'):
+    _load_profiles_file(os.environ['THRESHOLD_PROFILES_FILE'])
@@ -0,0 +1,181 @@
+import os
+
+import numpy as np
+
+from file_lock import atomic_write
+from snapshots import FileCache
+
+# Separator of the plant levels in dpath, e.g. "005-002;ON-05-0001;AMP-05-01270"
+PATH_SEPARATOR = ';'
+
+# Counts kept per dpath and rolled up per tree node
+COUNT_COLUMNS = ['total_count', 'bad_count', 'usp_count', 'dsp_count', 'dss_count']
+
+# Sort keys accepted by TopologyTree.worst
+SORT_KEYS = ('bad_count', 'dss_count', 'percentage', 'dss_percentage')
+
+# Node kinds by dpath segment prefix; the first segment is always the hub
+SEGMENT_KINDS = {
+    'ON-': 'on',
+    'AMP-': 'amp'
+}
+
+# Share of bad (USP/DSP) modems, in percent, above which an amplifier counts as degraded
+DEGRADED_PERCENTAGE = 20
+
+
+def topology_path(data_folder, city):
+    return os.path.join(data_folder, f'{city}_topology.npz')
+
+
+def _segment_kind(segment, level):
+    if level == 0:
+        return 'hub'
+    for prefix, kind in SEGMENT_KINDS.items():
+        if segment.startswith(prefix):
+            return kind
+    return 'node'
+
+
+class TopologyTree:
+    """
+    The plant hierarchy in dpath (hub, ON node, then each AMP cascade
+    level) as flat node arrays, with the modem counts of every subtree.
+    Node ids follow the order of first appearance; parent[i] is -1 for
+    hubs. Built from per-dpath counts, so queries never touch the rows.
+    """
+
+    def __init__(self, paths, counts):
+        """paths: distinct dpath strings; counts: {column: array} aligned with paths"""
+        ids = {}
+        nodes = []
+        parents = []
+        levels = []
+        ancestors = []
+        leaves = []
+        # Once per distinct dpath, like extract_codes: far fewer than rows
+        for leaf_index, path in enumerate(paths):
+            parent = -1
+            prefix = None
+            for level, segment in enumerate(str(path).split(PATH_SEPARATOR)):
+                prefix = segment if prefix is None else f'{prefix}{PATH_SEPARATOR}{segment}'
+                node = ids.get(prefix)
+                if node is None:
+                    node = ids[prefix] = len(nodes)
+                    nodes.append(prefix)
+                    parents.append(parent)
+                    levels.append(level)
+                ancestors.append(node)
+                leaves.append(leaf_index)
+                parent = node
+
+        self.ids = ids
+        self.node = np.asarray(nodes, dtype=object)
+        self.parent = np.asarray(parents, dtype=np.int64)
+        self.level = np.asarray(levels, dtype=np.int64)
+        self.name = np.asarray([node.rsplit(PATH_SEPARATOR, 1)[-1] for node in nodes], dtype=object)
+        self.kind = np.asarray([_segment_kind(name, level) for name, level in zip(self.name, levels)], dtype=object)
+        self.children = np.bincount(self.parent[self.parent >= 0], minlength=len(nodes))
+
+        # Bottom-up rollup in one pass: every dpath adds its counts to each of its prefixes
+        ancestors = np.asarray(ancestors, dtype=np.int64)
+        leaves = np.asarray(leaves, dtype=np.int64)
+        self.counts = {
+            col: np.bincount(ancestors, weights=np.asarray(counts[col])[leaves], minlength=len(nodes)).astype(np.int64)
+            for col in COUNT_COLUMNS
+        }
+
+    def __len__(self):
+        return len(self.node)
+
+    def _percentage(self, col):
+        total = self.counts['total_count']
+        return np.round(np.divide(self.counts[col] * 100, total, out=np.zeros(len(total)), where=total > 0), 2)
+
+    def rows(self, nodes):
+        """Row dictionaries for node ids"""
+        bad_percentage = self._percentage('bad_count')
+        dss_percentage = self._percentage('dss_count')
+        return [{
+            'node': self.node[i],
+            'name': self.name[i],
+            'kind': self.kind[i],
+            'level': int(self.level[i]),
+            'parent': self.node[self.parent[i]] if self.parent[i] >= 0 else None,
+            'children': int(self.children[i]),
+            **{col: int(self.counts[col][i]) for col in COUNT_COLUMNS},
+            'percentage': float(bad_percentage[i]),
+            'dss_percentage': float(dss_percentage[i])
+        } for i in nodes]
+
+    def worst(self, level=None, kind=None, sort='bad_count', n=10, min_total=1):
+        """
+        Ids of the n worst subtrees, optionally only at one level (0 = hub,
+        1 = ON node, 2 = first AMP, ...) or of one kind. Ties keep the
+        order of first appearance.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f'Unknown sort key: {sort}')
+        selected = self.counts['total_count'] >= min_total
+        if level is not None:
+            selected &= self.level == level
+        if kind is not None:
+            selected &= self.kind == kind
+        if sort == 'percentage':
+            key = self._percentage('bad_count')
+        elif sort == 'dss_percentage':
+            key = self._percentage('dss_count')
+        else:
+            key = self.counts[sort]
+        candidates = np.flatnonzero(selected & (key > 0))
+        order = np.argsort(-key[candidates], kind='stable')
+        return candidates[order[:n]]
+
+    def degraded_upstream(self, min_percentage=DEGRADED_PERCENTAGE, min_children=1):
+        """
+        Ids of amplifiers with at least min_children downstream amplifiers
+        directly below them, all of them degraded (bad share of at least
+        min_percentage), worst first. Points at a fault upstream of them.
+        """
+        is_amp = self.kind == 'amp'
+        has_parent = self.parent >= 0
+        below_amp = is_amp & has_parent
+        below_amp[has_parent] &= is_amp[self.parent[has_parent]]
+        degraded = self._percentage('bad_count') >= min_percentage
+        downstream = np.bincount(self.parent[below_amp], minlength=len(self))
+        degraded_downstream = np.bincount(self.parent[below_amp & degraded], minlength=len(self))
+        candidates = np.flatnonzero(is_amp & (downstream >= min_children) & (degraded_downstream == downstream))
+        order = np.argsort(-self.counts['bad_count'][candidates], kind='stable')
+        return candidates[order]
+
+
+def save_topology(data_folder, city, rows):
+    """
+    Persist a city's per-dpath counts (aggregates()['paths']) as NumPy
+    arrays, replacing the previous file atomically
+    """
+    path = topology_path(data_folder, city)
+    arrays = {'dpath': np.asarray([str(row['dpath']) for row in rows], dtype=str)}
+    for col in COUNT_COLUMNS:
+        arrays[col] = np.asarray([row[col] for row in rows], dtype=np.int64)
+
+    atomic_write(path, lambda f: np.savez(f, **arrays), lock=True)
+
+
+def _read_topology(path, stat):
+    try:
+        with np.load(path, allow_pickle=False) as saved:
+            return TopologyTree(saved['dpath'].tolist(), {col: saved[col] for col in COUNT_COLUMNS})
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+_trees = FileCache(_read_topology)
+
+
+def load_topology(data_folder, city):
+    """
+    The city's TopologyTree, or None if there is none. Trees are built
+    once per process and again only when the file's mtime or size changes.
+    """
+    return _trees.get(topology_path(data_folder, city))
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import time
+
+from file_lock import temporary_path
+from result_cache import HASH_BLOCK_SIZE
+
+
+class UploadSpool:
+    """
+    Uploaded exports saved to disk under their content hash (SHA-256, as
+    result_cache.file_digest), hashed while they are written, so the raw
+    bytes are read once and never held in worker memory. Files stay after
+    their job for retries and re-scoring, until the retention policy
+    removes them: anything older than max_age, then the least recently
+    used files once the total goes over max_bytes. Files used within
+    min_age (e.g. still queued) are never removed for size.
+    """
+
+    suffix = '.csv'
+
+    def __init__(self, directory, max_age=24 * 60 * 60, max_bytes=2 * 1024 * 1024 * 1024, min_age=30 * 60):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.directory, f'{digest}{self.suffix}')
+
+    def save(self, stream):
+        """
+        Copy a file-like object to the spool, returning (digest, path).
+        An upload that is already spooled is kept and only marked as used.
+        """
+        digest = hashlib.sha256()
+        with temporary_path(self.directory) as tmp_path:
+            with open(tmp_path, 'wb') as f:
+                for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b''):
+                    digest.update(block)
+                    f.write(block)
+            path = self.path(digest.hexdigest())
+            if os.path.exists(path):
+                # Already spooled; the copy is removed with the temporary file
+                self.touch(path)
+            else:
+                os.replace(tmp_path, path)
+        self.cleanup()
+        return digest.hexdigest(), path
+
+    def touch(self, path):
+        """Mark a spooled file as used, so it is kept longest"""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def cleanup(self):
+        """Apply the retention policy (see the class docstring)"""
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith((self.suffix, '.tmp')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime < now - self.max_age:
+                    os.remove(path)
+                elif name.endswith(self.suffix):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                continue
+
+        # Newest first; files past the size limit go, unless recently used
+        entries.sort(reverse=True)
+        total_bytes = 0
+        for mtime, size, path in entries:
+            total_bytes += size
+            if total_bytes > self.max_bytes and mtime < now - self.min_age:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass